@@ -0,0 +1,210 @@
+"""
+Fake hosts for running the ``deploy`` package without any servers.
+
+Each fake host is a directory. Fabric's ``run``, ``sudo``, ``put``, ``get``
+and the ``local`` commands that reach a host over ssh, like ``git push``,
+are run against that directory instead. Remote paths are written under
+``MARKER``, set ``env.root_path`` below it and every host gets its own
+copy of the tree.
+
+Every round trip to a host can be slowed down by a fixed latency, and is
+counted, including those made from the worker processes of
+``deploy.parallel``.
+
+**Usage:**
+
+.. code-block:: python
+
+    hosts = FakeHosts(latency=0.02)
+    hosts.install()  # Before anything from deploy is imported
+
+    from deploy.env import bootstrap
+
+    env.root_path = MARKER
+    execute(bootstrap, hosts=hosts.reset(4))
+    print(hosts.round_trips())
+
+"""
+
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from collections import Counter
+
+# Root of the remote paths, rewritten to the directory of each host
+MARKER = '/velcro-fakehost'
+
+_SSH_URL = re.compile(r'ssh://[^@/\s]+@([^/\s:]+)/(?={0})'.format(
+    re.escape(MARKER)))
+
+
+class FakeHosts(object):
+
+    """ A set of fake hosts in a temporary directory.
+    """
+
+    def __init__(self, latency=0.0, root=None):
+        """ Create the fake hosts directory.
+
+        :param latency: Seconds added to every round trip.
+        :type latency: float
+
+        :param root: Directory to keep the hosts in, a temporary one by
+            default.
+        :type root: str
+        """
+
+        self.latency = latency
+        self.root = root or tempfile.mkdtemp(prefix='velcro-fakehosts-')
+        self.log = os.path.join(self.root, 'round-trips.log')
+        self.hosts = []
+
+    def path(self, host):
+        """ Directory standing in for the root of a host.
+
+        :param host: The host name.
+        :type host: str
+
+        :returns: str -- The directory.
+        """
+
+        return os.path.join(self.root, 'hosts', host)
+
+    def reset(self, count):
+        """ Start over with ``count`` empty hosts and no round trips.
+
+        :param count: The number of hosts.
+        :type count: int
+
+        :returns: list -- The host names.
+        """
+
+        shutil.rmtree(os.path.join(self.root, 'hosts'), True)
+        open(self.log, 'w').close()
+
+        self.hosts = ['host{0}'.format(i + 1) for i in range(count)]
+        for host in self.hosts:
+            os.makedirs(self.path(host) + MARKER)
+        return list(self.hosts)
+
+    def round_trips(self):
+        """ Count the round trips made to each host since the last reset.
+
+        :returns: collections.Counter -- Host name to round trips.
+        """
+
+        with open(self.log) as f:
+            return Counter(line.strip() for line in f)
+
+    def _trip(self, host):
+        """ Count a round trip to a host and wait out the latency.
+        """
+
+        # A single short append is atomic, so worker processes can share it
+        with open(self.log, 'a') as f:
+            f.write(host + '\n')
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _remote(self, path):
+        """ Rewrite a remote path to the directory of the current host.
+        """
+
+        from fabric.state import env
+
+        return path.replace(MARKER, self.path(env.host) + MARKER)
+
+    def install(self):
+        """ Point Fabric at the fake hosts. Call it before anything from
+        ``deploy`` is imported, ``deploy.timing`` wraps the functions
+        patched here.
+        """
+
+        from fabric import api, operations
+        from fabric.state import env, output
+
+        harness = self
+
+        def _result(command, stdout, stderr, code, ok):
+            result = operations._AttributeString(stdout.rstrip('\n'))
+            result.return_code = code
+            result.failed = not ok
+            result.succeeded = ok
+            result.stderr = operations._AttributeString(stderr)
+            result.command = command
+            return result
+
+        def run_command(command, shell=True, pty=True, combine_stderr=True,
+                        sudo=False, user=None, quiet=False, warn_only=False,
+                        stdout=None, stderr=None, group=None, timeout=None,
+                        shell_escape=None, capture_buffer_size=None):
+            harness._trip(env.host)
+            if output.running and not quiet:
+                print('[{0}] {1}: {2}'.format(
+                    env.host, 'sudo' if sudo else 'run', command))
+            full = harness._remote(operations._prefix_commands(
+                operations._prefix_env_vars(command), 'remote'))
+            process = subprocess.Popen(
+                ['/bin/bash', '-c', full], stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE)
+            out, err = process.communicate()
+            ok = process.returncode in env.ok_ret_codes
+            result = _result(command, out, err, process.returncode, ok)
+            if not ok and not (warn_only or quiet or env.warn_only):
+                operations.error('{0}() received nonzero return code {1} '
+                                 'while executing!\n\nRequested: {2}'.format(
+                                     'sudo' if sudo else 'run',
+                                     process.returncode, command),
+                                 stdout=out, stderr=err)
+            return result
+
+        def local(command, capture=False, shell=None):
+            reached = _SSH_URL.findall(command)
+            for host in reached:
+                harness._trip(host)
+            command = _SSH_URL.sub(
+                lambda m: harness.path(m.group(1)), command)
+            with open(os.devnull, 'w') as devnull:
+                process = subprocess.Popen(
+                    command, shell=True, executable=shell or '/bin/bash',
+                    stdout=subprocess.PIPE if capture else
+                    None if output.stdout else devnull,
+                    stderr=subprocess.PIPE if capture else
+                    None if output.stderr else devnull,
+                    env=dict(os.environ, **env.get('shell_env', {})))
+                out, err = process.communicate()
+            ok = process.returncode in env.ok_ret_codes
+            result = _result(command, out or '', err or '',
+                             process.returncode, ok)
+            if not ok and not env.warn_only:
+                operations.error('local() encountered an error (return code '
+                                 '{0}) while executing {1!r}'.format(
+                                     process.returncode, command))
+            return result
+
+        def put(local_path=None, remote_path=None, use_sudo=False,
+                mirror_local_mode=False, mode=None, *args, **kwargs):
+            harness._trip(env.host)
+            remote = harness._remote(remote_path)
+            if os.path.isdir(remote):
+                remote = os.path.join(remote, os.path.basename(local_path))
+            shutil.copy(local_path, remote)
+            return [remote_path]
+
+        def get(remote_path, local_path=None, *args, **kwargs):
+            harness._trip(env.host)
+            local_path = local_path or os.path.basename(remote_path)
+            shutil.copy(harness._remote(remote_path), local_path)
+            return [local_path]
+
+        operations._run_command = run_command
+        operations.local = api.local = local
+        operations.put = api.put = put
+        operations.get = api.get = get
+
+        # Control masters only exist for real ssh connections
+        import deploy.connections
+        deploy.connections.ssh_master = lambda user, host: None
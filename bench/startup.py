@@ -0,0 +1,92 @@
+"""
+Startup latency benchmark for the fabfile.
+
+Times ``fab -l`` and ``fab live print_config_path`` from the root of the
+repository, optionally against another revision so the two can be compared.
+Nothing connects to a host, both commands only run locally.
+
+**Usage:**
+
+.. code-block:: none
+
+    python bench/startup.py
+    python bench/startup.py --runs 20 --compare HEAD~1
+
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = [
+    ['-l'],
+    ['live', 'print_config_path'],
+]
+
+
+def _time(fab, args, cwd, runs):
+    """ Run ``fab`` with ``args`` ``runs`` times, returning the timings or
+    None if the command fails, for example when the task does not exist
+    at an older revision.
+    """
+
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            started = time.time()
+            if subprocess.call([fab] + args, cwd=cwd, stdout=devnull,
+                               stderr=devnull):
+                return None
+            timings.append(time.time() - started)
+    return sorted(timings)
+
+
+def _export(revision):
+    """ Export a revision of the repository into a temporary directory.
+    """
+
+    path = tempfile.mkdtemp(prefix='velcro-bench-')
+    archive = subprocess.Popen(['git', 'archive', revision], cwd=ROOT,
+                               stdout=subprocess.PIPE)
+    subprocess.check_call(['tar', '-x', '-C', path], stdin=archive.stdout)
+    archive.wait()
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--fab', default='fab')
+    parser.add_argument('--compare', metavar='REVISION',
+                        help='Also time the fabfile at this revision')
+    options = parser.parse_args()
+
+    trees = [('working tree', ROOT)]
+    if options.compare:
+        trees.insert(0, (options.compare, _export(options.compare)))
+
+    try:
+        for args in COMMANDS:
+            print('fab {0}'.format(' '.join(args)))
+            for name, path in trees:
+                timings = _time(options.fab, args, path, options.runs)
+                if timings is None:
+                    print('  {0:<16} failed'.format(name))
+                    continue
+                print('  {0:<16} min {1:.3f}s  median {2:.3f}s'.format(
+                    name, timings[0], timings[len(timings) // 2]))
+    finally:
+        if options.compare:
+            shutil.rmtree(trees[0][1])
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,202 @@
+"""
+Deploy benchmarks against fake hosts.
+
+Times ``bootstrap``, ``deploy``, ``parallel_deploy``, a redeploy of an
+unchanged commit, ``rollback`` and the Nginx ``symlink`` on a growing number
+of hosts and a growing project tree, and counts the round trips each makes.
+Hosts are local directories, see ``bench/fakehosts.py``, with ``--latency``
+seconds added to every round trip to stand in for the network.
+
+The project tree is a git repository of ``--files`` files, bootstrap creates
+one directory for every ten of them.
+
+**Usage:**
+
+.. code-block:: none
+
+    python bench/tasks.py
+    python bench/tasks.py --hosts 1,8,32 --files 100,5000 --latency 0.05
+
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, ROOT)
+
+from fakehosts import FakeHosts, MARKER  # noqa: E402
+
+STEPS = ['bootstrap', 'deploy', 'redeploy', 'parallel_deploy', 'rollback',
+         'symlink']
+
+
+def _project(path, files):
+    """ Create a git repository of ``files`` files, ten to a directory,
+    along with the Nginx config the symlink step links.
+    """
+
+    for i in range(files):
+        directory = os.path.join(path, 'src', 'd{0}'.format(i // 10))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, 'f{0}.txt'.format(i)), 'w') as f:
+            f.write('{0}\n'.format(i) * 20)
+
+    os.makedirs(os.path.join(path, 'config', 'stage'))
+    with open(os.path.join(path, 'config', 'stage', 'nginx.conf'), 'w') as f:
+        f.write('server {}\n')
+
+    with open(os.devnull, 'w') as devnull:
+        for command in (['git', 'init', '-q'],
+                        ['git', 'checkout', '-q', '-b', 'master'],
+                        ['git', 'add', '-A'],
+                        ['git', '-c', 'user.name=bench', '-c',
+                         'user.email=bench@localhost', 'commit', '-q', '-m',
+                         'Initial commit']):
+            subprocess.check_call(command, cwd=path, stdout=devnull,
+                                  stderr=devnull)
+
+
+def _commit(path):
+    """ Change one file of the project and commit it.
+    """
+
+    with open(os.path.join(path, 'src', 'd0', 'f0.txt'), 'a') as f:
+        f.write('changed\n')
+    subprocess.check_call(['git', '-c', 'user.name=bench', '-c',
+                           'user.email=bench@localhost', 'commit', '-q',
+                           '-am', 'Change'], cwd=path)
+
+
+def _configure(env, hosts, cache, files):
+    """ Point ``env`` at the fake hosts for a fresh run.
+    """
+
+    from deploy.scm.git import parallel_deploy
+
+    env.client = 'bench'
+    env.project = 'velcro'
+    env.user = 'bench'
+    env.scm = 'git'
+    env.root_path = MARKER
+    env.directories = {'src': None, 'logs': None, 'tree': dict(
+        ('d{0}'.format(i), None) for i in range(max(1, files // 10)))}
+    env.use_releases = True
+    env.bundle_cache_dir = cache
+    env.http_server_conf_path = MARKER + '/etc/nginx'
+    env.nginx_conf = 'nginx.conf'
+    env.deploy_sessions = {}
+    env.hosts = env.all_hosts = hosts
+
+    if hasattr(parallel_deploy, 'return_value'):
+        del parallel_deploy.return_value
+
+
+def _scenario(harness, count, files):
+    """ Run every step against ``count`` fresh hosts and a project of
+    ``files`` files.
+
+    :returns: dict -- Step name to wall time and round trips.
+    """
+
+    from fabric.api import execute
+    from fabric.state import env
+    from deploy.conf import settings
+    from deploy.env import bootstrap
+    from deploy.http.nginx import symlink
+    from deploy.release import rollback
+    from deploy.scm.git import deploy, parallel_deploy
+    from deploy.utils import _target
+
+    hosts = harness.reset(count)
+    project = tempfile.mkdtemp(prefix='velcro-bench-')
+    cache = tempfile.mkdtemp(prefix='velcro-bench-cache-')
+    cwd = os.getcwd()
+    results = {}
+
+    def step(name, task, *args, **kwargs):
+        open(harness.log, 'w').close()
+        # Every fab run starts a new deploy session
+        env.deploy_sessions = {}
+        started = time.time()
+        execute(task, *args, hosts=hosts, **kwargs)
+        results[name] = (time.time() - started,
+                         sum(harness.round_trips().values()))
+
+    try:
+        _project(project, files)
+        os.chdir(project)
+        _configure(env, hosts, cache, files)
+        _target('stage')
+        env.config_path = os.path.join(settings.SRC_PATH(), 'config',
+                                       'stage')
+        for host in hosts:
+            os.makedirs(harness.path(host) + MARKER + '/etc/nginx/'
+                        'sites-available')
+            os.makedirs(harness.path(host) + MARKER + '/etc/nginx/'
+                        'sites-enabled')
+
+        step('bootstrap', bootstrap)
+        step('deploy', deploy, 'master')
+        step('redeploy', deploy, 'master')
+
+        # A new commit in a new release for parallel_deploy and rollback
+        _commit(project)
+        env.now = str(int(env.now) + 1)
+        step('parallel_deploy', parallel_deploy, 'master')
+        step('rollback', rollback)
+        step('symlink', symlink)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(project, True)
+        shutil.rmtree(cache, True)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--hosts', default='1,4,16',
+                        help='Comma separated host counts')
+    parser.add_argument('--files', default='10,1000',
+                        help='Comma separated project tree sizes')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='Seconds added to every round trip')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Show the output of the tasks')
+    options = parser.parse_args()
+
+    harness = FakeHosts(latency=options.latency)
+    harness.install()
+
+    from fabric.state import output
+
+    if not options.verbose:
+        for level in output:
+            output[level] = False
+
+    print('{0:<16} {1:>5} {2:>6} {3:>9} {4:>12}'.format(
+        'step', 'hosts', 'files', 'wall', 'round trips'))
+    try:
+        for files in [int(n) for n in options.files.split(',')]:
+            for count in [int(n) for n in options.hosts.split(',')]:
+                results = _scenario(harness, count, files)
+                for name in STEPS:
+                    wall, trips = results[name]
+                    print('{0:<16} {1:>5} {2:>6} {3:>8.3f}s {4:>12}'.format(
+                        name, count, files, wall, trips))
+    finally:
+        shutil.rmtree(harness.root, True)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,270 @@
+"""
+Checks of the deploy tasks against fake hosts, see ``bench/fakehosts.py``.
+
+**Usage:**
+
+.. code-block:: none
+
+    python -m pytest bench
+
+"""
+
+import os
+import shutil
+import tempfile
+
+import pytest
+
+from fakehosts import FakeHosts, MARKER
+from tasks import _commit, _configure, _project
+
+harness = FakeHosts()
+harness.install()
+
+from fabric.api import execute  # noqa: E402
+from fabric.state import env, output  # noqa: E402
+
+
+def _healthy():
+    """ Health check failing on host2, for ``rolling_deploy``.
+    """
+
+    return env.host != 'host2'
+
+
+def _host():
+    """ Task returning the host it ran on, for ``run_parallel``.
+    """
+
+    return env.host
+
+
+@pytest.fixture
+def hosts():
+    """ Three bootstrapped fake hosts and a project to deploy to them.
+    """
+
+    from deploy.conf import settings
+    from deploy.env import bootstrap
+    from deploy.utils import _target
+
+    for level in output:
+        output[level] = False
+
+    hosts = harness.reset(3)
+    project = tempfile.mkdtemp(prefix='velcro-test-')
+    cache = tempfile.mkdtemp(prefix='velcro-test-cache-')
+    cwd = os.getcwd()
+
+    _project(project, 10)
+    os.chdir(project)
+    try:
+        _configure(env, hosts, cache, 10)
+        _target('stage')
+        env.config_path = os.path.join(settings.SRC_PATH(), 'config',
+                                       'stage')
+        env.sudo_user = 'bench'
+        for host in hosts:
+            for name in ('sites-available', 'sites-enabled'):
+                os.makedirs(harness.path(host) + MARKER + '/etc/nginx/' +
+                            name)
+        execute(bootstrap, hosts=hosts)
+        yield hosts
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(project, True)
+        shutil.rmtree(cache, True)
+        for name in ('rolling_health_check', 'rolling_batch', 'nginx_test',
+                     'nginx_reload'):
+            env.pop(name, None)
+
+
+def _run(task, hosts, *args, **kwargs):
+    """ Run a task on the hosts as a new ``fab`` run would, counting the
+    round trips it makes.
+
+    :returns: tuple -- Host to the task result and host to round trips.
+    """
+
+    open(harness.log, 'w').close()
+    env.deploy_sessions = {}
+    results = execute(task, *args, hosts=hosts, **kwargs)
+    return results, harness.round_trips()
+
+
+def _next_commit():
+    """ Commit a change, released under a new timestamp.
+
+    :returns: str -- The commit.
+    """
+
+    _commit(os.getcwd())
+    env.now = str(int(env.now) + 1)
+    return _head()
+
+
+def _head():
+    """ The commit checked out in the project.
+    """
+
+    from fabric.api import local
+
+    return local('git rev-parse HEAD', capture=True).strip()
+
+
+def _remote(host, path):
+    """ Local path of a remote path on a fake host.
+    """
+
+    return harness.path(host) + path
+
+
+def _current(host):
+    """ Name and commit of the current release of a host.
+    """
+
+    from deploy.conf import settings
+
+    current = _remote(host, settings.CURRENT_PATH())
+    with open(os.path.join(current, 'REVISION')) as f:
+        return os.path.basename(os.readlink(current)), f.read().strip()
+
+
+def test_round_trips(hosts):
+    from deploy.release import rollback
+    from deploy.scm.git import deploy, parallel_deploy
+
+    _, trips = _run(deploy, hosts, 'master')
+    assert trips == dict((host, 4) for host in hosts)
+
+    _, trips = _run(deploy, hosts, 'master')
+    assert trips == dict((host, 1) for host in hosts)
+
+    _next_commit()
+    _, trips = _run(parallel_deploy, hosts, 'master')
+    assert trips == dict((host, 4) for host in hosts)
+
+    _, trips = _run(rollback, hosts)
+    assert trips == dict((host, 1) for host in hosts)
+
+
+def test_release_swap_and_rollback(hosts):
+    from deploy.release import rollback
+    from deploy.scm.git import deploy
+
+    first = _head()
+    _run(deploy, hosts, 'master')
+    released = _current(hosts[0])
+    assert released[1] == first
+
+    second = _next_commit()
+    _run(deploy, hosts, 'master')
+    for host in hosts:
+        assert _current(host)[1] == second
+        assert _current(host)[0] != released[0]
+
+    results, _ = _run(rollback, hosts)
+    for host in hosts:
+        assert results[host] == released[0]
+        assert _current(host) == released
+
+
+def test_rolling_halt_and_restore(hosts):
+    from deploy.rolling import rolling_deploy
+    from deploy.scm.git import deploy
+
+    first = _head()
+    _run(deploy, hosts, 'master')
+    _next_commit()
+
+    env.rolling_health_check = 'test_deploy._healthy'
+    env.rolling_batch = 1
+    results, _ = _run(rolling_deploy, hosts, 'master')
+    rows = results[hosts[0]]
+
+    assert rows['host1'][4] == 'rolled back to {0}'.format(first[:7])
+    assert rows['host2'][4] == 'rolled back to {0}'.format(first[:7])
+    assert rows['host3'][4] == 'not deployed'
+    for host in hosts:
+        assert _current(host)[1] == first
+    assert rows['host1'][3] != '-'
+
+
+def test_nginx_validate_and_restore(hosts):
+    from deploy.conf import settings
+    from deploy.http.nginx import sync_nginx
+    from deploy.scm.git import deploy
+
+    _run(deploy, hosts, 'master')
+    env.nginx_test = '! grep -q broken "$available"'
+    env.nginx_reload = 'true'
+
+    results, _ = _run(sync_nginx, hosts)
+    good = results[hosts[0]][1]
+    assert results[hosts[0]][0] == 'reloaded'
+
+    results, _ = _run(sync_nginx, hosts)
+    assert results[hosts[0]] == ('unchanged', good, good)
+
+    host = hosts[0]
+    conf, available, enabled = [
+        _remote(host, path) for path in (
+            os.path.join(settings.CONFIG_PATH(), settings.NGINX_CONF()),
+            os.path.join(settings.HTTP_SERVER_CONF_PATH(),
+                         'sites-available', 'bench_velcro_stage'),
+            os.path.join(settings.HTTP_SERVER_CONF_PATH(),
+                         'sites-enabled', 'bench_velcro_stage'))]
+    with open(conf, 'a') as f:
+        f.write('broken\n')
+
+    results, _ = _run(sync_nginx, [host])
+    status, new, was = results[host]
+    assert (status, was) == ('invalid', good)
+    assert new != good
+    assert os.path.basename(os.readlink(available)) == good + '.conf'
+    assert os.readlink(enabled).endswith(available[len(harness.path(host)):])
+    assert 'broken' not in open(enabled).read()
+
+
+def test_nginx_restore_keeps_previous_site(hosts):
+    from deploy.http.nginx import _paths, sync_nginx
+    from deploy.scm.git import deploy
+
+    _run(deploy, hosts, 'master')
+    env.nginx_test = '! grep -q broken "$available"'
+    env.nginx_reload = 'true'
+    host = hosts[0]
+    conf, available, enabled = [_remote(host, path) for path in _paths()]
+    with open(conf, 'a') as f:
+        f.write('broken\n')
+
+    # A hand managed config of a disabled site
+    with open(available, 'w') as f:
+        f.write('server {}\n')
+    results, _ = _run(sync_nginx, [host])
+    assert results[host][0] == 'invalid'
+    assert not os.path.islink(available)
+    assert open(available).read() == 'server {}\n'
+    assert not os.path.lexists(enabled)
+
+    # A link to the config the deploy already replaced
+    os.remove(available)
+    os.symlink(conf, available)
+    os.symlink(available, enabled)
+    results, _ = _run(sync_nginx, [host])
+    assert results[host][0] == 'invalid'
+    assert os.path.dirname(os.readlink(available)) != os.path.dirname(conf)
+    assert os.readlink(enabled) == available
+
+    results, _ = _run(sync_nginx, [host])
+    assert results[host][0] == 'invalid'
+
+
+def test_run_parallel_results_finishing_together():
+    from deploy.parallel import run_parallel
+
+    hosts = ['host{0}'.format(i) for i in range(12)]
+    results = run_parallel(_host, hosts)
+    assert dict((host, (result['status'], result['result']))
+                for host, result in results.items()) == \
+        dict((host, ('ok', host)) for host in hosts)
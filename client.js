@@ -1,5 +1,8 @@
 var io = require('socket.io-client');
 var http = require('http');
+var fs = require('fs');
+var os = require('os');
+var path = require('path');
 var config = require('config');
 
 var host = config.get('SocketServer.host');
@@ -7,28 +10,152 @@ var host = config.get('SocketServer.host');
 console.log('connecting to '+'https://'+host);
 var socket = io.connect('https://'+host, {reconnect: true});
 
+// Sonos commands sent and not answered yet
+var inflight = 0;
+var ready = false;
+var stopping = false;
+
+// During a reload the old and the new process are both connected until
+// the old one gets SIGINT. The new one holds the commands it receives
+// until the old one has stopped taking them and says when, in the
+// handover file, then sends on only those received from that time on.
+// Each start writes a token of its own next to its pid, so a pid file or
+// handover left by an earlier process with the same pid is not taken for
+// the previous one's. Commands are held for HOLD_TIMEOUT at most, by
+// then pm2 has killed the previous process (listen_timeout plus
+// kill_timeout in ecosystem.json), or the pid belongs to something else.
+var HOLD_TIMEOUT = 15000;
+var name = (process.env.name || 'client') + '-' +
+  (process.env.NODE_APP_INSTANCE || 0);
+var pidFile = path.join(os.tmpdir(), name + '.pid');
+var handoverFile = path.join(os.tmpdir(), name + '.handover');
+var token = process.pid + '-' + Date.now() + '-' +
+  Math.random().toString(36).slice(2);
+var previous = readPrevious();
+var holdUntil = Date.now() + HOLD_TIMEOUT;
+var held = [];
+fs.writeFileSync(pidFile, process.pid + ' ' + token);
+
+// Pid and token of the previous process, null if there is none running
+function readPrevious() {
+  try {
+    var started = fs.readFileSync(pidFile, 'utf8').split(' ');
+    var pid = parseInt(started[0], 10);
+    if (pid && pid !== process.pid && started[1] && alive(pid)) {
+      return {pid: pid, token: started[1]};
+    }
+  } catch (e) {
+    // No previous process
+  }
+  return null;
+}
+
+function alive(pid) {
+  try {
+    process.kill(pid, 0);
+    return true;
+  } catch (e) {
+    return false;
+  }
+}
+
+// Time the previous process stopped taking commands, null until it has
+function handoverTime() {
+  try {
+    var handover = fs.readFileSync(handoverFile, 'utf8').split(' ');
+    if (handover[0] === previous.token) {
+      return parseInt(handover[1], 10);
+    }
+  } catch (e) {
+    // Not handed over yet
+  }
+  return null;
+}
+
+function waitForHandover() {
+  if (previous === null) {
+    return;
+  }
+  var since = handoverTime();
+  if (since === null && alive(previous.pid) && Date.now() < holdUntil) {
+    setTimeout(waitForHandover, 100);
+    return;
+  }
+  if (since === null && Date.now() >= holdUntil) {
+    console.log('No handover from ' + previous.pid + ' after ' +
+                HOLD_TIMEOUT + 'ms, not waiting for it any longer');
+  }
+  // Gone without handing over, it sent none of the held commands on
+  var commands = held.filter(function (command) {
+    return since === null || command.time >= since;
+  });
+  console.log('Handed over, sending ' + commands.length + ' of ' +
+              held.length + ' held commands');
+  previous = null;
+  held = [];
+  commands.forEach(function (command) {
+    sendHTTPCommand(command.path);
+  });
+}
+waitForHandover();
+
 // Add a connect listener
 socket.on('connect', function (socket) {
     console.log('Connected!');
+    // Let pm2 stop the old process on reload, see wait_ready in ecosystem.json
+    if (!ready && process.send) {
+      ready = true;
+      process.send('ready');
+    }
 });
 
+// pm2 sends SIGINT to the old process once the new one is ready. Stop
+// taking commands and exit once the ones in flight have been sent on,
+// pm2 kills the process after kill_timeout if they never finish.
+process.on('SIGINT', function () {
+  console.log('Draining ' + inflight + ' commands');
+  stopping = true;
+  socket.close();
+  try {
+    fs.writeFileSync(handoverFile, token + ' ' + Date.now());
+  } catch (e) {
+    console.log('Could not write the handover: ' + e.message);
+  }
+  exitWhenDrained();
+});
+
+function exitWhenDrained() {
+  if (stopping && inflight === 0) {
+    process.exit(0);
+  }
+}
+
 socket.on('sonos:play', function (data) {
   console.log(data);
   //we now have a room target
   var path = '/'+escape(data.room)+'/spotify/now/spotify:album:'+data.id;
-  sendHTTPCommand(path);
+  relay(path);
 });
 
 socket.on('sonos:pause', function (data) {
   var path = '/'+escape(data.room)+'/pause';
-  sendHTTPCommand(path);
+  relay(path);
 });
 
 socket.on('sonos:unpause', function (data) {
   var path = '/'+escape(data.room)+'/play';
-  sendHTTPCommand(path);
+  relay(path);
 });
 
+// Send a command on, or hold it while the previous process still might
+function relay(path) {
+  if (previous !== null) {
+    held.push({path: path, time: Date.now()});
+  } else {
+    sendHTTPCommand(path);
+  }
+}
+
 function sendHTTPCommand(path) {
   var options = {
     host: config.get('Sonos.host'),
@@ -36,11 +163,23 @@ function sendHTTPCommand(path) {
     path: path
   };
 
+  var finished = false;
+  function done() {
+    if (!finished) {
+      finished = true;
+      inflight--;
+      exitWhenDrained();
+    }
+  }
+
+  inflight++;
   http.get(options, function(resp){
     resp.on('data', function(chunk){
       //do something with chunk
     });
+    resp.on('end', done);
   }).on("error", function(e){
     console.log("Got error: " + e.message);
+    done();
   });
 }
@@ -0,0 +1,259 @@
+"""
+.. module:: answers
+   :synopsis: Answers to the questions tasks would otherwise prompt for.
+
+Every question a task can ask is listed in ``QUESTIONS``. An answer is
+looked up, in order, in:
+
+- the answers already given during the run,
+- ``env.answers_file``, a YAML or JSON mapping of question to answer,
+  answers for a single target can be nested under the target name,
+- ``VELCRO_ANSWER_<TARGET>_<QUESTION>`` and ``VELCRO_ANSWER_<QUESTION>``
+  environment variables,
+
+and only then prompted for, unless ``env.abort_on_prompts`` is set. Tasks
+collect all the answers they need before doing any remote work, so nothing
+stops for a prompt once hosts are being worked on in parallel.
+
+Every answer is recorded in ``settings.ANSWERS_LOG()`` along with where it
+came from, secret answers are masked.
+
+"""
+
+import datetime
+import json
+import os
+
+from fabric.api import prompt
+from fabric.colors import blue, yellow
+from fabric.state import env
+from fabric.utils import puts
+
+from . import FabricException
+
+
+YES = ('y', 'yes', 'true', '1')
+
+# Question, how it is asked and the kind of answer: 'text', 'yes' for a
+# boolean or 'secret' for text that is never logged
+QUESTIONS = {
+    'mysql_root_user': ('MySQL root user name', 'text'),
+    'mysql_root_pass': ('MySQL root user password (leave blank if none)',
+                        'secret'),
+    'mysql_create_database': ('Create a MySQL DB [Y/n]', 'yes'),
+    'mysql_database_name': ('Database name', 'text'),
+    'mysql_create_user': ('Create a database user [Y/n]', 'yes'),
+    'mysql_user_name': ('Database user name, at most 16 characters',
+                        'text'),
+    'mysql_user_pass': ('Database user password for the {target} '
+                        'environment', 'secret'),
+    'git_merge_to_master': ('[ROBO NAG] Merge the branch to master and push '
+                            'it [Y/n]', 'yes'),
+    'git_push_to_origin': ('[ROBO NAG] Push master to origin [Y/n]', 'yes'),
+}
+
+_files = {}
+
+
+def _target():
+    """ The current target, or None before one is set.
+    """
+
+    return env.get('target')
+
+
+def _load(path):
+    """ Read an answers file, once per process.
+
+    :param path: The answers file path.
+    :type path: str
+
+    :returns: dict -- The answers.
+    """
+
+    from utils import _load_yaml
+
+    path = os.path.expanduser(path)
+    if path not in _files:
+        if not os.path.isfile(path):
+            raise FabricException('Answers file not found: {0}'.format(path))
+        if path.endswith('.json'):
+            with open(path, 'r') as f:
+                _files[path] = json.load(f)
+        else:
+            _files[path] = _load_yaml(path)
+    return _files[path]
+
+
+def _lookup(key):
+    """ Find an answer that was given without prompting.
+
+    :param key: The question.
+    :type key: str
+
+    :returns: tuple -- The answer and where it came from, or None twice.
+    """
+
+    from conf import settings
+
+    target = _target()
+    path = settings.ANSWERS_FILE()
+    if path:
+        answers = _load(path)
+        scoped = answers.get(target)
+        if isinstance(scoped, dict) and key in scoped:
+            return scoped[key], path
+        if key in answers:
+            return answers[key], path
+
+    names = ['VELCRO_ANSWER_{0}'.format(key.upper())]
+    if target:
+        names.insert(0, 'VELCRO_ANSWER_{0}_{1}'.format(target.upper(),
+                                                       key.upper()))
+    for name in names:
+        if name in os.environ:
+            return os.environ[name], name
+
+    return None, None
+
+
+def _normalize(key, value):
+    """ Turn an answer into the type its question expects.
+    """
+
+    if QUESTIONS[key][1] == 'yes':
+        return str(value).strip().lower() in YES
+    if value is None:
+        return ''
+    return value if isinstance(value, basestring) else str(value)
+
+
+def _audit(key, value, source):
+    """ Append an answer to ``settings.ANSWERS_LOG()``.
+    """
+
+    from conf import settings
+
+    path = settings.ANSWERS_LOG()
+    if not path:
+        return
+
+    record = {
+        'time': datetime.datetime.now().isoformat(),
+        'user': env.get('local_user'),
+        'target': _target(),
+        'command': env.get('command'),
+        'question': key,
+        'answer': '***' if QUESTIONS[key][1] == 'secret' and value
+                  else value,
+        'source': source}
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+    except (IOError, OSError):
+        pass
+
+
+def answer(key, validate=None):
+    """ Get the answer to a question, prompting for it only if it was not
+    given some other way.
+
+    :param key: The question, a key of ``QUESTIONS``.
+    :type key: str
+
+    :param validate: Checks the answer, returning it or raising an
+        exception saying what is wrong with it.
+    :type validate: callable
+
+    :returns: str or bool -- The answer, a bool for yes or no questions.
+    """
+
+    answers = env.setdefault('answers', {})
+    if (_target(), key) in answers:
+        return answers[(_target(), key)]
+
+    text, kind = QUESTIONS[key]
+    value, source = _lookup(key)
+
+    if source:
+        if validate:
+            try:
+                value = validate(value)
+            except Exception as e:
+                raise FabricException('Invalid answer to {0} from {1}: '
+                                      '{2}'.format(key, source, e))
+    elif env.get('abort_on_prompts'):
+        raise FabricException(
+            'No answer to {0}, set it in env.answers_file or '
+            'VELCRO_ANSWER_{1}'.format(key, key.upper()))
+    else:
+        source = 'prompt'
+        value = prompt(yellow('> {0}:'.format(text.format(
+            target=_target()))), validate=validate)
+
+    value = _normalize(key, value)
+    answers[(_target(), key)] = value
+    _audit(key, value, source)
+    return value
+
+
+def collect(keys, validators=None):
+    """ Get the answers to several questions at once, before any work that
+    depends on them starts.
+
+    :param keys: The questions, keys of ``QUESTIONS``.
+    :type keys: list
+
+    :param validators: Question to the callable checking its answer.
+    :type validators: dict
+
+    :returns: dict -- Question to its answer.
+    """
+
+    validators = validators or {}
+    return dict((key, answer(key, validators.get(key))) for key in keys)
+
+
+def questionnaire(questions=None, save=None):
+    """
+    Answer questions up front, so the tasks run after it in the same
+    ``fab`` run do not stop to ask them. The answers can also be saved to
+    a file to use as ``env.answers_file`` in later runs.
+
+    **Usage:**
+
+    .. code-block:: none
+
+        fab live questionnaire:mysql_root_user|mysql_root_pass deploy:master
+        fab live questionnaire:save=answers.json
+
+    :param questions: The questions to answer, ``|`` separated, defaults
+        to all of them.
+    :type questions: str
+
+    :param save: Path to write the answers given for the target to.
+    :type save: str
+
+    :returns: dict -- Question to its answer.
+    """
+
+    keys = questions.split('|') if questions else sorted(QUESTIONS)
+    unknown = [key for key in keys if key not in QUESTIONS]
+    if unknown:
+        raise FabricException('Unknown questions: {0}. Questions are {1}'
+                              .format(', '.join(unknown),
+                                      ', '.join(sorted(QUESTIONS))))
+
+    answers = collect(keys)
+
+    if save:
+        scoped = {_target(): answers} if _target() else answers
+        with open(os.path.expanduser(save), 'w') as f:
+            os.chmod(f.name, 0o600)
+            json.dump(scoped, f, indent=2, sort_keys=True)
+        puts(blue('[ANSWERS] Saved {0} answers to {1}'.format(
+            len(answers), save)))
+
+    return answers
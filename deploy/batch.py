@@ -0,0 +1,168 @@
+"""
+.. module:: batch
+   :synopsis: Run several remote commands in a single round trip.
+
+"""
+
+import time
+
+from fabric.api import run, sudo
+from fabric.context_managers import hide, settings
+from fabric.state import env, output
+from fabric.utils import error, puts
+
+import timing
+from utils import _check_sudo
+
+# Prefix of the lines the script reports each step on
+_MARKER = '@@velcro-step'
+
+# Shell function printing milliseconds since the epoch. BSD date has no %N
+# and prints it as is, there it falls back to whole seconds
+_CLOCK = ('__velcro_ms() { __t=$(date +%s%N); case $__t in *N) '
+          'echo $(( ${__t%N} * 1000 ));; *) echo $(( __t / 1000000 ));; '
+          'esac; }')
+
+
+class Batch(object):
+
+    """ A sequence of remote commands shipped to the host as one script.
+
+    Steps run in order, each in its own subshell, and the script stops at
+    the first step that fails, like ``set -e``. Every step reports its
+    exit code and duration back.
+
+    **Usage:**
+
+    .. code-block:: python:
+
+        batch = Batch()
+        batch.add('git clean -df', cwd=settings.SRC_PATH())
+        batch.add('git submodule update --init', cwd=settings.SRC_PATH())
+        results = batch.run()
+    """
+
+    def __init__(self, use_sudo=False):
+        """ Start an empty batch.
+
+        :param use_sudo: Run the whole script with sudo.
+        :type use_sudo: bool
+        """
+
+        self.use_sudo = use_sudo
+        self.steps = []
+
+    def __len__(self):
+        return len(self.steps)
+
+    def add(self, command, cwd=None):
+        """ Add a command to the batch.
+
+        :param command: The shell command.
+        :type command: str
+
+        :param cwd: Directory to run the command in.
+        :type cwd: str
+
+        :returns: Batch -- The batch, so calls can be chained.
+        """
+
+        self.steps.append({'command': command, 'cwd': cwd})
+        return self
+
+    def script(self):
+        """ Build the shell script for the batch.
+
+        :returns: str -- The script.
+        """
+
+        lines = [_CLOCK]
+        for i, step in enumerate(self.steps):
+            command = step['command']
+            if step['cwd']:
+                command = 'cd {0} && {1}'.format(step['cwd'], command)
+            lines.extend([
+                '__s=$(__velcro_ms)',
+                '( {0} )'.format(command),
+                '__rc=$?',
+                # On a line of its own, the step output may not end in one
+                'printf "\\n{0} {1} $__rc $(( $(__velcro_ms) - __s ))\\n"'
+                .format(_MARKER, i),
+                '[ $__rc -eq 0 ] || exit $__rc'])
+        return '\n'.join(lines)
+
+    def run(self):
+        """ Run the batch on the current host.
+
+        A failing step is reported the same way a failing ``run`` is,
+        aborting unless ``env.warn_only`` is set. A sudo batch raises a
+        FabricException when ``env.sudo_user`` is not set.
+
+        :returns: list -- One dict per step with the ``command``,
+            ``exit_code``, ``duration`` in seconds and ``stdout``. Steps
+            that did not run have an ``exit_code`` of None.
+        """
+
+        results = [{'command': step['command'], 'exit_code': None,
+                    'duration': 0.0, 'stdout': ''} for step in self.steps]
+        if not self.steps:
+            return results
+        if self.use_sudo:
+            _check_sudo(self.steps[-1]['command'])
+
+        show_stdout = output.stdout
+        if output.running:
+            for step in self.steps:
+                puts('{0}: {1}'.format('sudo' if self.use_sudo else 'run',
+                                       step['command']))
+
+        with timing.span('batch of {0}'.format(len(self)), 'batch'):
+            with settings(hide('stdout', 'running', 'warnings'),
+                          warn_only=True), timing.labelled('script'):
+                if self.use_sudo:
+                    result = sudo(self.script())
+                else:
+                    result = run(self.script())
+            finished = time.time()
+
+            lines = []
+            for line in result.splitlines() + [_MARKER]:
+                if not line.startswith(_MARKER):
+                    lines.append(line)
+                    continue
+                if line != _MARKER:
+                    # Drop the line break the marker was printed after
+                    if lines and not lines[-1]:
+                        lines.pop()
+                    i, exit_code, duration = line.split()[1:4]
+                    results[int(i)]['exit_code'] = int(exit_code)
+                    results[int(i)]['duration'] = int(duration) / 1000.0
+                    results[int(i)]['stdout'] = '\n'.join(lines)
+                if show_stdout:
+                    for out in lines:
+                        puts('out: {0}'.format(out))
+                lines = []
+
+            # The steps ran back to back until the script finished
+            start = finished - sum(step['duration'] for step in results)
+            for step in results:
+                if step['exit_code'] is not None:
+                    timing.add(step['command'], 'step', step['duration'],
+                               start=start, exit_code=step['exit_code'],
+                               status='failed' if step['exit_code'] else 'ok')
+                    start += step['duration']
+
+        for step in results:
+            if step['exit_code']:
+                error('{0}() received nonzero return code {1} while '
+                      'executing!\n\nRequested: {2}'.format(
+                          'sudo' if self.use_sudo else 'run',
+                          step['exit_code'], step['command']),
+                      stderr=getattr(result, 'stderr', None))
+                break
+        else:
+            if result.failed:
+                error('Batch failed with return code {0} on {1}'.format(
+                    result.return_code, env.host_string))
+
+        return results
@@ -0,0 +1,107 @@
+"""
+.. module:: changes
+   :synopsis: Reload only the services a deploy changed files for.
+
+"""
+
+import fnmatch
+
+from fabric.api import local
+from fabric.colors import blue, yellow
+from fabric.context_managers import hide, settings as fab_settings
+from fabric.state import env
+from fabric.utils import puts
+
+from hooks import _call_hooks
+
+# Changed files between two commits, computed once per pair
+_diffs = {}
+
+
+def _changed_files(old, new):
+    """ Get the files changed between two commits from the local
+    repository.
+
+    :param old: The commit the host was at.
+    :type old: str
+
+    :param new: The commit deployed.
+    :type new: str
+
+    :returns: list -- The changed paths, None when they can not be told.
+    """
+
+    if not old or not new:
+        return None
+
+    if (old, new) not in _diffs:
+        with fab_settings(hide('everything'), warn_only=True):
+            diff = local('git diff --name-only {0} {1}'.format(old, new),
+                         capture=True)
+        _diffs[(old, new)] = diff.splitlines() if diff.succeeded else None
+    return _diffs[(old, new)]
+
+
+def _actions(files, rules):
+    """ Get the hooks the changed files call for.
+
+    :param files: The changed paths, None to take every action.
+    :type files: list
+
+    :param rules: Pairs of file patterns and the hook to run when any file
+        matching them changed.
+    :type rules: list
+
+    :returns: list -- The hooks to run, in rule order.
+    """
+
+    actions = []
+    for patterns, hook in rules:
+        if hook in actions:
+            continue
+        if files is None or any(fnmatch.fnmatch(path, pattern)
+                                for path in files for pattern in patterns):
+            actions.append(hook)
+    return actions
+
+
+def reload_changed():
+    """
+    Reload the services whose files changed in the deploy, and nothing
+    else. Which files call for which reload is set by
+    ``env.reload_rules``, a list of file patterns and a hook:
+
+    .. code-block:: python:
+
+        env.reload_rules = [
+            (['*nginx*.conf'], 'deploy.http.nginx.sync_nginx'),
+            (['client.js', 'config/*.json'], 'deploy.process.pm2.reload_pm2'),
+        ]
+
+    When the commit the host was at is not known every reload runs.
+
+    **Usage:**
+
+    Add to the deploy as a post hook:
+
+    .. code-block:: none
+
+        fab live deploy:master,post=deploy.changes.reload_changed
+    """
+
+    from conf import settings
+
+    old, new = env.get('deploy_range') or (None, None)
+    files = _changed_files(old, new)
+    if files is None:
+        puts(yellow('[CHANGES] Previous commit not known, reloading all'))
+    else:
+        puts(blue('[CHANGES] {0} files changed in {1}..{2}'.format(
+            len(files), old[:7], new[:7])))
+
+    actions = _actions(files, settings.RELOAD_RULES())
+    if not actions:
+        puts(blue('[CHANGES] Nothing to reload'))
+        return
+
+    _call_hooks(actions)
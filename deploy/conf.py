@@ -4,16 +4,47 @@
 
 """
 
+import copy
 import os
+import threading
 
 from fabric.state import env
 from . import FabricException
-from db.mysql import get_root_user, get_root_pass
 from utils import _raise
 
 from utils import get_local_config
 
 
+# Marks a dependency on an env key that was not set
+_MISSING = object()
+
+# Dependency of a setting built by calling a callable set on env, which
+# can read anything, so the setting is never cached
+_VOLATILE = object()
+
+# Stands in for a copy of a value that could not be copied, never equal
+# to the value so it is always rebuilt
+_UNCOPIED = object()
+
+
+def _snapshot(value):
+    """ Copy of an ``env`` value to tell later whether it was changed in
+    place.
+
+    :param value: The value.
+
+    :returns: A deep copy of dicts, lists and sets, the value itself
+        otherwise.
+    """
+
+    if not isinstance(value, (dict, list, set)):
+        return value
+    try:
+        return copy.deepcopy(value)
+    except Exception:
+        return _UNCOPIED
+
+
 class Config(object):
 
     """ velcro configuration class, for easy reference to settings defined
@@ -23,12 +54,25 @@ class Config(object):
        Do not call this directly, use:
        conf import settings
        settings.IS_STATIC().
+
+    Setting values are cached along with the ``env`` keys they were built
+    from, including those read by any settings they depend on. A cached
+    value is used until one of those keys is replaced on ``env`` or, for
+    dicts, lists and sets, changed in place, so setting ``env.base_path``
+    rebuilds ``SRC_PATH`` and ``CONFIG_PATH`` but not ``PROJECT``. A
+    callable set on ``env``, like ``env.project_db_pass = lambda: ...``,
+    can read anything, so it is called again every time, and the settings
+    built from it are never cached either.
     """
 
     def __init__(self, *args, **kwargs):
         """ Sets up setting attributes.
         """
 
+        self._cache = {}
+        self._local = threading.local()
+        self.stats = {'hits': 0, 'misses': 0}
+
         # Get any config vars that are in the local ~/.velcro.yml file
         # and set them on the env object
         get_local_config()
@@ -51,7 +95,8 @@ class Config(object):
         self.BASE_PATH = self._env_config(
             'base_path', lambda: _raise(FabricException(
                 'Missing Base Path, have you set a target?')))
-        self.SRC_PATH = lambda: os.path.join(self.BASE_PATH(), 'src')
+        self.SRC_PATH = self._derived(
+            'src_path', lambda: os.path.join(self.BASE_PATH(), 'src'))
         self.LOCAL_PATH = self._env_config(
             'local_path', lambda: _raise(FabricException(
                 'env.local_path is required.')))
@@ -63,19 +108,22 @@ class Config(object):
                                              '{target}'])
         self.CONFIG_PATH = self._env_config(
             'config_path', lambda: os.path.join(*self._build_config_path()))
-        self.LOCAL_CONFIG_PATH = lambda: os.path.join(
-            *self._build_config_path(local=True))
+        self.LOCAL_CONFIG_PATH = self._derived(
+            'local_config_path', lambda: os.path.join(
+                *self._build_config_path(local=True)))
         self.HTTP_SERVER_CONF_PATH = self._env_config(
             'http_server_conf_path', lambda: _raise(FabricException(
                 'env.http_server_conf_path is required.')))
 
         # Logs
-        self.DEPLOY_LOG = lambda: os.path.join(self.LOG_PATH(), 'deploy.log')
-        self.ROLLBACK_LOG = lambda: os.path.join(self.LOG_PATH(),
-                                                 'rollback.log')
+        self.DEPLOY_LOG = self._derived(
+            'deploy_log', lambda: os.path.join(self.LOG_PATH(), 'deploy.log'))
+        self.ROLLBACK_LOG = self._derived(
+            'rollback_log', lambda: os.path.join(self.LOG_PATH(),
+                                                 'rollback.log'))
 
         # Project Details
-        self.CLIENT = self._env_config('client', lambda: env.user)
+        self.CLIENT = self._env_config('client', lambda: self._env('user'))
         self.PROJECT = self._env_config(
             'project', lambda: _raise(FabricException('Missing Project Name')))
         self.PACKAGE_NAME = self._env_config('package_name',
@@ -93,6 +141,66 @@ class Config(object):
         self.SCM = self._env_config(
             'scm', lambda: _raise(FabricException('env.scm is required')))
 
+        # Parallel deploys
+        self.DEPLOY_POOL_SIZE = self._env_config('deploy_pool_size', 5)
+        self.DEPLOY_HOST_TIMEOUT = self._env_config('deploy_host_timeout', 600)
+        self.DEPLOY_MAX_FAILURES = self._env_config('deploy_max_failures', 0)
+
+        # Releases, the apps run from CURRENT_PATH, set env.use_releases to
+        # False to run them from SRC_PATH updated in place instead
+        self.USE_RELEASES = self._env_config('use_releases', True)
+        self.RELEASES_PATH = self._env_config(
+            'releases_path', lambda: os.path.join(self.BASE_PATH(),
+                                                  'releases'))
+        self.CURRENT_PATH = self._env_config(
+            'current_path', lambda: os.path.join(self.BASE_PATH(), 'current'))
+        self.KEEP_RELEASES = self._env_config('keep_releases', 5)
+
+        # Dependencies, kept between releases while the manifests match
+        self.DEPENDENCY_MANIFESTS = self._env_config(
+            'dependency_manifests', ['package.json', 'npm-shrinkwrap.json'])
+        self.DEPENDENCY_DIRS = self._env_config('dependency_dirs',
+                                                ['node_modules'])
+        self.DEPENDENCY_CACHE_PATH = self._env_config(
+            'dependency_cache_path', lambda: os.path.join(
+                self.BASE_PATH(), 'cache', 'deps'))
+        self.NPM_INSTALL = self._env_config('npm_install', 'npm install')
+
+        # Code transfer, 'push' or 'bundle'
+        self.DEPLOY_TRANSFER = self._env_config('deploy_transfer', 'push')
+        self.BUNDLE_FANOUT = self._env_config('bundle_fanout', 'host')
+        self.BUNDLE_CACHE_DIR = self._env_config(
+            'bundle_cache_dir', lambda: os.path.join(
+                os.path.expanduser('~'), '.velcro', 'bundles',
+                self.PROJECT()))
+        self.BUNDLE_PATH = self._env_config(
+            'bundle_path', lambda: os.path.join(self.BASE_PATH(), 'bundles'))
+
+        # Timing, see deploy.timing, set with fab --set timing
+        self.TIMING = self._env_config('timing', False)
+
+        # SSH
+        self.SSH_CONTROL_PERSIST = self._env_config('ssh_control_persist', 60)
+        self.SSH_REPORT = self._env_config('ssh_report',
+                                           lambda: self.TIMING())
+
+        # Hooks
+        self.HOOK_CONCURRENCY = self._env_config('hook_concurrency', 1)
+
+        # Answers, see deploy.answers
+        self.ANSWERS_FILE = self._env_config('answers_file', None)
+        self.ANSWERS_LOG = self._env_config(
+            'answers_log', lambda: os.path.join(
+                os.path.expanduser('~'), '.velcro', 'answers.log'))
+
+        # Rolling deploys
+        self.ROLLING_BATCH = self._env_config('rolling_batch', '25%')
+        self.ROLLING_MAX_ERROR_RATE = self._env_config(
+            'rolling_max_error_rate', 0)
+        self.ROLLING_MAX_LATENCY = self._env_config('rolling_max_latency', 30)
+        self.ROLLING_HEALTH_CHECK = self._env_config(
+            'rolling_health_check', 'deploy.process.pm2.health_check')
+
         # Python
         self.PY_VENV_BASE = self._env_config(
             'py_venv_base', lambda: _raise(FabricException(
@@ -115,19 +223,37 @@ class Config(object):
 
         # MySQL
         self.MYSQL_ROOT_USER = self._env_config(
-            'mysql_root_user', lambda: get_root_user())
+            'mysql_root_user', lambda: _get_root_user())
         self.MYSQL_ROOT_PASS = self._env_config(
-            'mysql_root_pass', lambda: get_root_pass())
+            'mysql_root_pass', lambda: _get_root_pass())
 
         # For creating project DB
         self.PROJECT_DB_HOST = self._env_config('project_db_host', None)
         self.PROJECT_DB_USER = self._env_config('project_db_user',
-                lambda: '{0}_{1}'.format(env.project[0:10], env.target))
+                lambda: '{0}_{1}'.format(self._env('project')[0:10],
+                                         self._env('target')))
         self.PROJECT_DB_NAME = self._env_config('project_db_name',
-                lambda: '{0}_{1}'.format(env.project[0:10], env.target))
+                lambda: '{0}_{1}'.format(self._env('project')[0:10],
+                                         self._env('target')))
 
         self.PROJECT_DB_PASS = self._env_config('project_db_pass', None)
 
+        # Databases, users and grants, see deploy.db.mysql._spec
+        self.MYSQL_SPEC = self._env_config('mysql_spec', None)
+        self.MYSQL_HOSTS = self._env_config(
+            'mysql_hosts',
+            lambda: self._env('all_hosts') or self._env('hosts'))
+
+        # Snapshots, see deploy.db.mysql.snapshot
+        self.MYSQL_SNAPSHOT_JOBS = self._env_config('mysql_snapshot_jobs', 4)
+        self.MYSQL_SNAPSHOT_DIR = self._env_config(
+            'mysql_snapshot_dir', lambda: os.path.join(
+                os.path.expanduser('~'), '.velcro', 'snapshots',
+                self.PROJECT(), self.TARGET(), self.HOST()))
+        self.MYSQL_BACKUP_PATH = self._env_config(
+            'mysql_backup_path', lambda: os.path.join(
+                self.BASE_PATH(), 'backups', 'mysql'))
+
         # Upstart Service
         self.UPSTART_SCRIPTS = self._env_config(
             'upstart_scripts', lambda: _raise(FabricException(
@@ -149,9 +275,30 @@ class Config(object):
                 'env.nginx_conf is required.')))
         self.NGINX_SYMLINK_SUDO = self._env_config(
             'nginx_symlink_sudo', lambda: False)
+        self.NGINX_TEST = self._env_config('nginx_test', 'nginx -t')
+        self.NGINX_RELOAD = self._env_config('nginx_reload',
+                                             'service nginx reload')
+        self.NGINX_STATE_PATH = self._env_config(
+            'nginx_state_path', lambda: os.path.join(self.BASE_PATH(),
+                                                     'nginx'))
+
+        # pm2
+        self.PM2_ECOSYSTEM = self._env_config(
+            'pm2_ecosystem', lambda: os.path.join(
+                self.CONFIG_DIR(), self.TARGET(), 'ecosystem.json'))
+        self.PM2_HEALTH_TIMEOUT = self._env_config('pm2_health_timeout', 60)
+        self.PM2_MIN_UPTIME = self._env_config('pm2_min_uptime', 5)
+        self.PM2_MAX_UNAVAILABLE = self._env_config('pm2_max_unavailable', 1)
+
+        # Reloads
+        self.RELOAD_RULES = self._env_config('reload_rules', [
+            (['*nginx*.conf'], 'deploy.http.nginx.sync_nginx'),
+            (['client.js', 'package.json', 'config/*.json'],
+             'deploy.process.pm2.reload_pm2')])
 
         # Users
-        self.SUDO_USER = self._env_config('sudo_user', lambda: env.user)
+        self.SUDO_USER = self._env_config('sudo_user',
+                                          lambda: self._env('user'))
         self.USER = self._env_config(
             'user', lambda: _raise(FabricException(
                 'env.nginx_conf is required.')))
@@ -173,9 +320,11 @@ class Config(object):
         :returns: callable -- The setting.
         """
 
-        def inner():
+        def compute():
             setting = getattr(env, name, default)
             if callable(setting):
+                if setting is not default:
+                    self._depends(_VOLATILE)
                 try:
                     return setting()
                 except AttributeError:
@@ -183,8 +332,103 @@ class Config(object):
             else:
                 return setting
 
+        def inner():
+            self._depends(name)
+            return compute()
+
+        return self._derived(name, inner)
+
+    def _derived(self, name, compute):
+        """ Memoize a setting, recording the ``env`` keys it depends on.
+
+        :param name: The cache key, the setting name.
+        :type name: str.
+
+        :param compute: Builds the setting value.
+        :type compute: callable.
+
+        :returns: callable -- The cached setting.
+        """
+
+        def inner():
+            cached = self._cache.get(name)
+            if cached is not None and self._fresh(cached[1]):
+                self.stats['hits'] += 1
+                self._merge(cached[1])
+                return cached[0]
+
+            self.stats['misses'] += 1
+            stack = self._stack()
+            stack.append({})
+            try:
+                value = compute()
+            finally:
+                deps = stack.pop()
+                self._merge(deps)
+            self._cache[name] = (value, deps)
+            return value
+
         return inner
 
+    def _stack(self):
+        """ Dependency sets of the settings being built on this thread.
+        """
+
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _depends(self, key):
+        """ Record that the setting being built reads ``env.<key>``.
+        """
+
+        stack = self._stack()
+        if stack:
+            value = env.get(key, _MISSING)
+            stack[-1][key] = (value, _snapshot(value))
+
+    def _merge(self, deps):
+        """ Add a settings dependencies to the setting that used it.
+        """
+
+        stack = self._stack()
+        if stack:
+            stack[-1].update(deps)
+
+    def _fresh(self, deps):
+        """ Check none of the ``env`` keys a value was built from changed.
+        """
+
+        if _VOLATILE in deps:
+            return False
+        for key, (value, snapshot) in deps.iteritems():
+            current = env.get(key, _MISSING)
+            if current is not value or current != snapshot:
+                return False
+        return True
+
+    def _env(self, name):
+        """ Read ``env.<name>`` from a default, recording the dependency.
+
+        :param name: The env attribute name.
+        :type name: str.
+
+        :returns: The env value, raises AttributeError if not set.
+        """
+
+        self._depends(name)
+        return getattr(env, name)
+
+    def cache_stats(self):
+        """ Get the settings cache counters.
+
+        :returns: dict -- ``hits``, ``misses`` and ``size``.
+        """
+
+        stats = dict(self.stats)
+        stats['size'] = len(self._cache)
+        return stats
+
     def _build_config_path(self, local=False):
         """
         Build the config path from the list pipeline.
@@ -222,4 +466,39 @@ class Config(object):
         return dirs
 
 
-settings = Config()
+def _get_root_user():
+    """ Get the MySQL root user, importing the MySQL helpers only
+    when they are needed.
+    """
+
+    from db.mysql import get_root_user
+    return get_root_user()
+
+
+def _get_root_pass():
+    """ Get the MySQL root password, importing the MySQL helpers
+    only when they are needed.
+    """
+
+    from db.mysql import get_root_pass
+    return get_root_pass()
+
+
+class LazyConfig(object):
+
+    """ Builds the ``Config`` on first use.
+
+    Constructing the config reads ``~/.velcro.yml``, deferring it keeps
+    importing the fabfile and listing tasks cheap.
+    """
+
+    def __init__(self):
+        self._config = None
+
+    def __getattr__(self, name):
+        if self._config is None:
+            self._config = Config()
+        return getattr(self._config, name)
+
+
+settings = LazyConfig()
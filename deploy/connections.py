@@ -0,0 +1,158 @@
+"""
+.. module:: connections
+   :synopsis: SSH connection reuse and accounting.
+
+Fabric keeps one connection per host for the whole run and opens a channel
+on it for every ``run``, ``sudo`` and ``exists``. Commands run locally over
+ssh, like ``git push``, go through an OpenSSH control master per host
+instead, so they stop paying for a handshake each time too.
+
+"""
+
+import atexit
+import os
+import subprocess
+import time
+
+from fabric import network, operations
+from fabric.state import env
+
+from utils import _print_table
+
+
+_stats = {}
+_masters = set()
+
+
+def _task_stats():
+    """ Get the counters for the task currently running.
+
+    :returns: dict -- The task counters.
+    """
+
+    return _stats.setdefault(env.get('command') or '-', {
+        'handshakes': 0,
+        'handshake_time': 0.0,
+        'channels': 0,
+        'ssh_masters': 0,
+        'ssh_reused': 0})
+
+
+def control_path():
+    """ OpenSSH control socket path, one per user, host and port.
+
+    :returns: str -- The ``ControlPath`` pattern.
+    """
+
+    return os.path.join(os.path.expanduser('~'), '.velcro', 'cm-%r@%h:%p')
+
+
+def ssh_command():
+    """ The ssh command that shares the control master of the host.
+
+    Use it as ``GIT_SSH_COMMAND`` so git transports go over the master
+    connection.
+
+    :returns: str -- The ssh command.
+    """
+
+    from conf import settings
+
+    return 'ssh -o ControlMaster=auto -o ControlPath={0} '\
+           '-o ControlPersist={1}'.format(control_path(),
+                                          settings.SSH_CONTROL_PERSIST())
+
+
+def ssh_master(user, host):
+    """ Note that a local ssh command is about to run against a host,
+    recording whether it reuses the control master or starts one.
+
+    :param user: The remote user.
+    :type user: str
+
+    :param host: The remote host.
+    :type host: str
+    """
+
+    stats = _task_stats()
+    target = '{0}@{1}'.format(user, host)
+
+    with open(os.devnull, 'w') as devnull:
+        running = subprocess.call(
+            ['ssh', '-o', 'ControlPath={0}'.format(control_path()), '-O',
+             'check', target], stdout=devnull, stderr=devnull) == 0
+
+    if running:
+        stats['ssh_reused'] += 1
+    else:
+        stats['ssh_masters'] += 1
+        if not os.path.isdir(os.path.dirname(control_path())):
+            os.makedirs(os.path.dirname(control_path()))
+    _masters.add(target)
+
+
+def _close_masters():
+    """ Stop the control masters started during the run.
+    """
+
+    with open(os.devnull, 'w') as devnull:
+        for target in _masters:
+            subprocess.call(
+                ['ssh', '-o', 'ControlPath={0}'.format(control_path()), '-O',
+                 'exit', target], stdout=devnull, stderr=devnull)
+
+
+def report():
+    """ Print handshakes and channels per task, with an estimate of the time
+    saved by reusing connections instead of connecting for every command.
+    """
+
+    if not _stats:
+        return
+
+    handshakes = sum(s['handshakes'] for s in _stats.values())
+    handshake_time = sum(s['handshake_time'] for s in _stats.values())
+    average = handshake_time / handshakes if handshakes else 0.0
+
+    rows = []
+    for task, s in sorted(_stats.items()):
+        reused = max(s['channels'] - s['handshakes'], 0) + s['ssh_reused']
+        rows.append([task, s['handshakes'] + s['ssh_masters'], s['channels'],
+                     reused, '{0:.1f}s'.format(reused * average)])
+
+    _print_table(['Task', 'Handshakes', 'Channels', 'Reused', 'Saved'], rows)
+
+
+def install():
+    """ Start counting handshakes and channels, and report them at the end
+    of the run. Safe to call more than once.
+    """
+
+    from conf import settings
+
+    if getattr(network.connect, '_velcro', False):
+        return
+
+    connect = network.connect
+    default_channel = operations.default_channel
+
+    def counting_connect(*args, **kwargs):
+        started = time.time()
+        try:
+            return connect(*args, **kwargs)
+        finally:
+            stats = _task_stats()
+            stats['handshakes'] += 1
+            stats['handshake_time'] += time.time() - started
+
+    def counting_channel():
+        _task_stats()['channels'] += 1
+        return default_channel()
+
+    counting_connect._velcro = True
+    network.connect = counting_connect
+    operations.default_channel = counting_channel
+
+    atexit.register(_close_masters)
+    if settings.SSH_REPORT():
+        atexit.register(report)
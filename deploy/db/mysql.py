@@ -4,110 +4,1012 @@
 
 """
 
+import os
+import pipes
+import Queue
 import re
-
-from fabric.api import run, prompt
-from fabric.colors import blue, yellow, red
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from fabric.api import put, run
+from fabric.colors import blue, green, yellow
+from fabric.context_managers import hide, prefix, settings as fab_settings
+from fabric.decorators import runs_once
+from fabric.network import to_dict
 from fabric.state import env
 from fabric.utils import puts
+from deploy import FabricException, timing
+from deploy.answers import answer
+from deploy.batch import _CLOCK
 from deploy.decorators import pre_hooks, post_hooks
+from deploy.utils import _bool, _print_error, _print_table
+
+
+# Reads the root password from the first line of the input into
+# MYSQL_PWD, see _secret
+_READ_PASSWORD = 'IFS= read -r p; [ -z "$p" ] || export MYSQL_PWD="$p"; '
+
+# Marks the line each table job of ``_on_host`` reports on
+_REPORT = '@@velcro-table'
+
+# Runs a step for each table, several at once, on the host. The step gets
+# the database and table as $2 and $3 and prints the bytes it moved last
+_TABLE_JOBS = r'''{clock}
+job() {{
+  s=$(__velcro_ms)
+  if out=$( ( set -o pipefail; {step} ) 2>&1 ); then
+    echo "{marker} $1 ok $(( $(__velcro_ms) - s )) $(( ${{out##*[!0-9]}} + 0 ))"
+  else
+    echo "{marker} $1 failed $(echo $out | head -c 500)"
+  fi
+}}
+export -f __velcro_ms job
+printf '%s\0' {items} | xargs -0 -n 3 -P {jobs} bash -c 'job "$@"' job'''
 
 
 def get_root_user():
-    """ Get database root user name.
+    """ Get database root user name, see ``deploy.answers``.
     """
 
-    if not env.mysql_root_user:
-        env.mysql_root_user = prompt(yellow(
-            '> [MySQL]: Please enter root user name:'))
+    if not env.get('mysql_root_user'):
+        env.mysql_root_user = answer('mysql_root_user')
 
     return env.mysql_root_user
 
 
 def get_root_pass():
-    """ Get database root user pass.
+    """ Get database root user pass, see ``deploy.answers``.
     """
 
-    if not env.mysql_root_pass:
-        env.mysql_root_pass = prompt(yellow(
-            '> [MySQL]: Please enter root user password (leave blank if none):'))
+    if not env.get('mysql_root_pass'):
+        env.mysql_root_pass = answer('mysql_root_pass')
 
     return env.mysql_root_pass
 
 
+# Privileges GRANT ALL PRIVILEGES gives on a database
+ALL_PRIVILEGES = frozenset([
+    'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'CREATE', 'DROP', 'REFERENCES',
+    'INDEX', 'ALTER', 'CREATE TEMPORARY TABLES', 'LOCK TABLES', 'EXECUTE',
+    'CREATE VIEW', 'SHOW VIEW', 'CREATE ROUTINE', 'ALTER ROUTINE', 'EVENT',
+    'TRIGGER'])
+
+# The keys of a spec, see _spec
+SPEC_KEYS = frozenset(['databases', 'users', 'grants'])
+
+# Databases, users and database grants on the server, in one query
+STATE_QUERY = """
+SELECT 'database', SCHEMA_NAME, DEFAULT_CHARACTER_SET_NAME,
+       DEFAULT_COLLATION_NAME FROM information_schema.SCHEMATA
+UNION ALL SELECT 'user', User, Host, '' FROM mysql.user
+UNION ALL SELECT 'grant', GRANTEE, TABLE_SCHEMA, PRIVILEGE_TYPE
+          FROM information_schema.SCHEMA_PRIVILEGES;
+"""
+
+
+def _quote_name(name):
+    """ Quote a database name for SQL.
+    """
+
+    return '`{0}`'.format(name.replace('`', '``'))
+
+
+def _quote(value):
+    """ Quote a string for SQL.
+    """
+
+    return "'{0}'".format(value.replace('\\', '\\\\').replace("'", "\\'"))
+
+
+def _client_args():
+    """ Options logging the mysql client tools in as the root user. The
+    password is not one of them, see ``_login``.
+
+    :returns: str -- The options.
+    """
+
+    from deploy.conf import settings
+
+    args = ' -u {0}'.format(settings.MYSQL_ROOT_USER())
+
+    if settings.PROJECT_DB_HOST():
+        args += ' --host {0}'.format(settings.PROJECT_DB_HOST())
+
+    return args
+
+
+def _client():
+    """ The mysql client command, logged in as the root user.
+
+    :returns: str -- The command.
+    """
+
+    return 'mysql' + _client_args()
+
+
+def _secret(content):
+    """ Write secrets to a file on the current host only its user can read,
+    so they are never in a command line, where any user on the host can
+    see them.
+
+    :param content: The secrets.
+    :type content: str
+
+    :returns: str -- The remote path, to remove once read.
+    """
+
+    with fab_settings(hide('everything'), warn_only=True):
+        # Created readable by its owner only
+        path = run('mktemp')
+        if path.failed:
+            raise FabricException('Could not create a file on the host: '
+                                  '{0}'.format(path.strip()))
+
+        handle, local_path = tempfile.mkstemp()
+        try:
+            with os.fdopen(handle, 'w') as f:
+                f.write(content)
+            put(local_path, path.strip())
+        finally:
+            os.remove(local_path)
+
+    return path.strip()
+
+
+@contextmanager
+def _login():
+    """ Pass the root password to the mysql client tools run on the host in
+    the block through ``MYSQL_PWD``, read from a file, see ``_secret``, and
+    name the spans of the commands ``mysql``, see ``deploy.timing``.
+    """
+
+    from deploy.conf import settings
+
+    with timing.labelled('mysql'):
+        path = _secret((settings.MYSQL_ROOT_PASS() or '') + '\n')
+        try:
+            with prefix('{{ {0}}} < {1}'.format(_READ_PASSWORD, path)):
+                yield
+        finally:
+            with fab_settings(hide('everything'), warn_only=True):
+                run('rm -f {0}'.format(path))
+
+
+def _session(client, sql):
+    """ Run SQL in a single client session on the current host. The
+    statements can hold passwords, they are sent in a file after the root
+    password, see ``_secret``.
+
+    :param client: The mysql client command.
+    :type client: str
+
+    :param sql: The statements.
+    :type sql: str
+
+    :returns: str -- The rows returned, tab separated.
+    """
+
+    from deploy.conf import settings
+
+    with timing.labelled('mysql'):
+        path = _secret('{0}\n{1}\n'.format(settings.MYSQL_ROOT_PASS() or '',
+                                           sql.strip()))
+        with fab_settings(hide('running', 'stdout'), warn_only=True):
+            result = run('{{ {0}{1} --batch --skip-column-names; }} < {2}; '
+                         'r=$?; rm -f {2}; exit $r'.format(
+                             _READ_PASSWORD, client, path))
+
+    if result.failed:
+        raise FabricException('MySQL failed: {0}'.format(result.strip()))
+    return result
+
+
+def _default_spec():
+    """ Build the spec of the project database and user from
+    ``PROJECT_DB_NAME``, ``PROJECT_DB_USER`` and ``PROJECT_DB_PASS``,
+    asking for anything they do not give, see ``deploy.answers``.
+
+    :returns: dict -- The spec, None when no database should be created.
+    """
+
+    from deploy.conf import settings
+
+    if not answer('mysql_create_database'):
+        return None
+
+    db_name = settings.PROJECT_DB_NAME() or re.sub(
+        r'[\W]+', '', answer('mysql_database_name'), flags=re.UNICODE)
+    spec = {'databases': [db_name], 'users': [], 'grants': []}
+
+    if answer('mysql_create_user'):
+        username = settings.PROJECT_DB_USER()
+        if not username or not validate_db_username(username):
+            username = answer('mysql_user_name', _valid_username)
+
+        try:
+            password = settings.PROJECT_DB_PASS().get(env.target)
+        except AttributeError:
+            password = None
+
+        spec['users'].append({'name': username,
+                              'password': password or
+                              answer('mysql_user_pass')})
+        spec['grants'].append({'user': username, 'database': db_name})
+
+    return spec
+
+
+def _spec():
+    """ The databases, users and grants the current target should have.
+
+    ``env.mysql_spec`` is either the spec or a dict of target name to spec,
+    a target missing from it is skipped. The spec is built from the project
+    settings when it is not set. For example:
+
+    .. code-block:: python
+
+        env.mysql_spec = {
+            'databases': ['shop_live',
+                          {'name': 'shop_logs', 'charset': 'utf8mb4',
+                           'collation': 'utf8mb4_unicode_ci'}],
+            'users': [{'name': 'shop', 'password': 'secret'},
+                      {'name': 'report', 'host': '%', 'password': 'other'}],
+            'grants': [{'user': 'shop', 'database': 'shop_live'},
+                       {'user': 'report', 'host': '%',
+                        'database': 'shop_live', 'privileges': 'SELECT'}],
+        }
+
+    Databases default to ``utf8`` and ``utf8_unicode_ci``, users and grants
+    to the ``localhost`` host and grants to all privileges.
+
+    :returns: dict -- The normalized spec, None when no database should be
+        created.
+    """
+
+    from deploy.conf import settings
+
+    spec = settings.MYSQL_SPEC()
+    if spec is None:
+        spec = _default_spec()
+    else:
+        spec = _target_spec(spec)
+    if spec is None:
+        return None
+
+    databases = []
+    for database in spec.get('databases', []):
+        if not isinstance(database, dict):
+            database = {'name': database}
+        databases.append(dict({'charset': 'utf8',
+                               'collation': 'utf8_unicode_ci'}, **database))
+
+    users = []
+    for user in spec.get('users', []):
+        user = dict({'host': 'localhost'}, **user)
+        if not validate_db_username(user['name']):
+            raise FabricException('Invalid MySQL user name: {0}'.format(
+                user['name']))
+        users.append(user)
+
+    grants = []
+    for grant in spec.get('grants', []):
+        grant = dict({'host': 'localhost', 'privileges': 'ALL'}, **grant)
+        privileges = grant['privileges']
+        if isinstance(privileges, basestring):
+            privileges = privileges.split(',')
+        privileges = frozenset(p.strip().upper() for p in privileges)
+        if privileges & set(['ALL', 'ALL PRIVILEGES']):
+            privileges = ALL_PRIVILEGES
+        grant['privileges'] = privileges
+        grants.append(grant)
+
+    return {'databases': databases, 'users': users, 'grants': grants}
+
+
+def _target_spec(spec):
+    """ Pick the spec of the current target out of ``env.mysql_spec``.
+
+    :param spec: The spec, or a dict of target name to spec, told apart by
+        having keys other than ``SPEC_KEYS``.
+    :type spec: dict
+
+    :returns: dict -- The spec, None when ``spec`` has no entry for the
+        target.
+    """
+
+    from deploy.conf import settings
+
+    if set(spec) <= SPEC_KEYS:
+        return spec
+
+    target = settings.TARGET()
+    if target not in spec:
+        puts(yellow('[MySQL] No spec for the {0} target in '
+                    'env.mysql_spec'.format(target)))
+        return None
+    return spec[target]
+
+
+def _state(rows):
+    """ Parse the result of ``STATE_QUERY``.
+
+    :param rows: The tab separated rows.
+    :type rows: str
+
+    :returns: dict -- The databases with their character set and
+        collation, the users and the privileges of each user and host on
+        each database.
+    """
+
+    state = {'databases': {}, 'users': set(), 'grants': {}}
+    for line in rows.splitlines():
+        fields = line.rstrip('\r').split('\t')
+        if len(fields) != 4:
+            continue
+        kind, a, b, c = fields
+        if kind == 'database':
+            state['databases'][a] = (b, c)
+        elif kind == 'user':
+            state['users'].add((a, b))
+        elif kind == 'grant':
+            grantee = re.match(r"^'(.*)'@'(.*)'$", a)
+            if grantee:
+                key = grantee.groups() + (b.replace('\\', ''),)
+                state['grants'].setdefault(key, set()).add(c)
+    return state
+
+
+def _plan(spec, state):
+    """ Work out the statements that bring the server from ``state`` to
+    ``spec``.
+
+    :param spec: The normalized spec.
+    :type spec: dict
+
+    :param state: The server state, see ``_state``.
+    :type state: dict
+
+    :returns: list -- Statement and how it is shown, without passwords.
+    """
+
+    plan = []
+
+    for database in spec['databases']:
+        name = _quote_name(database['name'])
+        charset = (database['charset'], database['collation'])
+        current = state['databases'].get(database['name'])
+        if current is None:
+            statement = 'CREATE DATABASE IF NOT EXISTS {0} /*!40100 DEFAULT '\
+                        'CHARACTER SET {1} COLLATE {2} */'.format(name,
+                                                                  *charset)
+        elif current != charset:
+            statement = 'ALTER DATABASE {0} CHARACTER SET {1} COLLATE '\
+                        '{2}'.format(name, *charset)
+        else:
+            continue
+        plan.append((statement, statement))
+
+    for user in spec['users']:
+        if (user['name'], user['host']) in state['users']:
+            continue
+        if not user.get('password'):
+            raise FabricException('No password for MySQL user {0}'.format(
+                user['name']))
+        statement = 'CREATE USER {0}@{1} IDENTIFIED BY {{0}}'.format(
+            _quote(user['name']), _quote(user['host']))
+        plan.append((statement.format(_quote(user['password'])),
+                     statement.format("'***'")))
+
+    for grant in spec['grants']:
+        current = state['grants'].get(
+            (grant['user'], grant['host'], grant['database']), set())
+        missing = grant['privileges'] - current
+        if not missing:
+            continue
+        if grant['privileges'] == ALL_PRIVILEGES:
+            privileges = 'ALL PRIVILEGES'
+        else:
+            privileges = ', '.join(sorted(missing))
+        statement = 'GRANT {0} ON {1}.* TO {2}@{3}'.format(
+            privileges, _quote_name(grant['database']),
+            _quote(grant['user']), _quote(grant['host']))
+        plan.append((statement, statement))
+
+    return plan
+
+
+def _provision(dry_run=False):
+    """ Bring the server of the current host in line with the spec of the
+    current target, see ``create_database``.
+
+    :param dry_run: Only show the statements that would be run.
+    :type dry_run: bool
+
+    :returns: list -- The statements run, without passwords, None when no
+        database should be created.
+    """
+
+    # Every answer is collected before the first query
+    spec = _spec()
+    if spec is None:
+        puts(yellow('[MySQL]: Skipping DB Creation'))
+        return None
+    client = _client()
+
+    state = _state(_session(client, STATE_QUERY))
+    plan = _plan(spec, state)
+    if not plan:
+        puts(green('[MySQL] Up to date: {0}'.format(', '.join(
+            database['name'] for database in spec['databases']))))
+        return []
+
+    for statement, shown in plan:
+        puts(blue('[MySQL] {0}'.format(shown)))
+    if dry_run:
+        puts(yellow('[MySQL] Dry run, nothing applied'))
+    else:
+        _session(client, '\n'.join(statement + ';'
+                                   for statement, shown in plan))
+        puts(green('[MySQL] Applied {0} statements'.format(len(plan))))
+
+    return [shown for statement, shown in plan]
+
+
 @pre_hooks()
 @post_hooks()
-def create_database(**kwargs):
-    """ Create a MySQL database.
+def create_database(dry_run=False, **kwargs):
+    """ Create the MySQL databases, users and grants in the spec of the
+    target, see ``_spec``.
+
+    The server is read with a single query and only the statements for
+    what is missing are run, all of them in a single client session. On
+    a host that is already provisioned this is the one query.
 
     .. note::
         Supports pre and post hooks
+
+    **Usage:**
+
+    .. code-block:: none
+
+        fab live create_database
+        fab live create_database:dry_run=1
+
+    :param dry_run: Only show the statements that would be run.
+    :type dry_run: bool
+
+    :returns: list -- The statements run, without passwords.
     """
 
-    from conf import settings
+    try:
+        return _provision(_bool(dry_run)) or []
+    except FabricException as e:
+        _print_error(e)
+        return []
 
-    safe = re.compile('[\W]+', re.UNICODE)
 
-    def demand_valid_username():
-        while True:
-            username = prompt(yellow('> [MySQL]: Database Username:'))
-            if not validate_db_username(username):
-                puts(red('[MySQL] Username must be shorter than 16 characters'))
-            else:
-                break
-        return username
+@runs_once
+def provision_databases(targets=None, pool_size=None, timeout=None,
+                        dry_run=False):
+    """ Create the MySQL databases, users and grants of several targets at
+    once, see ``create_database``.
+
+    Every question is answered for every target first, then each target
+    is provisioned on each of its hosts by a bounded pool of workers. The
+    hosts of a target are ``env.mysql_hosts``, a list or a dict of target
+    name to list, defaulting to the hosts of the run.
+
+    **Usage:**
+
+    .. code-block:: none
+
+        fab provision_databases
+        fab provision_databases:targets=live|stage,pool_size=2
+
+    :param targets: The targets, ``|`` separated, defaults to live, stage,
+        test and dev.
+    :type targets: str
+
+    :param pool_size: Maximum number of targets and hosts provisioned at
+        once, defaults to ``env.deploy_pool_size``
+    :type pool_size: int
+
+    :param timeout: Seconds allowed per target and host, defaults to
+        ``env.deploy_host_timeout``
+    :type timeout: int
+
+    :param dry_run: Only show the statements that would be run.
+    :type dry_run: bool
+
+    :returns: dict -- Target name to host string to result dict.
+    """
+
+    from deploy.conf import settings
+    from deploy.parallel import run_parallel
+
+    targets = (targets or 'live|stage|test|dev').split('|')
+    pool_size = int(pool_size or settings.DEPLOY_POOL_SIZE())
+    timeout = int(timeout or settings.DEPLOY_HOST_TIMEOUT() or 0)
+
+    jobs = []
+    envs = {}
+    errors = {}
+    for target in targets:
+        with fab_settings(target=target):
+            hosts = settings.MYSQL_HOSTS()
+            if isinstance(hosts, dict):
+                hosts = hosts.get(target) or []
+            try:
+                # Answer everything here, the workers can not prompt
+                if _spec() is not None:
+                    _client()
+                    settings.MYSQL_ROOT_PASS()
+            except FabricException as e:
+                errors[target] = str(e)
+                continue
+        for host in hosts:
+            job = '{0} {1}'.format(target, host)
+            jobs.append(job)
+            envs[job] = dict(to_dict(host), target=target)
+
+    puts(blue('[MySQL] Provisioning {0} targets on {1} hosts, {2} at a '
+              'time'.format(len(targets), len(set(
+                  envs[job]['host_string'] for job in jobs)), pool_size)))
+
+    dry_run = _bool(dry_run)
+    results = run_parallel(_provision, jobs, args=(dry_run,),
+                           pool_size=pool_size, timeout=timeout, envs=envs)
+
+    hosts = []
+    matrix = dict((target, {}) for target in targets)
+    for job in jobs:
+        target, host = envs[job]['target'], envs[job]['host_string']
+        if host not in hosts:
+            hosts.append(host)
+        matrix[target][host] = results[job]
+
+    def cell(result):
+        if result is None:
+            return '-'
+        if result['status'] != 'ok':
+            return result['error'] or result['status']
+        if result['result'] is None:
+            return 'skipped'
+        if not result['result']:
+            return 'up to date'
+        return '{0} {1}'.format(len(result['result']),
+                                'planned' if dry_run else 'applied')
+
+    _print_table(['Target'] + hosts, [
+        [name] + ([errors[name]] * len(hosts) if name in errors else
+                  [cell(matrix[name].get(column)) for column in hosts])
+        for name in targets])
+
+    failed = [job for job in jobs if results[job]['status'] != 'ok']
+    if failed or errors:
+        _print_error('Provisioning failed for: {0}'.format(', '.join(
+            sorted(errors) + failed)))
+
+    return matrix
+
+
+def _databases():
+    """ Names of the databases of the current target, those in its spec or
+    else ``PROJECT_DB_NAME``.
+
+    :returns: list -- The database names.
+    """
+
+    from deploy.conf import settings
+
+    spec = settings.MYSQL_SPEC()
+    if spec is None:
+        return [settings.PROJECT_DB_NAME()]
+    spec = _target_spec(spec) or {}
+    return [database['name'] if isinstance(database, dict) else database
+            for database in spec.get('databases', [])]
+
 
-    create = prompt(yellow('> [MySQL]: Create a MySQL DB [Y/n]: '))
+def _tables(client, databases):
+    """ List the tables of some databases, largest first so the slowest
+    dumps start first.
 
-    if create.lower() == 'y':
+    :param client: The mysql client command.
+    :type client: str
 
-        mysql = "mysql -u {0}".format(settings.MYSQL_ROOT_USER())
+    :param databases: The database names.
+    :type databases: list
 
-        if settings.PROJECT_DB_HOST():
-            mysql += " --host {0}".format(settings.PROJECT_DB_HOST())
+    :returns: list -- Database and table name pairs.
+    """
 
-        if settings.MYSQL_ROOT_PASS():
-            mysql += " -p{0}".format(settings.MYSQL_ROOT_PASS())
+    if not databases:
+        return []
+    rows = _session(client, "SELECT TABLE_SCHEMA, TABLE_NAME FROM "
+                            "information_schema.TABLES WHERE TABLE_SCHEMA "
+                            "IN ({0}) AND TABLE_TYPE = 'BASE TABLE' ORDER "
+                            "BY DATA_LENGTH + INDEX_LENGTH DESC;".format(
+                                ', '.join(_quote(name)
+                                          for name in databases)))
+    return [tuple(line.rstrip('\r').split('\t'))
+            for line in rows.splitlines() if '\t' in line]
 
-        db_name = settings.PROJECT_DB_NAME()
-        if len(settings.PROJECT()):
-            puts(yellow('> [MySQL]: ') + red('Your db name was truncated: ') + yellow(db_name))
 
-        if not db_name:
-            db_name = prompt(yellow('> [MySQL]: Please enter a database name: '))
-            db_name = safe.sub('', db_name)
+def _in_parallel(func, items, jobs):
+    """ Call ``func`` with each item, ``jobs`` at a time, in threads.
 
-        puts(blue('[MySQL] Database name: {0}'.format(db_name)))
+    :param func: The callable.
+    :type func: callable
 
-        command = mysql + " --execute='CREATE DATABASE IF NOT EXISTS "\
-                          "`{0}` /*!40100 DEFAULT CHARACTER SET utf8 COLLATE "\
-                          "utf8_unicode_ci */'".format(db_name)
-        run(command)
+    :param items: The items.
+    :type items: list
 
-        create_user = prompt(yellow('> [MySQL]: Create user for {0}? '
-                                    '[Y/n]:'.format(db_name)))
+    :param jobs: The number of threads.
+    :type jobs: int
 
-        if create_user.lower() == 'y':
+    :returns: list -- What ``func`` returned or raised for each item.
+    """
 
-            username = settings.PROJECT_DB_USER()
-            if not username or not validate_db_username(username):
-                username = demand_valid_username()
+    results = [None] * len(items)
+    pending = Queue.Queue()
+    for i in range(len(items)):
+        pending.put(i)
 
+    def work(stack):
+        timing.adopt(stack)
+        while True:
             try:
-                password = settings.PROJECT_DB_PASS().get(env.target)
-            except AttributeError:
-                password = None
+                i = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = func(items[i])
+            except Exception as e:
+                results[i] = e
+
+    threads = [threading.Thread(target=work, args=(timing.current(),))
+               for _ in range(max(1, min(int(jobs), len(items))))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+
+def _on_host(step, items, jobs):
+    """ Run a step for each table, ``jobs`` at a time, as a single script
+    on the current host. Unlike ``_in_parallel`` nothing on ``env`` is
+    shared between the jobs, they are processes on the host.
+
+    :param step: Shell commands getting the database as ``$2`` and the
+        table as ``$3``, printing the bytes they moved last.
+    :type step: str
+
+    :param items: Database and table name pairs.
+    :type items: list
+
+    :param jobs: The number of tables at once.
+    :type jobs: int
+
+    :returns: list -- The bytes and seconds, or the exception, of each
+        item.
+    """
+
+    script = _TABLE_JOBS.format(
+        clock=_CLOCK, step=step, marker=_REPORT, jobs=max(1, int(jobs)),
+        items=' '.join('{0} {1} {2}'.format(i, pipes.quote(database),
+                                           pipes.quote(table))
+                       for i, (database, table) in enumerate(items)))
+    output = run(script)
+
+    # Left for the tables the script never got to
+    error = (output.strip().splitlines() or ['No result'])[-1]
+    results = [FabricException(error) for _ in items]
+    for line in output.splitlines():
+        if not line.startswith(_REPORT):
+            continue
+        fields = line.split(None, 3)
+        i, status = int(fields[1]), fields[2]
+        if status == 'ok':
+            duration, size = fields[3].split()
+            results[i] = (int(size), int(duration) / 1000.0)
+        else:
+            results[i] = FabricException(
+                fields[3].strip() if len(fields) > 3 else 'Failed')
+    return results
+
+
+def _stream(command, local_path, upload=False):
+    """ Run a command on the current host over its ssh control master,
+    streaming its output to a local file, or a local file to its input.
+
+    The root password is sent ahead of the stream and read into
+    ``MYSQL_PWD`` on the host, see ``_secret``.
+
+    :param command: The remote command, run with ``pipefail``.
+    :type command: str
+
+    :param local_path: The local file.
+    :type local_path: str
+
+    :param upload: Stream the file to the command instead.
+    :type upload: bool
+    """
+
+    from deploy.conf import settings
+    from deploy.connections import ssh_command, ssh_master
+
+    ssh_master(env.user, env.host)
+    command = _READ_PASSWORD + command
+    args = shlex.split(ssh_command()) + [
+        '-p', str(env.port), '{0}@{1}'.format(env.user, env.host),
+        'bash -o pipefail -c {0}'.format(pipes.quote(command))]
+
+    with open(local_path, 'rb' if upload else 'wb') as f:
+        process = subprocess.Popen(
+            args, stdin=subprocess.PIPE, stdout=None if upload else f,
+            stderr=subprocess.PIPE)
+        try:
+            process.stdin.write((settings.MYSQL_ROOT_PASS() or '') + '\n')
+            if upload:
+                shutil.copyfileobj(f, process.stdin)
+            process.stdin.close()
+        except IOError:
+            # The command exited early, its error says why
+            pass
+        error = process.stderr.read()
+        process.wait()
+
+    if process.returncode:
+        raise FabricException(error.strip() or 'Exited with code {0}'.format(
+            process.returncode))
+
+
+def _report_transfer(label, results, items, started):
+    """ Print the size, time and throughput of each table of a snapshot or
+    restore, raising if any of them failed.
+    """
+
+    from deploy.store import _size
+
+    rows = []
+    failed = []
+    total = 0
+    for (database, table), result in zip(items, results):
+        name = '{0}.{1}'.format(database, table)
+        if isinstance(result, Exception):
+            failed.append(name)
+            rows.append([name, '-', '-', '-', str(result)])
+            continue
+        size, seconds = result
+        total += size
+        rows.append([name, _size(size), '{0:.1f}s'.format(seconds),
+                     '{0}/s'.format(_size(size / max(seconds, 0.001))),
+                     'ok'])
 
-            if not password:
-                password = prompt(yellow('> [MySQL]: Database User Password for {0.target} environment:'.format(env)))
+    _print_table(['Table', 'Size', 'Time', 'Rate', 'Result'], rows)
 
-            command = mysql + " --execute=\"GRANT ALL PRIVILEGES "\
-                              "ON {0}.* TO {1}@'localhost' IDENTIFIED BY "\
-                              "'{2}'\"".format(db_name, username, password)
-            run(command)
+    wall = time.time() - started
+    puts(blue('[MySQL] {0} {1} tables, {2} compressed in {3:.1f}s, '
+              '{4}/s'.format(label, len(items) - len(failed), _size(total),
+                             wall, _size(total / max(wall, 0.001)))))
 
+    if failed:
+        raise FabricException('{0} failed for {1}'.format(
+            label, ', '.join(failed)))
+
+
+def snapshot(to='local', jobs=None):
+    """ Dump the databases of the target, a table at a time and several
+    tables at once, compressed on the host.
+
+    Each table is dumped with ``--single-transaction --quick``, so InnoDB
+    tables are read without locking and rows are streamed rather than
+    held in memory. Each table is consistent on its own, tables dumped
+    by different workers are not consistent with each other.
+
+    The dumps are streamed over the ssh control master of the host to
+    ``env.mysql_snapshot_dir`` locally, or with ``to=host`` written to
+    ``env.mysql_backup_path`` on the host by a single script running the
+    dumps side by side. The snapshot is named after the run timestamp.
+
+    **Usage:**
+
+    .. code-block:: none
+
+        fab live snapshot
+        fab live snapshot:to=host,jobs=8
+
+        # Before every deploy
+        fab live deploy:master,pre=deploy.db.mysql.snapshot
+
+    :param to: ``local`` or ``host``.
+    :type to: str
+
+    :param jobs: Tables dumped at once, defaults to
+        ``env.mysql_snapshot_jobs``
+    :type jobs: int
+
+    :returns: str -- The snapshot path.
+    """
+
+    from deploy.conf import settings
+
+    try:
+        jobs = int(jobs or settings.MYSQL_SNAPSHOT_JOBS())
+        client = _client()
+        args = _client_args()
+        if to == 'host':
+            path = os.path.join(settings.MYSQL_BACKUP_PATH(), settings.NOW())
+        else:
+            path = os.path.join(settings.MYSQL_SNAPSHOT_DIR(), settings.NOW())
+        databases = _databases()
+        if not databases:
+            raise FabricException('No databases to snapshot')
+        items = _tables(client, databases)
+    except FabricException as e:
+        _print_error(e)
+        return
+
+    puts(blue('[MySQL] Snapshot of {0} tables from {1} to {2}, {3} at '
+              'a time'.format(len(items), ', '.join(databases), path, jobs)))
+
+    if to == 'host':
+        with fab_settings(hide('everything'), warn_only=True):
+            run('mkdir -p {0}'.format(' '.join(
+                os.path.join(path, name) for name in databases)))
     else:
-        puts(yellow('[MySQL]: Skipping DB Creation'))
+        for name in databases:
+            if not os.path.isdir(os.path.join(path, name)):
+                os.makedirs(os.path.join(path, name))
+
+    # Fast compression, snapshots are meant to run on every deploy
+    command = 'mysqldump{0} --single-transaction --quick '\
+              '--skip-lock-tables {{0}} {{1}} | gzip -1'.format(args)
+
+    def dump(item):
+        database, table = item
+        target = os.path.join(path, database, table + '.sql.gz')
+        started = time.time()
+        try:
+            _stream(command.format(database, table), target)
+        except FabricException:
+            os.remove(target)
+            raise
+        return os.path.getsize(target), time.time() - started
+
+    started = time.time()
+    # Output settings are global, they are not changed from the threads
+    with fab_settings(hide('everything'), warn_only=True):
+        if to == 'host':
+            target = '{0}/"$2"/"$3".sql.gz'.format(path)
+            with _login():
+                results = _on_host('{0} > {1} && wc -c < {1} || {{ rm -f {1}; '
+                                   'exit 1; }}'.format(command.format(
+                                       '"$2"', '"$3"'), target), items, jobs)
+        else:
+            results = _in_parallel(dump, items, jobs)
+    try:
+        _report_transfer('Snapshot', results, items, started)
+    except FabricException as e:
+        _print_error(e)
+        return
+
+    return path
+
+
+def restore(name=None, source='local', jobs=None):
+    """ Load a snapshot, see ``snapshot``, several tables at once.
+
+    Tables are loaded with foreign key checks off, databases that do not
+    exist are created first.
+
+    **Usage:**
+
+    .. code-block:: none
+
+        fab live restore
+        fab live restore:1480000000,source=host,jobs=8
+
+    :param name: The snapshot, defaults to the latest.
+    :type name: str
+
+    :param source: Where the snapshot is, ``local`` or ``host``.
+    :type source: str
+
+    :param jobs: Tables loaded at once, defaults to
+        ``env.mysql_snapshot_jobs``
+    :type jobs: int
+
+    :returns: str -- The snapshot restored.
+    """
+
+    from deploy.conf import settings
+
+    try:
+        jobs = int(jobs or settings.MYSQL_SNAPSHOT_JOBS())
+        client = _client()
+        args = _client_args()
+        if source == 'host':
+            base = settings.MYSQL_BACKUP_PATH()
+            with fab_settings(hide('everything'), warn_only=True):
+                listing = run('cd {0} && ls -1 {1}/*/*.sql.gz'.format(
+                    base, name or '$(ls -1 | sort | tail -n 1)'))
+            files = [line.strip() for line in listing.splitlines()
+                     if listing.succeeded and line.strip()]
+        else:
+            base = settings.MYSQL_SNAPSHOT_DIR()
+            if not name and os.path.isdir(base):
+                name = (sorted(os.listdir(base)) or [None])[-1]
+            files = []
+            if name and os.path.isdir(os.path.join(base, name)):
+                for database in sorted(os.listdir(os.path.join(base, name))):
+                    files.extend(os.path.join(name, database, table)
+                                 for table in sorted(os.listdir(
+                                     os.path.join(base, name, database))))
+        if not files:
+            raise FabricException('No snapshot {0}in {1}'.format(
+                name + ' ' if name else '', base))
+    except FabricException as e:
+        _print_error(e)
+        return
+
+    name = files[0].split('/')[0]
+    items = [(f.split('/')[1], f.split('/')[2][:-len('.sql.gz')])
+             for f in files]
+    databases = sorted(set(database for database, table in items))
+
+    puts(yellow('[MySQL] Restoring {0} tables of snapshot {1}, {2} at a '
+                'time'.format(len(items), name, jobs)))
+    try:
+        _session(client, '\n'.join(
+            'CREATE DATABASE IF NOT EXISTS {0};'.format(_quote_name(database))
+            for database in databases))
+    except FabricException as e:
+        _print_error(e)
+        return
+
+    command = '(echo "SET FOREIGN_KEY_CHECKS=0;"; gunzip -c{{0}}) | '\
+              'mysql{0} {{1}}'.format(args)
+
+    def load(item):
+        database, table = item
+        dump = os.path.join(base, name, database, table + '.sql.gz')
+        started = time.time()
+        _stream(command.format('', database), dump, upload=True)
+        return os.path.getsize(dump), time.time() - started
+
+    started = time.time()
+    with fab_settings(hide('everything'), warn_only=True):
+        if source == 'host':
+            dump = '{0}/{1}/"$2"/"$3".sql.gz'.format(base, name)
+            with _login():
+                results = _on_host('{0} && wc -c < {1}'.format(command.format(
+                    ' ' + dump, '"$2"'), dump), items, jobs)
+        else:
+            results = _in_parallel(load, items, jobs)
+    try:
+        _report_transfer('Restore', results, items, started)
+    except FabricException as e:
+        _print_error(e)
+        return
+
+    return name
+
+
+def _valid_username(username):
+    """ Check a database user name answer, see ``validate_db_username``.
+    """
+
+    if not validate_db_username(username or ''):
+        raise ValueError('Username must be shorter than 16 characters')
+    return username
 
 
 def validate_db_username(username):
@@ -4,15 +4,47 @@
 
 """
 
-from utils import _call_hooks
+from hooks import _call_hooks, _validate
 
 from functools import wraps
 
+from . import FabricException
+
+
+def _check_hooks(func, kwargs, *hooks):
+    """ Check every hook a call will run resolves, before any of them run.
+
+    :param func: The decorated function, post hooks it was decorated with
+        are checked as well.
+    :type func: callable
+
+    :param kwargs: The keyword arguments of the call.
+    :type kwargs: dict
+
+    :raises: FabricException -- When a hook does not resolve, naming
+        every hook that does not.
+    """
+
+    names = list(getattr(func, '_post_hooks', None) or [])
+    for hook_list in hooks:
+        names.extend(hook_list or [])
+    for key in ('pre', 'post'):
+        if kwargs.get(key):
+            names.extend(kwargs[key].split('|'))
+
+    errors = _validate(names)
+    if errors:
+        raise FabricException('Unresolved hooks, {0} not called: {1}'.format(
+            func.__name__, '; '.join(errors)))
+
 
 def pre_hooks(*args):
     """ Pre hooks decorator, runs functions before the call of the
     decorated function.
 
+    Every pre and post hook of the call is checked before the first one
+    runs, the call raises FabricException if any of them cannot be imported.
+
     :rtype: callable -- the decorated function
     """
 
@@ -23,12 +55,14 @@ def pre_hooks(*args):
     def inner(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
+            _check_hooks(func, kwargs, arg_hooks)
             if arg_hooks:
                 _call_hooks(arg_hooks)
             hooks = kwargs.get('pre')
             if hooks:
                 _call_hooks(hooks.split('|'))
             return func(*args, **kwargs)
+        wrapper._post_hooks = getattr(func, '_post_hooks', None)
         return wrapper
     return inner
 
@@ -47,11 +81,14 @@ def post_hooks(*args):
     def inner(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            func(*args, **kwargs)
+            _check_hooks(func, kwargs, arg_hooks)
+            result = func(*args, **kwargs)
             if arg_hooks:
                 _call_hooks(arg_hooks)
             hooks = kwargs.get('post')
             if hooks:
                 _call_hooks(hooks.split('|'))
+            return result
+        wrapper._post_hooks = arg_hooks
         return wrapper
     return inner
@@ -0,0 +1,184 @@
+"""
+.. module:: deps
+   :synopsis: Dependency installs cached on the hash of their manifests.
+
+"""
+
+import os
+
+from fabric.colors import blue, green, yellow
+from fabric.state import env
+from fabric.utils import puts
+
+from . import FabricException
+from batch import Batch
+from decorators import pre_hooks, post_hooks
+from utils import _print_error, _json_log_command
+
+# Marks the line each install step reports its result on
+_REPORT = '@@velcro-deps'
+
+_NPM = r'''set -e
+[ -f package.json ] || exit 0
+hash=$(cat {manifests} 2>/dev/null | sha1sum | cut -c1-40)
+cache={cache}/npm-$hash
+if [ -f node_modules/.velcro-hash ] && [ "$(cat node_modules/.velcro-hash)" = "$hash" ]; then
+  result=skip
+elif [ -d "$cache" ]; then
+  rm -rf node_modules
+  cp -a --reflink=auto "$cache" node_modules
+  result=hit
+else
+  rm -rf node_modules
+  {install}
+  mkdir -p node_modules
+  echo "$hash" > node_modules/.velcro-hash
+  mkdir -p {cache}
+  rm -rf "$cache.tmp"
+  cp -a --reflink=auto node_modules "$cache.tmp"
+  mv "$cache.tmp" "$cache"
+  (cd {cache} && ls -1td npm-* | tail -n +{keep} | xargs -r rm -rf)
+  result=miss
+fi
+{log}
+echo "{marker} npm $result $hash"'''
+
+_PIP = r'''set -e
+[ -f {requirements} ] || exit 0
+hash=$(sha1sum {requirements} | cut -c1-40)
+cache={cache}/pip-$hash
+if [ -f {venv}/.velcro-hash ] && [ "$(cat {venv}/.velcro-hash)" = "$hash" ]; then
+  result=skip
+else
+  if [ -d "$cache" ]; then
+    result=hit
+  else
+    mkdir -p {cache}
+    rm -rf "$cache.tmp"
+    if ! {venv}/bin/pip wheel -q -r {requirements} -w "$cache.tmp"; then
+      rm -rf "$cache.tmp"
+      exit 1
+    fi
+    mv "$cache.tmp" "$cache"
+    (cd {cache} && ls -1td pip-* | tail -n +{keep} | xargs -r rm -rf)
+    result=miss
+  fi
+  {venv}/bin/pip install -q --no-index --find-links "$cache" -r {requirements}
+  echo "$hash" > {venv}/.velcro-hash
+fi
+{log}
+echo "{marker} pip $result $hash"'''
+
+
+def _log_command(kind):
+    """ Shell command appending the install result to the deploy log as a
+    JSON line.
+
+    :param kind: The installer, npm or pip.
+    :type kind: str
+
+    :returns: str -- The command.
+    """
+
+    from conf import settings
+
+    return _json_log_command(settings.DEPLOY_LOG(), {
+        'time': int(settings.NOW()),
+        'host': env.host_string,
+        'target': settings.TARGET(),
+        'event': 'dependencies',
+        'kind': kind,
+        'hash': '$hash',
+        'result': '$result'})
+
+
+def _install_steps(batch, path):
+    """ Add the dependency install steps for a source tree to a batch.
+
+    ``npm`` runs when the tree has a ``package.json``, ``pip`` when it has
+    ``env.py_pip_reqs_file`` and ``env.py_venv_base`` is set. Each is
+    skipped when the installed dependencies already match the manifests,
+    or restored from the per host cache in
+    ``settings.DEPENDENCY_CACHE_PATH()`` when they have been installed
+    before.
+
+    ``node_modules`` is copied to and from the cache, as a copy on write
+    clone where the file system supports it, so a package written to in
+    one release changes neither the cache nor the other releases.
+
+    :param batch: The batch to add to.
+    :type batch: deploy.batch.Batch
+
+    :param path: The source tree to install into.
+    :type path: str
+    """
+
+    from conf import settings
+
+    cache = settings.DEPENDENCY_CACHE_PATH()
+    keep = int(settings.KEEP_RELEASES()) + 1
+
+    batch.add(_NPM.format(
+        manifests=' '.join(settings.DEPENDENCY_MANIFESTS()), cache=cache,
+        install=settings.NPM_INSTALL(), keep=keep, log=_log_command('npm'),
+        marker=_REPORT), cwd=path)
+
+    try:
+        venv = os.path.join(settings.PY_VENV_BASE(), settings.PY_VENV_NAME())
+    except FabricException:
+        return
+
+    batch.add(_PIP.format(
+        requirements=settings.PY_PIP_REQS_FILE(), venv=venv, cache=cache,
+        keep=keep, log=_log_command('pip'), marker=_REPORT), cwd=path)
+
+
+def _report_installs(results):
+    """ Print the outcome of the dependency install steps.
+
+    :param results: The batch results.
+    :type results: list
+
+    :returns: dict -- Installer name to skip, hit or miss.
+    """
+
+    outcome = {}
+    for result in results:
+        for line in result['stdout'].splitlines():
+            if line.startswith(_REPORT):
+                kind, status = line.split()[1:3]
+                outcome[kind] = status
+                puts(blue('[DEPS] {0}: '.format(kind)) + {
+                    'skip': green('up to date'),
+                    'hit': green('restored from cache'),
+                    'miss': yellow('installed')}[status])
+    return outcome
+
+
+@pre_hooks()
+@post_hooks()
+def install_dependencies(**kwargs):
+    """ Install dependencies in ``settings.SRC_PATH()``, reusing previous
+    installs of the same manifests.
+
+    .. note::
+        Supports pre and post hooks
+
+    **Usage:**
+
+    .. code-block:: none
+
+        fab live deploy:master,post=deploy.deps.install_dependencies
+
+    :returns: dict -- Installer name to skip, hit or miss.
+    """
+
+    from conf import settings
+
+    try:
+        batch = Batch()
+        _install_steps(batch, settings.SRC_PATH())
+    except FabricException as e:
+        _print_error(e)
+    else:
+        return _report_installs(batch.run())
@@ -5,10 +5,10 @@
 """
 
 import os
+from pipes import quote
 
 from fabric.api import run
-from fabric.contrib.files import exists
-from fabric.context_managers import cd
+from fabric.context_managers import cd, hide
 from fabric.colors import blue, green, yellow
 from fabric.utils import puts
 from . import FabricException
@@ -53,32 +53,30 @@ def bootstrap(**kwargs):
 
     from conf import settings
 
-    def walk_directories(d, depth=0, base=''):
-        for k, v in sorted(d.items(), key=lambda x: x[0]):
-            path = os.path.join(base, k)
-            if isinstance(v, dict):
-                walk_directories(v, depth=depth + 1, base=path)
-            else:
-                if not exists(path):
-                    run('mkdir -p {0}'.format(path))
-                    puts(blue(('|- ') * (depth + 1) + k))
-
     try:
-        if not exists(settings.BASE_PATH()):
-            puts(yellow('[WARNING]: {0} Does not exist, creating. '.format(
-                settings.BASE_PATH())))
-            run('mkdir -p {0}'.format(settings.BASE_PATH()))
-        puts(blue('Creating directories at {0}'.format(
-            settings.BASE_PATH())))
-        walk_directories(settings.DIRECTORIES(), base=settings.BASE_PATH())
+        plan = _plan_directories(settings.BASE_PATH(),
+                                 settings.DIRECTORIES(),
+                                 settings.LOG_PATH())
     except FabricException as e:
         _print_error(e)
+    else:
+        created = _create_directories(plan)
+        base_path, log_path = plan[0][0], plan[-1][0]
+        leaves = plan[1:-1]
 
-    # Log Path - Can be different
-    if not exists(settings.LOG_PATH()):
-        puts(blue('Creating logging directory'))
-        puts(blue('Create log directory: ') + green(settings.LOG_PATH()))
-        run('mkdir -p {0}'.format(settings.LOG_PATH()))
+        if base_path in created:
+            puts(yellow('[WARNING]: {0} Does not exist, creating. '.format(
+                base_path)))
+        puts(blue('Creating directories at {0}'.format(base_path)))
+        for path, depth, name in leaves:
+            if path in created:
+                puts(blue(('|- ') * (depth + 1) + name))
+
+        # Log Path - Can be different
+        if log_path in created and \
+                log_path not in [leaf[0] for leaf in leaves]:
+            puts(blue('Creating logging directory'))
+            puts(blue('Create log directory: ') + green(log_path))
 
     try:
         scm_init = {
@@ -93,6 +91,66 @@ def bootstrap(**kwargs):
         _print_error(e)
 
 
+def _plan_directories(base_path, directories, log_path):
+    """ Flatten the project directory tree into an ordered plan.
+
+    The base path comes first and the log path last, with the leaves of
+    ``directories`` in between in the same sorted, depth first order the
+    tree is printed in.
+
+    :param base_path: The project base path.
+    :type base_path: str.
+
+    :param directories: Nested directory tree, leaves are ``None``.
+    :type directories: dict or list.
+
+    :param log_path: The logging directory path.
+    :type log_path: str.
+
+    :returns: list -- ``(path, depth, name)`` tuples.
+    """
+
+    plan = [(base_path, -1, base_path)]
+
+    def walk_directories(d, depth=0, base=''):
+        if not isinstance(d, dict):
+            d = dict.fromkeys(d or [])
+        for k, v in sorted(d.items(), key=lambda x: x[0]):
+            path = os.path.join(base, k)
+            if isinstance(v, dict):
+                walk_directories(v, depth=depth + 1, base=path)
+            else:
+                plan.append((path, depth, k))
+
+    walk_directories(directories, base=base_path)
+    plan.append((log_path, -1, log_path))
+
+    return plan
+
+
+def _create_directories(plan):
+    """ Create every directory in the plan with a single remote command.
+
+    The command is idempotent, paths that already exist are left alone
+    and only the newly created ones are echoed back. It stops at the
+    first directory it fails to create, failing the ``run``.
+
+    :param plan: The plan built by ``_plan_directories``.
+    :type plan: list.
+
+    :returns: set -- The paths that were created.
+    """
+
+    paths = ' '.join(quote(path) for path, depth, name in plan)
+    command = 'for d in {0}; do if [ ! -e "$d" ]; then '\
+              'mkdir -p "$d" || exit 1; echo "$d"; fi; done'.format(paths)
+
+    with hide('stdout'):
+        result = run(command)
+
+    return set(line.strip() for line in result.splitlines() if line.strip())
+
+
 def _git_init():
     """ Create Git repository in settings.SRC_PATH()
     """
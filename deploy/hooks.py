@@ -0,0 +1,311 @@
+"""
+.. module:: hooks
+   :synopsis: Resolving, checking and running pre and post hooks.
+
+Hooks are named by their dotted path, like ``deploy.scm.git.clean``. Each
+path is imported once per process and the callable kept, so a hook used
+by several tasks or hosts is only looked up the first time.
+
+Hooks share Fabric's ``env`` and output levels, so a hook using ``cd``,
+``hide`` or ``settings`` changes them for any hook running alongside it.
+Only hooks marked ``concurrent`` are run alongside others, every other
+hook runs on its own.
+
+"""
+
+import cProfile
+import os
+import pstats
+import Queue
+import sys
+import threading
+import time
+
+from fabric.colors import blue, yellow
+from fabric.state import connections, env
+from fabric.utils import puts
+
+import timing
+
+_registry = {}
+_times = {}
+
+
+def _resolve(hook):
+    """ Import a hook and get its callable.
+
+    :param hook: The dotted path of the hook.
+    :type hook: str
+
+    :returns: tuple -- The callable, or None and the reason it could not
+        be resolved.
+    """
+
+    if hook not in _registry:
+        path, name = os.path.splitext(hook)
+        try:
+            module = __import__(path, globals(), locals(), [name[1:]], -1)
+        except (ImportError, ValueError):
+            _registry[hook] = (None, 'Failed to import hook: {0}'.format(hook))
+        else:
+            func = getattr(module, name[1:], None)
+            if callable(func):
+                _registry[hook] = (func, None)
+            else:
+                _registry[hook] = (None, '{0} is not callable'.format(hook))
+    return _registry[hook]
+
+
+def _validate(hooks):
+    """ Check a list of hooks all resolve.
+
+    :param hooks: Dotted paths of the hooks.
+    :type hooks: list or tuple
+
+    :returns: list -- Why each hook that does not resolve failed.
+    """
+
+    return [error for func, error in (_resolve(hook) for hook in hooks or [])
+            if error]
+
+
+def _profile(hook, func):
+    """ Run a hook under cProfile, print the functions it spent the most
+    time in and save the stats to ``~/.velcro/profiles/``.
+
+    :param hook: The dotted path of the hook.
+    :type hook: str
+
+    :param func: The hook callable.
+    :type func: callable
+
+    :returns: The hook's result.
+    """
+
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func)
+    finally:
+        path = os.path.join(os.path.expanduser('~'), '.velcro', 'profiles')
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        path = os.path.join(path, '{0}-{1}.prof'.format(hook,
+                                                        int(time.time())))
+        profile.dump_stats(path)
+        puts(blue('[HOOK] Profile of {0} saved to {1}'.format(hook, path)))
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(15)
+
+
+def _reraise(kind, error, traceback):
+    """ Raise an exception again with its original traceback.
+
+    The three argument raise is Python 2 syntax, it is kept in a string so
+    the module still compiles with Python 3 tools.
+
+    :param kind: The exception class.
+    :param error: The exception.
+    :param traceback: The traceback of where it was raised.
+    """
+
+    exec('raise kind, error, traceback')
+
+
+def _run_hook(hook, func, stack=None):
+    """ Run a single hook, timing it.
+
+    :param hook: The dotted path of the hook.
+    :type hook: str
+
+    :param func: The hook callable.
+    :type func: callable
+
+    :param stack: Spans to nest the hook in, when it runs in a thread.
+    :type stack: list
+
+    :returns: tuple -- ``sys.exc_info()`` of the exception the hook raised,
+        None if it succeeded.
+    """
+
+    if stack is not None:
+        timing.adopt(stack)
+
+    puts(yellow('[HOOK]: {0}'.format(hook)))
+    started = time.time()
+    try:
+        with timing.span(hook, 'hook'):
+            if env.get('profile_hooks'):
+                _profile(hook, func)
+            else:
+                func()
+    except Exception:
+        return sys.exc_info()
+    finally:
+        _times.setdefault(hook, []).append(time.time() - started)
+        puts(blue('[HOOK] {0} took {1:.2f}s'.format(hook, _times[hook][-1])))
+
+
+def _graph(funcs):
+    """ Find the hooks each hook in a list has to wait for.
+
+    A hook waits for the hooks it was declared to run ``after`` that are
+    in the list, wherever they are in it.
+
+    :param funcs: Dotted paths and callables of the hooks, in order.
+    :type funcs: list
+
+    :returns: list -- The indexes each hook waits for.
+    """
+
+    graph = []
+    for hook, func in funcs:
+        after = set(_resolve(h)[0] for h in getattr(func, '_after', ()))
+        graph.append(set(i for i, (other, f) in enumerate(funcs)
+                         if f in after and other != hook))
+    return graph
+
+
+def _call_hooks(hooks):
+    """ Run hook functions, timing each one.
+
+    Hooks run in the order given, except that a hook declared to run
+    ``after`` others waits for them. Up to ``settings.HOOK_CONCURRENCY()``
+    hooks marked ``concurrent`` whose dependencies have finished run at
+    once, each in its own thread. Other hooks wait for the running ones to
+    finish and run on their own.
+
+    Once a hook fails no more are started, the ones running are left to
+    finish and the rest are skipped. Failures are reported in the order
+    the hooks were given and the first one is raised again.
+
+    With ``env.profile_hooks`` set, ``fab --set profile_hooks ...``, each
+    hook is run under cProfile.
+
+    :param hooks: List of hooks to import and call
+    :type hooks: list or tuple
+    """
+
+    from conf import settings
+    from utils import _print_error
+
+    funcs = []
+    for hook in hooks or []:
+        func, error = _resolve(hook)
+        if error:
+            _print_error(error)
+        else:
+            funcs.append((hook, func))
+
+    graph = _graph(funcs)
+    concurrency = max(1, int(settings.HOOK_CONCURRENCY()))
+    if concurrency > 1 and env.host_string and len(funcs) > 1:
+        # Connect before the threads race each other to do it
+        connections[env.host_string]
+
+    pending = range(len(funcs))
+    running = {}
+    errors = {}
+    finished = Queue.Queue()
+
+    def run(i, stack):
+        try:
+            error = _run_hook(funcs[i][0], funcs[i][1], stack)
+        except BaseException:
+            # Like the SystemExit of abort(), raised again once the
+            # running hooks finish
+            error = sys.exc_info()
+        finished.put((i, error))
+
+    while pending or running:
+        while len(running) < concurrency and not any(errors.values()):
+            ready = [i for i in pending if graph[i] <= set(errors)]
+            if not ready:
+                break
+            i = ready[0]
+            alone = concurrency == 1 or not getattr(funcs[i][1],
+                                                    '_concurrent', False)
+            if alone and running:
+                break
+            pending.remove(i)
+            if alone:
+                errors[i] = _run_hook(*funcs[i])
+                continue
+            running[i] = threading.Thread(target=run,
+                                          args=(i, timing.current()))
+            running[i].daemon = True
+            running[i].start()
+
+        if not running:
+            break
+        try:
+            # Poll, a blocking get() can not be interrupted
+            i, error = finished.get(timeout=0.1)
+        except Queue.Empty:
+            continue
+        running.pop(i).join()
+        errors[i] = error
+
+    for i in pending:
+        puts(yellow('[HOOK] Skipped {0}'.format(funcs[i][0])))
+    if pending and not any(errors.values()):
+        _print_error('Hook dependencies form a cycle: {0}'.format(
+            ', '.join(funcs[i][0] for i in pending)))
+
+    failed = [(funcs[i][0], errors[i]) for i in sorted(errors) if errors[i]]
+    for hook, (kind, error, traceback) in failed:
+        _print_error('{0} failed: {1}'.format(
+            hook, str(error) or kind.__name__))
+    if failed:
+        _reraise(*failed[0][1])
+
+
+def after(*hooks):
+    """ Declare the hooks a hook has to run after, when they run in the
+    same call.
+
+    **Usage:**
+
+    .. code-block:: python:
+
+        @after('deploy.scm.git.clean')
+        def cdn_timestamp():
+            ...
+
+    :param hooks: Dotted paths of the hooks to wait for.
+    :type hooks: str
+
+    :rtype: callable -- the decorated function
+    """
+
+    def inner(func):
+        func._after = hooks
+        return func
+    return inner
+
+
+def concurrent(func):
+    """ Mark a hook as safe to run alongside other hooks, see
+    ``_call_hooks``. The hook must not change ``env`` or the output levels,
+    with ``cd``, ``hide``, ``settings`` or anything that uses them.
+
+    **Usage:**
+
+    .. code-block:: python:
+
+        @concurrent
+        def warm_cache():
+            run('curl -s localhost/warm')
+
+    :rtype: callable -- the decorated function
+    """
+
+    func._concurrent = True
+    return func
+
+
+def hook_times():
+    """ Get the wall time of every hook run so far.
+
+    :returns: dict -- Hook path to the seconds each of its runs took.
+    """
+
+    return dict((hook, list(times)) for hook, times in _times.items())
@@ -6,10 +6,17 @@
 
 import os
 
-from fabric.colors import green, yellow, red
+from fabric.colors import blue, green, yellow, red
+from fabric.context_managers import hide, settings as fab_settings
+from fabric.decorators import runs_once
+from fabric.state import env
 from fabric.utils import puts
 from deploy import FabricException
-from deploy.utils import _symlink, _print_error, _sudo
+from deploy.batch import Batch
+from deploy.utils import _symlink, _print_error, _print_table, _sudo
+
+# Prefix of the line the sync script reports on
+_MARKER = '@@velcro-nginx'
 
 
 def symlink():
@@ -41,26 +48,241 @@ def symlink():
     Set ``env.nginx_symlink_sudo = True`` to run symlinks as sudo
     """
 
-    from conf import settings
+    from deploy.conf import settings
 
     try:
         sudo = settings.NGINX_SYMLINK_SUDO()
-        config_name = '{client}_{project}_{target}'.format(
-            client=settings.CLIENT(), project=settings.PROJECT(),
-            target=settings.TARGET())
-        available_path = os.path.join(
-            settings.HTTP_SERVER_CONF_PATH(), 'sites-available')
-        enabled_path = os.path.join(
-            settings.HTTP_SERVER_CONF_PATH(), 'sites-enabled')
-        conf_path = os.path.join(settings.CONFIG_PATH(), settings.NGINX_CONF())
+        conf_path, available_path, enabled_path = _paths()
+    except FabricException as e:
+        _print_error(e)
+    else:
+        batch = Batch(use_sudo=sudo)
+        _symlink(conf_path, available_path, batch=batch)
+        _symlink(available_path, enabled_path, batch=batch)
+        try:
+            batch.run()
+        except FabricException as e:
+            _print_error(e)
+        except:
+            _print_error('Symlink Failed: {0} > {1}'.format(
+                conf_path, enabled_path))
+
+
+def _paths():
+    """ The project Nginx config and its ``sites-available`` and
+    ``sites-enabled`` links.
+
+    :returns: tuple -- The config, available and enabled paths.
+    """
+
+    from deploy.conf import settings
+
+    config_name = '{client}_{project}_{target}'.format(
+        client=settings.CLIENT(), project=settings.PROJECT(),
+        target=settings.TARGET())
+    return (os.path.join(settings.CONFIG_PATH(), settings.NGINX_CONF()),
+            os.path.join(settings.HTTP_SERVER_CONF_PATH(), 'sites-available',
+                         config_name),
+            os.path.join(settings.HTTP_SERVER_CONF_PATH(), 'sites-enabled',
+                         config_name))
+
+
+def _sync_script(conf_path, available_path, enabled_path, state_path, keep):
+    """ Build the script that syncs the Nginx config on a host, see
+    ``sync_nginx``.
+
+    :returns: str -- The script, it reports ``@@velcro-nginx`` followed
+        by ``unchanged``, ``reloaded`` or ``invalid``, the hash of the
+        config and the hash of the config it replaced.
+    """
+
+    from deploy.conf import settings
+
+    return """conf={conf}; available={available}; enabled={enabled}
+state={state}
+new=$(sha1sum "$conf" | cut -c1-40) || exit 1
+was=
+[ ! -e "$available" ] || was=$(sha1sum "$available" | cut -c1-40) || exit 1
+file=$([ -f "$available" ] && [ ! -L "$available" ] && echo 1)
+if [ "$(cat "$state/reloaded" 2>/dev/null)" = "$new" ] && \\
+   [ "$(readlink "$available")" = "$state/$new.conf" ] && \\
+   [ "$(readlink "$enabled")" = "$available" ]; then
+  echo "{marker} unchanged $new $was"; exit 0
+fi
+mkdir -p "$state" && rm -f "$state/enabled.prev" || exit 1
+# Copy what the site had, its link can point at a file the deploy changes
+if [ -n "$was" ] && [ ! -e "$state/$was.conf" ]; then
+  cp "$available" "$state/$was.conf.tmp" && \\
+    mv -f "$state/$was.conf.tmp" "$state/$was.conf" || exit 1
+fi
+if [ -e "$enabled" ] || [ -L "$enabled" ]; then
+  cp -P "$enabled" "$state/enabled.prev" || exit 1
+fi
+cp "$conf" "$state/$new.conf.tmp" && \\
+  mv -f "$state/$new.conf.tmp" "$state/$new.conf" || exit 1
+ln -sfn "$state/$new.conf" "$available.tmp" && \\
+  mv -Tf "$available.tmp" "$available" || exit 1
+ln -sfn "$available" "$enabled.tmp" && \\
+  mv -Tf "$enabled.tmp" "$enabled" || exit 1
+if ! {test} 2>&1; then
+  if [ -z "$was" ]; then
+    rm -f "$available"
+  elif [ -n "$file" ]; then
+    cp "$state/$was.conf" "$available.tmp" && \\
+      mv -Tf "$available.tmp" "$available"
+  else
+    ln -sfn "$state/$was.conf" "$available.tmp" && \\
+      mv -Tf "$available.tmp" "$available"
+  fi
+  if [ -e "$state/enabled.prev" ] || [ -L "$state/enabled.prev" ]; then
+    mv -Tf "$state/enabled.prev" "$enabled"
+  else
+    rm -f "$enabled"
+  fi
+  echo "{marker} invalid $new $was"; exit 1
+fi
+{reload} || exit 1
+echo "$new" > "$state/reloaded" && rm -f "$state/enabled.prev"
+(cd "$state" && ls -1t *.conf | grep -vx "$new.conf" | tail -n +{keep} | \\
+  xargs -r rm -f)
+echo "{marker} reloaded $new $was"
+""".format(
+        conf=conf_path, available=available_path, enabled=enabled_path,
+        state=state_path, test=settings.NGINX_TEST(),
+        reload=settings.NGINX_RELOAD(), keep=int(keep), marker=_MARKER)
+
+
+def sync_nginx():
+    """
+    Sync the project Nginx config on the current host, reloading Nginx
+    only when the config changed and passes ``nginx -t``.
+
+    The config is hashed and copied to ``env.nginx_state_path`` under its
+    hash, ``sites-available`` is pointed at the copy, so the config Nginx
+    runs can not change under it, and ``sites-enabled`` at
+    ``sites-available``. When the copy is already the one linked and
+    Nginx was reloaded with it nothing is done. When the new config does
+    not pass the test ``sites-available`` gets back the config it had,
+    from a copy taken before the swap, ``sites-enabled`` is put back as it
+    was and Nginx is left alone. Otherwise Nginx is reloaded gracefully,
+    open connections are kept.
+
+    All of it runs as a single script with sudo. The newest
+    ``env.keep_releases`` copies are kept.
+
+    **Usage:**
+
+    .. code-block:: none
+
+        fab live sync_nginx
+
+    :returns: tuple -- ``unchanged``, ``reloaded`` or ``invalid``, the
+        hash of the config and of the config it replaced, None if the
+        sync failed.
+    """
+
+    from deploy.conf import settings
+
+    try:
+        if not env.sudo_user:
+            raise FabricException('Could not sync Nginx, missing sudo user')
+        script = _sync_script(*(_paths() + (settings.NGINX_STATE_PATH(),
+                                            settings.KEEP_RELEASES())))
     except FabricException as e:
         _print_error(e)
+        return None
+
+    with fab_settings(hide('warnings'), warn_only=True):
+        step = Batch(use_sudo=True).add(script).run()[0]
+
+    lines = step['stdout'].splitlines()
+    report = [line.split()[1:] for line in lines
+              if line.startswith(_MARKER)]
+    if not report:
+        _print_error('Nginx sync failed: {0}'.format(
+            step['stdout'].strip() or step['exit_code']))
+        return None
+
+    status, new, was = (report[-1] + [''])[:3]
+    if status == 'unchanged':
+        puts(green('[Nginx] Config unchanged: {0}'.format(new[:7])))
+    elif status == 'reloaded':
+        puts(green('[Nginx] Reloaded config {0}'.format(new[:7])))
     else:
-        _symlink(conf_path, os.path.join(available_path, config_name),
-                 use_sudo=sudo)
-        _symlink(os.path.join(available_path, config_name),
-                 os.path.join(enabled_path, config_name),
-                 use_sudo=sudo)
+        _print_error('Nginx config {0} failed the test, kept {1}:\n{2}'
+                     .format(new[:7], was[:7] or 'no config', '\n'.join(
+                         line for line in lines
+                         if not line.startswith(_MARKER))))
+    return status, new, was
+
+
+def _sync_host():
+    """ Sync the Nginx config on the current host, failing unless Nginx
+    ends up running it.
+
+    :returns: tuple -- See ``sync_nginx``.
+    """
+
+    result = sync_nginx()
+    if result is None:
+        raise FabricException('Sync failed')
+    if result[0] == 'invalid':
+        raise FabricException('Config {0} failed the test, kept {1}'.format(
+            result[1][:7], result[2][:7] or 'no config'))
+    return result
+
+
+@runs_once
+def parallel_sync_nginx(pool_size=None, timeout=None):
+    """
+    Sync the project Nginx config on every host at once, see
+    ``sync_nginx``.
+
+    **Usage:**
+
+    .. code-block:: none
+
+        fab live parallel_sync_nginx
+        fab live parallel_sync_nginx:pool_size=10
+
+    :param pool_size: Maximum number of hosts synced at once, defaults to
+        ``env.deploy_pool_size``
+    :type pool_size: int
+
+    :param timeout: Seconds allowed per host, defaults to
+        ``env.deploy_host_timeout``
+    :type timeout: int
+
+    :returns: dict -- Per host results.
+    """
+
+    from deploy.conf import settings
+    from deploy.parallel import run_parallel
+
+    pool_size = int(pool_size or settings.DEPLOY_POOL_SIZE())
+    timeout = int(timeout or settings.DEPLOY_HOST_TIMEOUT() or 0)
+    hosts = env.all_hosts or env.hosts
+
+    puts(blue('[Nginx] Syncing config on {0} hosts, {1} at a time'.format(
+        len(hosts), pool_size)))
+
+    results = run_parallel(_sync_host, hosts, pool_size=pool_size,
+                           timeout=timeout)
+
+    rows = []
+    for host in hosts:
+        result = results[host]
+        status, new, was = result['result'] or ('', '', '')
+        rows.append([host, '{0:.1f}s'.format(result['duration']),
+                     was[:7] or '-', new[:7] or '-',
+                     result['error'] or status])
+    _print_table(['Host', 'Duration', 'Was', 'Now', 'Result'], rows)
+
+    failed = [host for host in hosts if results[host]['status'] != 'ok']
+    if failed:
+        _print_error('Nginx sync failed on: {0}'.format(', '.join(failed)))
+
+    return results
 
 
 def restart_nginx():
@@ -0,0 +1,190 @@
+"""
+.. module:: parallel
+   :synopsis: Bounded parallel execution of tasks across hosts.
+
+"""
+
+import multiprocessing
+import time
+from Queue import Empty
+
+from fabric import state
+from fabric.context_managers import settings
+from fabric.network import to_dict
+
+import timing
+
+
+def _result(host, status, started, result=None, error=None):
+    """ Build the result dict reported for a single host.
+    """
+
+    return {
+        'host': host,
+        'status': status,
+        'result': result,
+        'error': error,
+        'duration': time.time() - started if started else 0.0}
+
+
+def _worker(func, host, args, kwargs, queue, overrides):
+    """ Run ``func`` against a single host inside a child process and
+    report the outcome back over ``queue``.
+    """
+
+    # Connections are not safe to share with the parent process
+    state.connections.clear()
+    timing.fork()
+    started = time.time()
+
+    # Nobody can answer a prompt from a worker, see deploy.answers
+    with settings(parallel=True, linewise=True, abort_on_prompts=True,
+                  **overrides):
+        try:
+            with timing.span(func.__name__, 'task'):
+                result = func(*args, **kwargs)
+        except SystemExit:
+            # abort() has already printed the reason
+            message = _result(host, 'failed', started, error='Aborted')
+        except BaseException as e:
+            message = _result(host, 'failed', started,
+                              error=str(e) or e.__class__.__name__)
+        else:
+            message = _result(host, 'ok', started, result=result)
+        timing.flush()
+
+    message['spans'] = timing.spans()
+    queue.put(message)
+
+
+def _drain(queue, results, timeout=None):
+    """ Move the results the workers have sent into ``results``.
+
+    :param queue: The queue the workers send their results on.
+    :type queue: multiprocessing.Queue
+
+    :param results: Host string to result dict, updated in place.
+    :type results: dict
+
+    :param timeout: Seconds to wait for the first result, not waiting by
+        default.
+    :type timeout: float
+    """
+
+    while True:
+        try:
+            if timeout:
+                message = queue.get(timeout=timeout)
+                timeout = None
+            else:
+                message = queue.get_nowait()
+        except Empty:
+            return
+        timing.merge(message.pop('spans', []))
+        results[message['host']] = message
+
+
+def run_parallel(func, hosts, args=(), kwargs=None, pool_size=None,
+                 timeout=None, max_failures=None, envs=None):
+    """ Run ``func`` once per host with a bounded pool of worker processes.
+
+    Each host gets its own process, at most ``pool_size`` run at once.
+    A host still running after ``timeout`` seconds is terminated and
+    reported as ``timeout``. Once more than ``max_failures`` hosts have
+    failed no new hosts are started, the ones already running are left
+    to finish and the rest are reported as ``skipped``.
+
+    :param func: The callable to run for each host.
+    :type func: callable
+
+    :param hosts: Host strings to run against.
+    :type hosts: list
+
+    :param args: Positional arguments passed to ``func``.
+    :type args: tuple
+
+    :param kwargs: Keyword arguments passed to ``func``.
+    :type kwargs: dict
+
+    :param pool_size: Maximum number of hosts to run at once.
+    :type pool_size: int
+
+    :param timeout: Seconds each host is allowed to run for.
+    :type timeout: int
+
+    :param max_failures: Failures tolerated before the run is halted,
+        ``None`` tolerates any number.
+    :type max_failures: int
+
+    :param envs: The ``env`` settings of each entry of ``hosts``, which
+        then name jobs rather than hosts, so several jobs can run against
+        the same host. The settings must include the ``host_string``.
+    :type envs: dict
+
+    :returns: dict -- Host string to a result dict with the ``status``,
+        ``result``, ``error`` and ``duration`` of each host.
+    """
+
+    kwargs = kwargs or {}
+    pool_size = max(1, int(pool_size or len(hosts) or 1))
+    queue = multiprocessing.Queue()
+    pending = list(hosts)
+    running = {}
+    dead = set()
+    results = {}
+
+    def failures():
+        return len([r for r in results.values() if r['status'] != 'ok'])
+
+    try:
+        while pending or running:
+
+            halted = max_failures is not None and failures() > max_failures
+            while pending and len(running) < pool_size and not halted:
+                host = pending.pop(0)
+                overrides = envs[host] if envs else to_dict(host)
+                process = multiprocessing.Process(
+                    target=_worker, args=(func, host, args, kwargs, queue,
+                                          overrides))
+                process.start()
+                running[host] = (process, time.time())
+
+            # Wait for a message, then take every other one already sent
+            _drain(queue, results, timeout=0.1)
+
+            for host, (process, started) in list(running.items()):
+                if host in results:
+                    process.join()
+                    del running[host]
+                elif timeout and time.time() - started > float(timeout):
+                    process.terminate()
+                    process.join()
+                    results[host] = _result(
+                        host, 'timeout', started,
+                        error='Timed out after {0}s'.format(timeout))
+                    del running[host]
+                elif not process.is_alive():
+                    # Give the queue one more pass before giving up on it
+                    if host in dead:
+                        process.join()
+                        _drain(queue, results)
+                        if host not in results:
+                            results[host] = _result(
+                                host, 'failed', started,
+                                error='Exited with code {0}'.format(
+                                    process.exitcode))
+                        del running[host]
+                    dead.add(host)
+
+            if pending and not running and halted:
+                break
+    except KeyboardInterrupt:
+        for process, started in running.values():
+            process.terminate()
+        raise
+
+    for host in pending:
+        results[host] = _result(host, 'skipped', None,
+                                error='Failure threshold reached')
+
+    return results
@@ -0,0 +1,3 @@
+""" Process manager helper functions.
+
+"""
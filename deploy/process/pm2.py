@@ -0,0 +1,225 @@
+"""
+.. module:: pm2
+   :synopsis: pm2 process manager utility functions.
+
+Reloads are graceful: with ``exec_mode`` cluster and ``wait_ready`` in the
+ecosystem file pm2 starts the new process, waits for it to send ``ready``
+and only then sends ``SIGINT`` to the old one, which drains the commands
+it has in flight before exiting. Until then both are connected, so the new
+one holds the commands it receives and sends on only those that came in
+after the old one stopped taking them, see ``client.js``.
+
+"""
+
+import json
+import time
+
+from fabric.colors import blue, green, yellow, red
+from fabric.context_managers import cd, hide, settings as fab_settings
+from fabric.api import run
+from fabric.decorators import runs_once
+from fabric.state import env
+from fabric.utils import puts
+from deploy import FabricException
+from deploy.batch import _CLOCK
+from deploy.utils import _print_error, _print_table
+
+
+def _app_path():
+    """ Directory the app runs from, the current release when releases are
+    used.
+
+    :returns: str -- The app path.
+    """
+
+    from deploy.conf import settings
+
+    if settings.USE_RELEASES():
+        return settings.CURRENT_PATH()
+    return settings.SRC_PATH()
+
+
+def _app_names():
+    """ Names of the apps in the ecosystem file on the current host.
+
+    :returns: list -- The app names.
+    """
+
+    from deploy.conf import settings
+
+    with cd(_app_path()), fab_settings(hide('everything'), warn_only=True):
+        ecosystem = run('cat {0}'.format(settings.PM2_ECOSYSTEM()))
+
+    try:
+        return [app['name'] for app in json.loads(ecosystem)['apps']]
+    except (ValueError, KeyError, TypeError):
+        raise FabricException('Could not read the apps from {0}'.format(
+            settings.PM2_ECOSYSTEM()))
+
+
+def _processes(names):
+    """ Get the pm2 processes of some apps along with the time on the host.
+
+    :param names: The app names.
+    :type names: list
+
+    :returns: tuple -- Milliseconds since the epoch on the host and the
+        processes ``pm2 jlist`` reports for the apps.
+    """
+
+    with fab_settings(hide('everything'), warn_only=True):
+        output = run('{0}; pm2 jlist && echo && __velcro_ms'.format(_CLOCK))
+
+    lines = output.splitlines()
+    try:
+        now = int(lines[-1])
+        processes = json.loads([line for line in lines
+                                if line.startswith('[')][-1])
+    except (ValueError, IndexError):
+        return None, []
+
+    return now, [p for p in processes if p.get('name') in names]
+
+
+def health_check(timeout=None, min_uptime=None):
+    """
+    Wait for every process of the apps in the ecosystem file to be online
+    and to have stayed up for ``min_uptime`` seconds.
+
+    **Usage:**
+
+    .. code-block:: none
+
+        fab live health_check
+
+    :param timeout: Seconds to wait, defaults to ``env.pm2_health_timeout``
+    :type timeout: int
+
+    :param min_uptime: Seconds a process must have been up, defaults to
+        ``env.pm2_min_uptime``
+    :type min_uptime: int
+
+    :returns: bool -- True if all the processes are healthy.
+    """
+
+    from deploy.conf import settings
+
+    timeout = float(timeout or settings.PM2_HEALTH_TIMEOUT())
+    min_uptime = float(min_uptime or settings.PM2_MIN_UPTIME()) * 1000
+    names = _app_names()
+    deadline = time.time() + timeout
+
+    while True:
+        now, processes = _processes(names)
+        found = set(p['name'] for p in processes)
+        waiting = [p for p in processes
+                   if p['pm2_env'].get('status') != 'online' or
+                   now - p['pm2_env'].get('pm_uptime', now) < min_uptime]
+
+        if processes and found == set(names) and not waiting:
+            puts(green('[PM2] Healthy: {0}'.format(', '.join(names))))
+            return True
+
+        if time.time() > deadline:
+            _print_error('pm2 apps not healthy after {0:.0f}s: {1}'.format(
+                timeout, ', '.join(
+                    ['{0} {1}'.format(p['name'], p['pm2_env'].get('status'))
+                     for p in waiting] +
+                    ['{0} missing'.format(name)
+                     for name in names if name not in found])))
+            return False
+
+        time.sleep(1)
+
+
+def reload_pm2():
+    """
+    Gracefully reload the pm2 apps in ``settings.PM2_ECOSYSTEM()``,
+    starting them if they are not running, then wait for them to be
+    healthy.
+
+    :returns: bool -- True if the apps are healthy after the reload.
+    """
+
+    from deploy.conf import settings
+
+    try:
+        ecosystem = settings.PM2_ECOSYSTEM()
+        target = settings.TARGET()
+        path = _app_path()
+        puts(yellow('[PM2] Reloading'))
+        with cd(path):
+            run('pm2 startOrReload {0} --env {1}'.format(ecosystem, target))
+        return health_check()
+    except FabricException as e:
+        _print_error(e)
+        return False
+
+
+def _reload_host():
+    """ Reload the current host, failing if it does not come back healthy.
+
+    :returns: bool -- True.
+    """
+
+    if not reload_pm2():
+        raise FabricException('Unhealthy after reload')
+    return True
+
+
+@runs_once
+def rolling_reload(max_unavailable=None, timeout=None):
+    """
+    Gracefully reload pm2 on every host, ``max_unavailable`` hosts at a
+    time. Each group has to come back healthy before the next one is
+    reloaded, the reload stops at the first group that does not.
+
+    **Usage:**
+
+    .. code-block:: none
+
+        fab live rolling_reload
+        fab live rolling_reload:max_unavailable=2
+
+    :param max_unavailable: Hosts reloaded at once, defaults to
+        ``env.pm2_max_unavailable``
+    :type max_unavailable: int
+
+    :param timeout: Seconds allowed per host, defaults to
+        ``env.deploy_host_timeout``
+    :type timeout: int
+
+    :returns: dict -- Per host results.
+    """
+
+    from deploy.conf import settings
+    from deploy.parallel import run_parallel
+
+    size = max(1, int(max_unavailable or settings.PM2_MAX_UNAVAILABLE()))
+    timeout = int(timeout or settings.DEPLOY_HOST_TIMEOUT() or 0)
+    hosts = env.all_hosts or env.hosts
+
+    puts(blue('[PM2] Reloading {0} hosts, {1} at a time'.format(
+        len(hosts), size)))
+
+    results = {}
+    for i in range(0, len(hosts), size):
+        group = hosts[i:i + size]
+        results.update(run_parallel(_reload_host, group, pool_size=size,
+                                    timeout=timeout))
+        if any(results[host]['status'] != 'ok' for host in group):
+            break
+
+    _print_table(['Host', 'Duration', 'Result'], [
+        [host, '{0:.1f}s'.format(results[host]['duration']),
+         results[host]['error'] or results[host]['status']]
+        if host in results else [host, '-', 'not reloaded']
+        for host in hosts])
+
+    failed = [host for host in hosts
+              if host in results and results[host]['status'] != 'ok']
+    if failed:
+        puts(red('[PM2] Rolling reload stopped, failed on: {0}'.format(
+            ', '.join(failed))))
+
+    return results
@@ -0,0 +1,157 @@
+"""
+.. module:: release
+   :synopsis: Release directories with an atomically swapped current link.
+
+Each deploy exports the commit into ``releases/<timestamp>`` and then
+points ``current`` at it, so the running code never sees a half checked
+out tree. This is the default, the apps run from ``current`` and
+``settings.SRC_PATH()`` only holds the repository the releases are
+exported from. Rolling back only moves the link, the running apps keep the code
+they loaded until they are reloaded.
+
+"""
+
+import os
+
+from fabric.colors import blue, green, yellow
+from fabric.context_managers import hide, settings as fab_settings
+from fabric.state import env
+from fabric.utils import puts
+
+from . import FabricException
+from batch import Batch
+from decorators import pre_hooks, post_hooks
+from deps import _install_steps, _report_installs
+from store import _stage_release, _report_reuse
+from utils import _print_error, _symlink
+
+
+def _log_line(action):
+    """ Shell command appending a line to the rollback log for the release
+    named by ``$release``.
+
+    :param action: What happened to the release, deploy or rollback.
+    :type action: str
+
+    :returns: str -- The command.
+    """
+
+    from conf import settings
+
+    return 'mkdir -p {log_dir} && echo "{now}\t{action}\t$release\t'\
+           '$(cat {releases}/$release/REVISION)\t{user}" >> {log}'.format(
+               log_dir=os.path.dirname(settings.ROLLBACK_LOG()),
+               now=settings.NOW_STR(), action=action,
+               releases=settings.RELEASES_PATH(), user=env.local_user,
+               log=settings.ROLLBACK_LOG())
+
+
+def create_release(commit):
+    """ Export a commit from ``settings.SRC_PATH()`` as a new release, make
+    it current and remove old releases, in a single round trip.
+
+    Files unchanged since the current release are hardlinked from it, see
+    ``deploy.store``, and dependencies are installed before the release is
+    made current, see ``deploy.deps``.
+
+    Only the newest ``env.keep_releases`` releases are kept, the current
+    release is never removed.
+
+    :param commit: The commit to release.
+    :type commit: str
+
+    :returns: str -- The release path.
+    """
+
+    from conf import settings
+
+    release = settings.NOW()
+    release_path = os.path.join(settings.RELEASES_PATH(), release)
+    keep = int(settings.KEEP_RELEASES())
+
+    puts(blue('[RELEASE] Creating ') + green(release_path))
+
+    batch = Batch()
+    _stage_release(batch, commit, release_path)
+    _install_steps(batch, release_path)
+    _symlink(release_path, settings.CURRENT_PATH(), batch=batch, atomic=True)
+    batch.add('release={0} && {1}'.format(release, _log_line('deploy')))
+    batch.add('ls -1 | sort -r | grep -vx {0} | tail -n +{1} | '
+              'xargs rm -rf'.format(release, keep),
+              cwd=settings.RELEASES_PATH())
+    results = batch.run()
+    _report_reuse(results[0]['stdout'])
+    _report_installs(results)
+
+    return release_path
+
+
+@pre_hooks()
+@post_hooks()
+def rollback(release=None, **kwargs):
+    """ Point ``current`` back at an earlier release, in a single round
+    trip. The rollback is recorded in ``settings.ROLLBACK_LOG()``.
+
+    Only the link is moved, the apps are not reloaded. Pass a reload as a
+    post hook, like ``deploy.process.pm2.reload_pm2``, to run the release
+    rolled back to.
+
+    .. note::
+        Supports pre and post hooks
+
+    **Usage:**
+
+    .. code-block:: none
+
+        # The release before the current one
+        fab live rollback
+
+        # A specific release
+        fab live rollback:1480000000
+
+        # Reloading pm2 to run it
+        fab live rollback:post=deploy.process.pm2.reload_pm2
+
+    :param release: The release to roll back to, defaults to the one
+        before the current release.
+    :type release: str
+
+    :returns: str -- The release now current.
+    """
+
+    from conf import settings
+
+    try:
+        releases = settings.RELEASES_PATH()
+        current = settings.CURRENT_PATH()
+    except FabricException as e:
+        _print_error(e)
+        return
+
+    if release:
+        choose = 'release={0}'.format(release)
+    else:
+        choose = 'release=$(ls -1 | sort | grep -B1 -x "$(basename '\
+                 '$(readlink {0}))" | head -n 1)'.format(current)
+
+    command = '{choose} && [ -n "$release" ] && [ -d "$release" ] && '\
+              '[ "{releases}/$release" != "$(readlink {current})" ] && '\
+              'ln -sfn {releases}/$release {current}.tmp && '\
+              'mv -Tf {current}.tmp {current} && {log} && '\
+              'echo "$release"'.format(choose=choose, releases=releases,
+                                       current=current,
+                                       log=_log_line('rollback'))
+
+    puts(yellow('[RELEASE] Rolling back'))
+    with fab_settings(hide('warnings'), warn_only=True):
+        result = Batch().add(command, cwd=releases).run()[0]
+
+    if result['exit_code']:
+        _print_error('No release to roll back to{0}'.format(
+            ': {0}'.format(release) if release else ''))
+        return
+
+    release = result['stdout'].strip().splitlines()[-1]
+    puts(blue('[RELEASE] Current release: ') + green(release))
+
+    return release
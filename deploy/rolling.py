@@ -0,0 +1,287 @@
+"""
+.. module:: rolling
+   :synopsis: Rolling deploys in health checked waves.
+
+"""
+
+import math
+import time
+
+from fabric.colors import blue, green, yellow
+from fabric.context_managers import cd, hide, settings as fab_settings
+from fabric.api import run
+from fabric.decorators import runs_once
+from fabric.network import to_dict
+from fabric.state import env
+from fabric.utils import puts
+
+from . import FabricException
+from hooks import _call_hooks, _resolve
+from parallel import run_parallel
+from utils import _bool, _print_error, _print_table
+
+
+def _wave_size(batch, total):
+    """ Number of hosts in each wave.
+
+    :param batch: A number of hosts, or a percentage of them like ``25%``.
+    :type batch: str or int
+
+    :param total: The number of hosts being deployed.
+    :type total: int
+
+    :returns: int -- The wave size.
+    """
+
+    batch = str(batch).strip()
+    if batch.endswith('%'):
+        return max(1, int(math.ceil(total * float(batch[:-1]) / 100)))
+    return max(1, int(batch))
+
+
+def _check_host(check):
+    """ Run the health check hook on the current host.
+
+    :param check: Dotted path of the health check, it fails by returning
+        False or raising.
+    :type check: str
+
+    :returns: float -- Seconds until the check passed, the whole check,
+        including any time it waits for the host to settle.
+    """
+
+    func, error = _resolve(check)
+    if error:
+        raise FabricException(error)
+
+    started = time.time()
+    if func() is False:
+        raise FabricException('Health check failed')
+    return time.time() - started
+
+
+def _release_of(previous):
+    """ Find the newest release of a commit on the current host.
+
+    :param previous: The commit.
+    :type previous: str
+
+    :returns: tuple -- The release name, None if there is none, and
+        whether it is the current release.
+    """
+
+    from conf import settings
+
+    with fab_settings(hide('everything'), warn_only=True):
+        found = run('cd {0} && basename "$(readlink {1})"; grep -lx {2} '
+                    '*/REVISION | tail -n 1'.format(
+                        settings.RELEASES_PATH(), settings.CURRENT_PATH(),
+                        previous))
+
+    lines = [line.strip() for line in found.splitlines()]
+    if len(lines) < 2 or not lines[-1].endswith('/REVISION'):
+        return None, False
+
+    release = lines[-1][:-len('/REVISION')]
+    return release, lines[0] == release
+
+
+def _restore_host(heads, commit, post=None):
+    """ Put the current host back on the commit it was at before the
+    rollout, then run the post hooks of the deploy again.
+
+    With releases, ``current`` is pointed at the newest release of that
+    commit. A host whose deploy failed before its release was made is
+    already there and is left alone.
+
+    :param heads: The commit each host was at.
+    :type heads: dict
+
+    :param commit: The commit the rollout deployed.
+    :type commit: str
+
+    :param post: The post hooks of the deploy, ``|`` separated.
+    :type post: str
+
+    :returns: str -- The commit restored.
+    """
+
+    from conf import settings
+    from release import rollback
+    from scm.bundle import _record_deployed
+
+    previous = heads.get(env.host_string)
+    if not previous:
+        raise FabricException('Previous commit not known')
+
+    if settings.USE_RELEASES():
+        release, current = _release_of(previous)
+        if release is None:
+            raise FabricException('No release of {0} to roll back '
+                                  'to'.format(previous[:7]))
+        if current:
+            return previous
+        if not rollback(release):
+            raise FabricException('Rolling back to {0} failed'.format(
+                release))
+    else:
+        with cd(settings.SRC_PATH()):
+            run('git reset --hard {0}'.format(previous))
+
+    env.deploy_range = (commit, previous)
+    if post:
+        _call_hooks(post.split('|'))
+
+    _record_deployed(env.host_string, previous)
+
+    return previous
+
+
+@runs_once
+def rolling_deploy(branch, batch=None, max_error_rate=None, max_latency=None,
+                   force=False, **kwargs):
+    """ Deploy project code using git in waves of hosts.
+
+    The hosts of a wave are deployed at once, then the health check in
+    ``env.rolling_health_check`` is run on each of them. The rollout
+    halts when the share of hosts deployed so far that failed to deploy or
+    failed their check goes over ``max_error_rate``, or the slowest host
+    of a wave takes longer than ``max_latency`` seconds to pass its check.
+    That is the whole check, for the pm2 check including the
+    ``env.pm2_min_uptime`` it waits for the apps to stay up. Every host
+    deployed by the rollout is then put back on the commit it was at.
+
+    Hosts already at the commit are left alone unless ``force`` is set.
+
+    .. note::
+        Supports pre and post hooks, they run once per host.
+
+    **Usage:**
+
+    .. code-block:: none
+
+        fab live rolling_deploy:master
+        fab live rolling_deploy:master,batch=25%,max_error_rate=0.1
+
+    :param branch: Branch to deploy HEAD from
+    :type branch: str
+
+    :param batch: Hosts per wave, a number or a percentage, defaults to
+        ``env.rolling_batch``
+    :type batch: str
+
+    :param max_error_rate: Share of failed hosts tolerated, defaults to
+        ``env.rolling_max_error_rate``
+    :type max_error_rate: float
+
+    :param max_latency: Seconds a host may take to pass its health check,
+        defaults to ``env.rolling_max_latency``
+    :type max_latency: float
+
+    :param force: Deploy hosts that are already at the commit too.
+    :type force: bool
+
+    :returns: dict -- Per host results.
+    """
+
+    from conf import settings
+    from scm.bundle import _prepare_bundle, _seed_bundle, _record_deployed
+    from scm.git import DeploySession, _deploy_host
+
+    if max_error_rate is None:
+        max_error_rate = settings.ROLLING_MAX_ERROR_RATE()
+    max_error_rate = float(max_error_rate)
+    max_latency = float(max_latency or settings.ROLLING_MAX_LATENCY())
+    timeout = int(settings.DEPLOY_HOST_TIMEOUT() or 0)
+    check = settings.ROLLING_HEALTH_CHECK()
+
+    session = DeploySession.get(branch)
+    commit = session.commit
+    hosts = env.all_hosts or env.hosts
+    heads = session.probe(hosts)
+    changed = list(hosts) if _bool(force) else session.changed_hosts(hosts)
+
+    size = _wave_size(batch or settings.ROLLING_BATCH(), len(changed) or 1)
+    puts(blue('[ROLLING] Deploying {0} to {1} of {2} hosts, {3} per '
+              'wave'.format(commit[:7], len(changed), len(hosts), size)))
+
+    if changed and settings.DEPLOY_TRANSFER() == 'bundle':
+        _prepare_bundle(session, changed)
+        if session.bundle and settings.BUNDLE_FANOUT() != 'local':
+            with fab_settings(**to_dict(changed[0])):
+                _seed_bundle(session)
+
+    rows = dict((host, [host, '-', '-', '-', 'not deployed'
+                        if host in changed else 'unchanged'])
+                for host in hosts)
+    deployed = []
+    failed = 0
+    halted = None
+
+    for wave, i in enumerate(range(0, len(changed), size), 1):
+        group = changed[i:i + size]
+        puts(blue('[ROLLING] Wave {0}: {1}'.format(wave, ', '.join(group))))
+
+        results = run_parallel(_deploy_host, group, args=(branch, commit),
+                               kwargs=kwargs, pool_size=size,
+                               timeout=timeout)
+        healthy = [host for host in group if results[host]['status'] == 'ok']
+        checks = run_parallel(_check_host, healthy, args=(check,),
+                              pool_size=size, timeout=timeout)
+
+        latency = 0.0
+        for host in group:
+            deployed.append(host)
+            rows[host][1:] = [wave, '{0:.1f}s'.format(
+                results[host]['duration']), '-', 'ok']
+            if host not in checks:
+                failed += 1
+                rows[host][4] = results[host]['error'] or \
+                    results[host]['status']
+            elif checks[host]['status'] != 'ok':
+                failed += 1
+                rows[host][3] = '{0:.1f}s'.format(checks[host]['duration'])
+                rows[host][4] = checks[host]['error'] or 'unhealthy'
+            else:
+                latency = max(latency, checks[host]['result'])
+                rows[host][3] = '{0:.1f}s'.format(checks[host]['result'])
+
+        error_rate = float(failed) / len(deployed)
+        if error_rate > max_error_rate:
+            halted = 'error rate {0:.0%} over {1:.0%}'.format(
+                error_rate, max_error_rate)
+        elif latency > max_latency:
+            halted = 'healthy after {0:.1f}s, over {1:.1f}s'.format(
+                latency, max_latency)
+        if halted:
+            break
+        puts(green('[ROLLING] Wave {0} healthy'.format(wave)))
+
+    for host in hosts:
+        if host not in changed:
+            _record_deployed(host, commit)
+
+    if halted:
+        _print_error('Rollout halted, {0}. Rolling back {1} hosts'.format(
+            halted, len(deployed)))
+        restored = run_parallel(_restore_host, deployed,
+                                args=(heads, commit, kwargs.get('post')),
+                                pool_size=size, timeout=timeout)
+        for host in deployed:
+            if restored[host]['status'] == 'ok':
+                rows[host][4] = 'rolled back to {0}'.format(
+                    restored[host]['result'][:7])
+            else:
+                rows[host][4] = 'rollback failed: {0}'.format(
+                    restored[host]['error'] or restored[host]['status'])
+
+    _print_table(['Host', 'Wave', 'Deploy', 'Healthy after', 'Result'],
+                 [rows[host] for host in hosts])
+
+    if not halted:
+        puts(green('[ROLLING] {0} hosts deployed'.format(len(deployed))))
+    elif failed:
+        puts(yellow('[ROLLING] {0} of {1} hosts failed'.format(
+            failed, len(deployed))))
+
+    return rows
@@ -0,0 +1,250 @@
+"""
+.. module:: bundle
+   :synopsis: Git bundle based code transfer.
+
+"""
+
+import os
+
+from fabric.api import run, local, put
+from fabric.colors import blue, yellow
+from fabric.context_managers import cd, hide, settings as fab_settings
+from fabric.state import env
+from fabric.utils import puts
+
+from deploy import FabricException
+from deploy.utils import _print_error
+
+_agent = {}
+
+
+def _record_path(host):
+    """ Local file recording the commit last deployed to a host.
+
+    :param host: The host string.
+    :type host: str
+
+    :returns: str -- The record path.
+    """
+
+    from deploy.conf import settings
+
+    return os.path.join(settings.BUNDLE_CACHE_DIR(), 'deployed',
+                        settings.TARGET(), host)
+
+
+def _deployed_commit(host):
+    """ Get the commit last deployed to a host.
+
+    :param host: The host string.
+    :type host: str
+
+    :returns: str -- The commit, or None if the host has no record.
+    """
+
+    try:
+        with open(_record_path(host), 'r') as f:
+            return f.read().strip() or None
+    except IOError:
+        return None
+
+
+def _record_deployed(host, commit):
+    """ Record the commit deployed to a host.
+
+    :param host: The host string.
+    :type host: str
+
+    :param commit: The deployed commit.
+    :type commit: str
+    """
+
+    path = _record_path(host)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(commit)
+
+
+def _bundle_basis(commit, hosts, heads=None):
+    """ Find the newest commit every host already has.
+
+    :param commit: The commit being deployed.
+    :type commit: str
+
+    :param hosts: The hosts being deployed to.
+    :type hosts: list
+
+    :param heads: The commit each host was probed at, used instead of the
+        local records of what was deployed.
+    :type heads: dict
+
+    :returns: str -- The basis commit, or None if a full bundle is needed.
+    """
+
+    if heads is not None:
+        deployed = [heads.get(host) for host in hosts]
+    else:
+        deployed = [_deployed_commit(host) for host in hosts]
+    if not deployed or None in deployed:
+        return None
+
+    with fab_settings(hide('everything'), warn_only=True):
+        basis = local('git merge-base --octopus {0} {1}'.format(
+            commit, ' '.join(sorted(set(deployed)))), capture=True)
+
+    return basis.strip() if basis.succeeded and basis.strip() else None
+
+
+def _prepare_bundle(session, hosts):
+    """ Build the bundle for a deploy session, once.
+
+    Bundles are kept in ``settings.BUNDLE_CACHE_DIR()`` and reused when the
+    same basis and commit come up again. When every host already has the
+    commit no bundle is built and the hosts count as fetched.
+
+    :param session: The deploy session.
+    :type session: DeploySession
+
+    :param hosts: The hosts being deployed to, the first is the seed.
+    :type hosts: list
+    """
+
+    from deploy.conf import settings
+
+    if session.bundle_hosts is not None:
+        return
+
+    session.bundle_hosts = list(hosts)
+    basis = _bundle_basis(session.commit, hosts, session.heads)
+    if basis == session.commit:
+        puts(blue('[GIT] All hosts already have {0}'.format(
+            session.commit[:7])))
+        session.bundle_current = True
+        return
+
+    name = '{0}-{1}.bundle'.format(basis[:12] if basis else 'full',
+                                   session.commit[:12])
+    path = os.path.join(settings.BUNDLE_CACHE_DIR(), name)
+
+    if not os.path.exists(path):
+        if not os.path.isdir(settings.BUNDLE_CACHE_DIR()):
+            os.makedirs(settings.BUNDLE_CACHE_DIR())
+        puts(blue('[GIT] Bundling {0}{1}'.format(
+            '{0}..'.format(basis[:7]) if basis else '', session.commit[:7])))
+        local('git bundle create {0} {1}{2}'.format(
+            path, session.branch, ' ^{0}'.format(basis) if basis else ''))
+
+    puts(blue('[GIT] Bundle size: {0:.1f} KB'.format(
+        os.path.getsize(path) / 1024.0)))
+    session.bundle = path
+
+
+def _remote_bundle_path(session):
+    """ Path of the session bundle on the hosts.
+    """
+
+    from deploy.conf import settings
+
+    return os.path.join(settings.BUNDLE_PATH(),
+                        os.path.basename(session.bundle))
+
+
+def _seed_bundle(session):
+    """ Upload the session bundle to the current host, the only upload
+    from the operator in ``host`` fan out mode.
+
+    :param session: The deploy session.
+    :type session: DeploySession
+    """
+
+    from deploy.conf import settings
+
+    remote = _remote_bundle_path(session)
+    run('mkdir -p {0}'.format(settings.BUNDLE_PATH()))
+    puts(blue('[GIT] Uploading bundle to ') + yellow(env.host_string))
+    put(session.bundle, remote)
+    session.bundle_seeded = True
+
+
+def _agent_available():
+    """ Whether a local SSH agent with keys is running, for the hosts to
+    use when they copy the bundle from the seed. Checked once per process.
+
+    :returns: bool -- True if the agent can be forwarded.
+    """
+
+    if 'forward' not in _agent:
+        with fab_settings(hide('everything'), warn_only=True):
+            _agent['forward'] = bool(os.environ.get('SSH_AUTH_SOCK')) and \
+                local('ssh-add -l', capture=True).succeeded
+    return _agent['forward']
+
+
+def _fetch_bundle(session):
+    """ Get the session bundle onto the current host and fetch the branch
+    from it.
+
+    The seed host, and every host when ``env.bundle_fanout`` is ``local``,
+    gets the bundle uploaded from the local cache. The other hosts copy it
+    from the seed with ``scp`` using the forwarded agent, falling back to
+    an upload if there is no local agent with keys to forward or the hosts
+    cannot reach each other.
+
+    Hosts that all had the commit already, see ``_prepare_bundle``, count
+    as fetched without doing anything.
+
+    :param session: The deploy session.
+    :type session: DeploySession
+
+    :returns: bool -- True if the branch was fetched, False if the caller
+        should fall back to a push.
+    """
+
+    from deploy.conf import settings
+
+    if session.bundle_current:
+        return True
+    if not session.bundle:
+        return False
+
+    remote = _remote_bundle_path(session)
+    seed = session.bundle_hosts[0]
+
+    try:
+        if settings.BUNDLE_FANOUT() == 'local' or env.host_string == seed:
+            if env.host_string != seed or not session.bundle_seeded:
+                _seed_bundle(session)
+        elif not _agent_available():
+            puts(yellow('[GIT] No SSH agent to copy the bundle from the '
+                        'seed with, uploading'))
+            _seed_bundle(session)
+        else:
+            puts(blue('[GIT] Copying bundle from ') + yellow(seed))
+            run('mkdir -p {0}'.format(settings.BUNDLE_PATH()))
+            with fab_settings(forward_agent=True, warn_only=True):
+                copied = run('scp -q -o BatchMode=yes {user}@{seed}:{path} '
+                             '{path}'.format(
+                                 user=settings.USER(),
+                                 seed=seed.split('@')[-1].split(':')[0],
+                                 path=remote))
+            if copied.failed:
+                puts(yellow('[GIT] Copy from seed failed, uploading'))
+                _seed_bundle(session)
+
+        with cd(settings.SRC_PATH()), fab_settings(warn_only=True):
+            fetched = run('git fetch -q --update-head-ok {0} '
+                          '+refs/heads/{1}:refs/heads/{1}'.format(
+                              remote, session.branch))
+            run('find {0} -name "*.bundle" ! -name {1} -delete'.format(
+                settings.BUNDLE_PATH(), os.path.basename(remote)))
+    except FabricException as e:
+        _print_error(e)
+        return False
+
+    if fetched.failed:
+        _print_error('Bundle fetch failed on {0}, falling back to '
+                     'push'.format(env.host_string))
+        return False
+
+    return True
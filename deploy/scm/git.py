@@ -8,15 +8,20 @@
 
 from __future__ import unicode_literals
 
-from fabric.api import run, local, prompt
+from fabric.api import run, local
 from fabric.colors import blue, yellow, red
-from fabric.context_managers import cd
+from fabric.context_managers import (cd, hide, shell_env,
+                                     settings as fab_settings)
+from fabric.decorators import runs_once
+from fabric.network import to_dict
 from fabric.utils import puts
 from fabric.state import env
 
 from deploy import FabricException
+from deploy.answers import answer
+from deploy.batch import Batch
 from deploy.decorators import pre_hooks, post_hooks
-from deploy.utils import _print_error
+from deploy.utils import _bool, _print_error, _print_table
 
 
 def clean():
@@ -26,9 +31,8 @@ def clean():
     from deploy.conf import settings
 
     try:
-        with cd(settings.SRC_PATH()):
-            puts(blue('[GIT] Cleaning'))
-            run("git clean -df")
+        puts(blue('[GIT] Cleaning'))
+        Batch().add('git clean -df', cwd=settings.SRC_PATH()).run()
     except FabricException as e:
         _print_error(e)
 
@@ -37,70 +41,422 @@ def update_submodules():
     """ Update git submodules
     """
 
-    from conf import settings
+    from deploy.conf import settings
 
     try:
-        with cd(settings.SRC_PATH()):
-            puts(blue('[GIT] Updating sub modules'))
-            run('git submodule update --init')
+        puts(blue('[GIT] Updating sub modules'))
+        Batch().add('git submodule update --init',
+                    cwd=settings.SRC_PATH()).run()
     except FabricException as e:
         _print_error(e)
 
 
-@pre_hooks()
-@post_hooks()
-def deploy(branch, **kwargs):
+def deploy(branch, force=False, **kwargs):
     """ Deploy project code using git.
 
+    Every host is probed for the commit it is at first, hosts already at
+    the commit being deployed are skipped, hooks included, unless ``force``
+    is set.
+
     .. note::
-        Supports pre and post hooks.
+        Supports pre and post hooks. They run for each host deployed,
+        after the commit has been resolved and the branch checks answered.
+
+    **Usage:**
+
+    .. code-block:: none
+
+        fab live deploy:master
+        fab live deploy:master,force=1
 
     :param banch: Branch to deploy HEAD from
     :type branch: str
+
+    :param force: Deploy hosts that are already at the commit too.
+    :type force: bool
+
+    :returns: str -- The deployed commit.
+    """
+
+    session = DeploySession.get(branch)
+    hosts = env.all_hosts or env.hosts or [env.host_string]
+
+    if not _bool(force) and session.probe(hosts).get(env.host_string) == \
+            session.commit:
+        puts(blue('[GIT] Already at {0}, skipping'.format(
+            session.commit[:7])))
+        commit = session.commit
+    else:
+        try:
+            commit = _deploy_host(branch, session.commit, **kwargs)
+        except FabricException as e:
+            _print_error(e)
+            commit = None
+
+    if env.host_string == hosts[-1]:
+        session.summary(hosts)
+
+    return commit
+
+
+@runs_once
+def parallel_deploy(branch, pool_size=None, timeout=None, max_failures=None,
+                    force=False, **kwargs):
+    """ Deploy project code using git to all hosts at once.
+
+    The deploy session is resolved once and every host probed for the
+    commit it is at, then every host not already at the commit
+    is deployed by a bounded pool of workers. Hosts that take longer than
+    ``timeout`` seconds are stopped, and once more than ``max_failures``
+    hosts have failed no further hosts are started.
+
+    .. note::
+        Supports pre and post hooks, they run once per host.
+
+    **Usage:**
+
+    .. code-block:: none
+
+        fab live parallel_deploy:master,pool_size=4,timeout=120,max_failures=1
+
+    :param branch: Branch to deploy HEAD from
+    :type branch: str
+
+    :param pool_size: Maximum number of hosts deployed at once, defaults to
+        ``env.deploy_pool_size``
+    :type pool_size: int
+
+    :param timeout: Seconds allowed per host, defaults to
+        ``env.deploy_host_timeout``
+    :type timeout: int
+
+    :param max_failures: Failed hosts tolerated before the rollout stops,
+        defaults to ``env.deploy_max_failures``
+    :type max_failures: int
+
+    :param force: Deploy hosts that are already at the commit too.
+    :type force: bool
+
+    :returns: dict -- Per host results.
     """
 
     from deploy.conf import settings
+    from deploy.parallel import run_parallel
+    from deploy.scm.bundle import (_prepare_bundle, _seed_bundle,
+                                   _record_deployed)
+
+    pool_size = int(pool_size or settings.DEPLOY_POOL_SIZE())
+    timeout = int(timeout or settings.DEPLOY_HOST_TIMEOUT() or 0)
+    if max_failures is None:
+        max_failures = settings.DEPLOY_MAX_FAILURES()
+    max_failures = int(max_failures)
+
+    session = DeploySession.get(branch)
+    commit = session.commit
+
+    hosts = env.all_hosts or env.hosts
+    if _bool(force):
+        changed = list(hosts)
+    else:
+        session.probe(hosts)
+        changed = session.changed_hosts(hosts)
+    puts(blue('[GIT] Deploying {0} to {1} of {2} hosts, {3} at a '
+              'time'.format(commit[:7], len(changed), len(hosts),
+                            pool_size)))
+
+    if changed and settings.DEPLOY_TRANSFER() == 'bundle':
+        _prepare_bundle(session, changed)
+        if session.bundle and settings.BUNDLE_FANOUT() != 'local':
+            with fab_settings(**to_dict(changed[0])):
+                _seed_bundle(session)
+
+    results = run_parallel(_deploy_host, changed, args=(branch, commit),
+                           kwargs=kwargs, pool_size=pool_size,
+                           timeout=timeout, max_failures=max_failures)
+    for host in hosts:
+        if host not in results:
+            _record_deployed(host, commit)
+            results[host] = {'host': host, 'status': 'ok', 'result': commit,
+                             'error': None, 'duration': 0.0}
+
+    heads = session.heads or {}
+    _print_table(['Host', 'Duration', 'Was', 'Now', 'Result'], [
+        [host, '{0:.1f}s'.format(results[host]['duration']),
+         (heads.get(host) or '-')[:7], (results[host]['result'] or '-')[:7],
+         results[host]['error'] or ('changed' if host in changed
+                                    else 'unchanged')]
+        for host in hosts])
+
+    failed = [host for host in hosts if results[host]['status'] != 'ok']
+    if len(failed) > max_failures:
+        _print_error('Rollout halted, {0} of {1} hosts failed: {2}'.format(
+            len(failed), len(hosts), ', '.join(failed)))
+    elif failed:
+        puts(yellow('[GIT] {0} hosts failed, within the threshold of '
+                    '{1}'.format(len(failed), max_failures)))
+
+    return results
+
+
+class DeploySession(object):
+
+    """ Deploy state shared by every host in a single ``fab`` run.
+
+    Fabric calls ``deploy`` once per host, the session makes sure the
+    local commit lookup, the ROBO NAG questions and the probe of the commit
+    each host is at only happen for the first of them.
+
+    .. note::
+       Do not call this directly, use:
+       DeploySession.get(branch)
+    """
+
+    def __init__(self, branch):
+        """ Resolve the commit and run the branch checks.
+        """
+
+        self.branch = branch
+        self.target = getattr(env, 'target', None)
+        self.commit = _resolve_commit(branch)
+        self.decisions = _branch_checks(branch)
+
+        # Set by probe()
+        self.heads = None
+
+        # Set by deploy.scm.bundle when deploy_transfer is 'bundle'
+        self.bundle = None
+        self.bundle_hosts = None
+        self.bundle_seeded = False
+        self.bundle_current = False
+
+    def probe(self, hosts):
+        """ Get the commit every host is at, probing them all at once the
+        first time.
+
+        :param hosts: The hosts being deployed to.
+        :type hosts: list
+
+        :returns: dict -- Host string to its commit, None when it is not
+            known.
+        """
+
+        if self.heads is None:
+            self.heads = _probe_heads(hosts)
+        return self.heads
+
+    def changed_hosts(self, hosts):
+        """ Get the hosts not already at the session commit.
+
+        :param hosts: The hosts being deployed to.
+        :type hosts: list
+
+        :returns: list -- The hosts to deploy.
+        """
+
+        heads = self.heads or {}
+        return [host for host in hosts if heads.get(host) != self.commit]
+
+    def summary(self, hosts):
+        """ Print which hosts were changed by the deploy and which were
+        already at the commit.
+
+        :param hosts: The hosts being deployed to.
+        :type hosts: list
+        """
+
+        if self.heads is None:
+            return
+
+        changed = self.changed_hosts(hosts)
+        _print_table(['Host', 'Was', 'Now', 'Result'], [
+            [host, (self.heads.get(host) or '-')[:7], self.commit[:7],
+             'changed' if host in changed else 'unchanged']
+            for host in hosts])
+        puts(blue('[GIT] {0} changed, {1} unchanged'.format(
+            len(changed), len(hosts) - len(changed))))
+
+    @classmethod
+    def get(cls, branch):
+        """ Get the session for the branch and current target, creating it
+        on first use.
 
-    commit = local('git log -1 --format=format:%H {0}'.format(branch),
-                   capture=True)
+        :param branch: The branch being deployed.
+        :type branch: str
 
-    if 'live' == env.target and 'master' != branch:
+        :returns: DeploySession -- The shared session.
+        """
+
+        sessions = env.setdefault('deploy_sessions', {})
+        key = (getattr(env, 'target', None), branch)
+        if key not in sessions:
+            sessions[key] = cls(branch)
+        return sessions[key]
+
+
+def _head():
+    """ Get the commit the current host is deployed at.
+
+    That is the ``REVISION`` of the current release when releases are
+    used, otherwise the ``HEAD`` of ``settings.SRC_PATH()`` as long as no
+    tracked file has been changed.
+
+    :returns: str -- The commit, or None if it can not be told.
+    """
+
+    from deploy.conf import settings
+
+    try:
+        if settings.USE_RELEASES():
+            command = 'cat {0}/REVISION'.format(settings.CURRENT_PATH())
+        else:
+            command = 'cd {0} && [ -z "$(git status --porcelain -uno)" ] && '\
+                      'git rev-parse -q --verify HEAD'.format(
+                          settings.SRC_PATH())
+    except FabricException:
+        return None
+
+    with fab_settings(hide('everything'), warn_only=True):
+        head = run(command)
+
+    return head.strip() if head.succeeded and head.strip() else None
+
+
+def _probe_heads(hosts):
+    """ Get the commit every host is deployed at, all hosts at once.
+
+    :param hosts: The hosts to probe.
+    :type hosts: list
+
+    :returns: dict -- Host string to its commit, None when it is not
+        known.
+    """
+
+    from deploy.conf import settings
+    from deploy.parallel import run_parallel
+
+    puts(blue('[GIT] Probing {0} hosts'.format(len(hosts))))
+
+    if len(hosts) == 1:
+        with fab_settings(**to_dict(hosts[0])):
+            return {hosts[0]: _head()}
+
+    results = run_parallel(_head, hosts,
+                           pool_size=settings.DEPLOY_POOL_SIZE(),
+                           timeout=settings.DEPLOY_HOST_TIMEOUT())
+    return dict((host, result['result'])
+                for host, result in results.items())
+
+
+def _resolve_commit(branch):
+    """ Get the commit at the HEAD of the local branch.
+
+    :param branch: The local branch name.
+    :type branch: str
+
+    :returns: str -- The commit SHA.
+    """
+
+    return local('git log -1 --format=format:%H {0}'.format(branch),
+                 capture=True)
+
+
+def _branch_checks(branch):
+    """ Nag about deploying anything other than master to live.
+
+    The decisions are answers to questions, see ``deploy.answers``, so
+    they can be given up front instead of at a prompt.
+
+    :param branch: The branch being deployed.
+    :type branch: str
+
+    :returns: dict -- The decisions made.
+    """
+
+    decisions = {}
+    target = getattr(env, 'target', None)
+
+    if 'live' == target and 'master' != branch:
 
         puts((blue('[ROBO NAG] 👮  Oh, I see you\'re pushing ') +
               yellow(branch) +
               blue(' to live. Y\'all be sure to merge to master now'))
              .encode('utf-8'))
 
-        answer = prompt(yellow(u'[ROBO NAG] want me to do it?'))
+        decisions['merge_to_master'] = answer('git_merge_to_master')
 
-        if 'y' == answer.lower():
+        if decisions['merge_to_master']:
             cmd = 'git checkout master && git pull origin master && '\
                   'git merge {0} && git push origin master -u'.format(branch)
             local(cmd)
         else:
-            prompt(red('[ROBO NAG] Ok, I\'m sure you\'re just testing something. '
-                       'Good luck, merge it when you get a mo yeh?'))
+            puts(red('[ROBO NAG] Ok, I\'m sure you\'re just testing something. '
+                     'Good luck, merge it when you get a mo yeh?'))
 
-    elif 'live' == env.target and 'master' == branch:
+    elif 'live' == target and 'master' == branch:
         puts(blue('[ROBO NAG] 🎉  Woop woop! deploying live').encode('utf-8'))
-        answer = prompt(yellow('[ROBO NAG] Push to Githubs?'))
+        decisions['push_to_origin'] = answer('git_push_to_origin')
 
-        if 'y' == answer.lower():
+        if decisions['push_to_origin']:
             cmd = 'git pull origin master && git push origin master -u'
             local(cmd)
             puts(blue('[ROBO NAG] 😇 Pushing Master to Origin').encode('utf-8'))
 
-    try:
-        push = 'git push -f ssh://{user}@{host}/{src} {branch}'.format(
-            user=settings.USER(), host=settings.HOST(),
-            src=settings.SRC_PATH(), branch=branch)
-    except FabricException as e:
-        _print_error(e)
-    else:
+    return decisions
+
+
+@pre_hooks()
+@post_hooks()
+def _deploy_host(branch, commit, **kwargs):
+    """ Push the branch to the current host and reset it to ``commit``.
+
+    :param branch: The branch to push.
+    :type branch: str
+
+    :param commit: The commit to reset the host to.
+    :type commit: str
+
+    :returns: str -- The deployed commit, raises FabricException when the
+        host could not be deployed.
+    """
+
+    from deploy.conf import settings
+    from deploy.connections import ssh_command, ssh_master
+    from deploy.release import create_release
+    from deploy.scm.bundle import (_prepare_bundle, _fetch_bundle,
+                                   _record_deployed, _deployed_commit)
+
+    session = DeploySession.get(branch)
+    if settings.DEPLOY_TRANSFER() == 'bundle':
+        # The first host deployed seeds the bundle
+        changed = session.changed_hosts(env.all_hosts or env.hosts)
+        _prepare_bundle(session, [env.host_string] + [
+            host for host in changed if host != env.host_string])
+
+    push = 'git push -f ssh://{user}@{host}/{src} {branch}'.format(
+        user=settings.USER(), host=settings.HOST(), src=settings.SRC_PATH(),
+        branch=branch)
+
+    if not _fetch_bundle(session):
         puts((blue('[GIT] Force Pushing on ') +
               yellow(branch) +
               blue(' branch')))
-        local(push)
-        with cd(settings.SRC_PATH()):
-            puts(blue('[GIT] Resetting to: {0}'.format(commit)))
-            run('git reset --hard {0}'.format(commit))
+        ssh_master(settings.USER(), settings.HOST())
+        with shell_env(GIT_SSH_COMMAND=ssh_command()):
+            local(push)
+    with cd(settings.SRC_PATH()):
+        puts(blue('[GIT] Resetting to: {0}'.format(commit)))
+        run('git reset --hard {0}'.format(commit))
+
+    if settings.USE_RELEASES():
+        create_release(commit)
+
+    # The commits deploy.changes diffs to decide what to reload
+    if session.heads is not None:
+        previous = session.heads.get(env.host_string)
+    else:
+        previous = _deployed_commit(env.host_string)
+    env.deploy_range = (previous, commit)
+
+    _record_deployed(env.host_string, commit)
+
+    return commit
@@ -0,0 +1,102 @@
+"""
+.. module:: store
+   :synopsis: Hardlink deduplicated release trees.
+
+A new release starts as a hardlinked copy of the current one. Only the
+paths git reports as changed between the two commits are replaced, and
+dependency directories are only kept while the hash of the dependency
+manifests is unchanged. Unchanged files cost no disk and no copying.
+
+A hardlinked file is the same file in every release that has it, so
+files in a release must be replaced, written to a new file and renamed
+over the old one, never edited in place. Dependency directories, which
+installers write to in place, are copied instead, as copy on write
+clones where the file system supports it.
+
+"""
+
+from fabric.colors import blue, green
+from fabric.utils import puts
+
+# Marks the line the stage script reports reuse on
+_REPORT = '@@velcro-store'
+
+_STAGE = r'''set -e -o pipefail
+commit={commit}; new={release}; stage={release}.tmp
+prev=$(readlink -f {current} || true)
+rm -rf "$stage"
+if [ -f "$prev/REVISION" ] && git cat-file -e "$(cat "$prev/REVISION")^{{commit}}" 2>/dev/null; then
+  old=$(cat "$prev/REVISION")
+  cp -al "$prev" "$stage"
+  rm -f "$stage/REVISION"
+  (cd "$stage" && rm -rf {dependencies})
+  git diff -z --name-only --no-renames "$old" "$commit" | (cd "$stage" && xargs -0 -r rm -rf --)
+  git diff -z --name-only --no-renames --diff-filter=AMT "$old" "$commit" | xargs -0 -r bash -c 'set -o pipefail; c=$1; shift; git archive "$c" -- "$@" | tar -x -C "$0"' "$stage" "$commit"
+  if [ "$(cd "$prev" && cat {manifests} 2>/dev/null | sha1sum)" = "$(cd "$stage" && cat {manifests} 2>/dev/null | sha1sum)" ]; then
+    for d in {dependencies}; do
+      if [ -e "$prev/$d" ]; then
+        cp -a --reflink=auto "$prev/$d" "$stage/$d"
+      fi
+    done
+  fi
+else
+  prev=
+  mkdir -p "$stage"
+  git archive "$commit" | tar -x -C "$stage"
+fi
+echo "$commit" > "$stage/REVISION" && mv "$stage" "$new"
+total=$(du -sb "$new" | cut -f1)
+if [ -n "$prev" ]; then copied=$(du -sb "$prev" "$new" | tail -n 1 | cut -f1); else copied=$total; fi
+echo "{marker} $((total - copied)) $copied"'''
+
+
+def _stage_release(batch, commit, release_path):
+    """ Add the steps that build a release tree to a batch.
+
+    :param batch: The batch creating the release.
+    :type batch: deploy.batch.Batch
+
+    :param commit: The commit to release.
+    :type commit: str
+
+    :param release_path: The new release directory.
+    :type release_path: str
+    """
+
+    from conf import settings
+
+    batch.add(_STAGE.format(
+        commit=commit, release=release_path,
+        current=settings.CURRENT_PATH(),
+        manifests=' '.join(settings.DEPENDENCY_MANIFESTS()),
+        dependencies=' '.join(settings.DEPENDENCY_DIRS()),
+        marker=_REPORT), cwd=settings.SRC_PATH())
+
+
+def _report_reuse(stdout):
+    """ Print the bytes a release reused from the previous one against the
+    bytes it copied.
+
+    :param stdout: Output of the stage step.
+    :type stdout: str
+
+    :returns: tuple -- Bytes reused and bytes copied.
+    """
+
+    for line in stdout.splitlines():
+        if line.startswith(_REPORT):
+            reused, copied = [int(n) for n in line.split()[1:3]]
+            puts(blue('[RELEASE] Reused ') + green(_size(reused)) +
+                 blue(', copied ') + green(_size(copied)))
+            return reused, copied
+    return 0, 0
+
+
+def _size(n):
+    """ Human readable byte count.
+    """
+
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if n < 1024 or unit == 'GB':
+            return '{0:.1f} {1}'.format(n, unit)
+        n /= 1024.0
@@ -0,0 +1,431 @@
+"""
+.. module:: timing
+   :synopsis: Timing spans for tasks, hooks and commands.
+
+Every fab task, hook and command run on a host or locally is timed as a
+span. Spans nest, so a task's span holds the hooks and commands it ran,
+and record the time spent waiting on remote and local commands, the bytes
+sent and received and the exit status.
+
+Timing is off unless ``env.timing`` is set, with ``fab --set timing ...``,
+and ``install()`` is called from the fabfile before it imports any tasks:
+
+.. code-block:: python
+
+    from deploy import timing
+    timing.install()
+
+    from deploy.scm.git import deploy
+
+Spans are kept in memory until the end of the run. They are then appended
+to ``settings.DEPLOY_LOG()`` as JSON lines, in a single command per host,
+on the hosts the run is still connected to, and a summary of the whole run
+is printed.
+
+"""
+
+import atexit
+import base64
+import glob
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from fabric import network, operations, tasks
+from fabric.state import connections, env
+
+# Longest command kept in a span name
+_NAME_LENGTH = 60
+
+_local = threading.local()
+_spans = []
+_pending = []
+_enabled = False
+
+
+def _stack():
+    """ Get the spans open in the current thread.
+
+    :returns: list -- The open spans, outermost first.
+    """
+
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def current():
+    """ Get the spans open in the current thread, to carry them over to a
+    thread started from it with ``adopt()``.
+
+    :returns: list -- The open spans, outermost first.
+    """
+
+    return list(_stack())
+
+
+def adopt(stack):
+    """ Nest the spans of the current thread in spans opened by another.
+
+    :param stack: Open spans from ``current()``.
+    :type stack: list
+    """
+
+    _local.stack = list(stack)
+
+
+def _name(command):
+    """ Shorten a command to a span name.
+    """
+
+    command = ' '.join(str(command).split())
+    if len(command) > _NAME_LENGTH:
+        return command[:_NAME_LENGTH - 3] + '...'
+    return command
+
+
+@contextmanager
+def span(name, kind, **fields):
+    """ Time a block of work as a span.
+
+    The time a ``run``, ``sudo``, ``put`` or ``get`` span takes counts as
+    remote time and a ``local`` span's as local time, for it and every span
+    it is nested in.
+
+    **Usage:**
+
+    .. code-block:: python:
+
+        with span('assets', 'step') as record:
+            record['bytes_sent'] = upload()
+
+    :param name: What is being timed, a task, hook or command.
+    :type name: str
+
+    :param kind: The kind of span, task, hook, run, sudo, local, put, get.
+    :type kind: str
+
+    :returns: dict -- The span record, extra fields can be set on it.
+    """
+
+    stack = _stack()
+    if not _enabled or getattr(_local, 'paused', False):
+        yield {}
+        return
+
+    record = {
+        'event': 'span',
+        'name': _name(name),
+        'kind': kind,
+        'host': env.host_string,
+        'task': env.get('command'),
+        'path': [s['name'] for s in stack] + [_name(name)],
+        'start': time.time(),
+        'duration': 0.0,
+        'remote': 0.0,
+        'local': 0.0,
+        'bytes_sent': 0,
+        'bytes_received': 0,
+        'exit_code': None,
+        'status': 'ok'}
+    record.update(fields)
+
+    stack.append(record)
+    try:
+        yield record
+    except BaseException:
+        record['status'] = 'failed'
+        raise
+    finally:
+        stack.pop()
+        record['duration'] = time.time() - record['start']
+        wait = {'local': 'local', 'run': 'remote', 'sudo': 'remote',
+                'put': 'remote', 'get': 'remote'}.get(kind)
+        if wait:
+            record[wait] = record['duration']
+            for parent in stack:
+                parent[wait] += record['duration']
+                parent['bytes_sent'] += record['bytes_sent']
+                parent['bytes_received'] += record['bytes_received']
+        _spans.append(record)
+        _pending.append(record)
+
+
+def add(name, kind, duration, **fields):
+    """ Record a span timed elsewhere, like a step of a remote batch, as a
+    child of the span currently open. Its time is not added to its
+    parents, the command it ran in already accounts for it.
+
+    :param name: What was timed.
+    :type name: str
+
+    :param kind: The kind of span.
+    :type kind: str
+
+    :param duration: Seconds it took.
+    :type duration: float
+
+    :param start: When it started, defaults to ``duration`` ago.
+    :type start: float
+    """
+
+    with span(name, kind, **fields) as record:
+        pass
+    if record:
+        record['duration'] = duration
+        if 'start' not in fields:
+            record['start'] -= duration
+
+
+@contextmanager
+def labelled(name):
+    """ Name the spans of the commands run in the current thread, instead
+    of naming them after the command.
+
+    :param name: The span name.
+    :type name: str
+    """
+
+    _local.label = name
+    try:
+        yield
+    finally:
+        _local.label = None
+
+
+@contextmanager
+def paused():
+    """ Stop recording spans in the current thread, for the commands that
+    write the spans out themselves.
+    """
+
+    _local.paused = True
+    try:
+        yield
+    finally:
+        _local.paused = False
+
+
+def flush():
+    """ Append the spans recorded for the current host to
+    ``settings.DEPLOY_LOG()`` on the host, in a single command. Nothing is
+    written to a host the run is not connected to, so tasks that never
+    reached it do not open a connection just to log.
+    """
+
+    from conf import settings
+    from fabric.context_managers import hide, settings as fab_settings
+
+    host = env.host_string
+    if not host or host not in connections:
+        return
+    records = [s for s in _pending if s['host'] == host]
+    if not records:
+        return
+    for record in records:
+        _pending.remove(record)
+
+    try:
+        log = settings.DEPLOY_LOG()
+        target = settings.TARGET()
+    except Exception:
+        return
+
+    lines = ''.join(json.dumps(dict(record, target=target),
+                               sort_keys=True) + '\n'
+                    for record in records)
+    with paused():
+        with fab_settings(hide('everything'), warn_only=True):
+            try:
+                operations.run('mkdir -p {0} && echo {1} | base64 -d '
+                               '>> {2}'.format(os.path.dirname(log),
+                                               base64.b64encode(lines), log))
+            except Exception:
+                # The connection dropped, the summary still has its spans
+                pass
+
+
+def _flush_all():
+    """ Flush the spans of every host, before the run disconnects from
+    them.
+    """
+
+    from fabric.context_managers import settings as fab_settings
+
+    for host in sorted(set(s['host'] for s in _pending if s['host'])):
+        with fab_settings(**network.to_dict(host)):
+            flush()
+
+
+def fork():
+    """ Forget the spans recorded so far, in a child process that reports
+    its own spans back with ``spans()``.
+    """
+
+    del _spans[:]
+    del _pending[:]
+
+
+def spans():
+    """ Get the spans recorded so far.
+
+    :returns: list -- The span records.
+    """
+
+    return list(_spans)
+
+
+def merge(records):
+    """ Add spans recorded in another process to the summary.
+
+    :param records: The span records.
+    :type records: list
+    """
+
+    _spans.extend(records)
+
+
+def report():
+    """ Print the time spent in each task, hook and command, nested the way
+    they ran and summed across hosts.
+    """
+
+    from utils import _print_table
+
+    if not _spans:
+        return
+
+    totals = {}
+    for record in _spans:
+        key = tuple(record['path'])
+        total = totals.setdefault(key, {
+            'calls': 0, 'duration': 0.0, 'remote': 0.0, 'local': 0.0,
+            'bytes': 0, 'failed': 0})
+        total['calls'] += 1
+        total['duration'] += record['duration']
+        total['remote'] += record['remote']
+        total['local'] += record['local']
+        total['bytes'] += record['bytes_sent'] + record['bytes_received']
+        total['failed'] += record['status'] != 'ok'
+
+    first = {}
+    for i, record in enumerate(_spans):
+        key = tuple(record['path'])
+        first[key] = min(first.get(key, (record['start'], i)),
+                         (record['start'], i))
+
+    def order(key):
+        # Parents before children, siblings in the order they first ran
+        return [first.get(key[:i], 0) for i in range(1, len(key) + 1)]
+
+    longest = max(t['duration'] for t in totals.values()) or 1.0
+
+    rows = []
+    for key in sorted(totals, key=order):
+        total = totals[key]
+        rows.append([
+            '  ' * (len(key) - 1) + key[-1],
+            total['calls'],
+            '{0:.2f}s'.format(total['duration']),
+            '{0:.2f}s'.format(total['remote']),
+            '{0:.2f}s'.format(total['local']),
+            total['bytes'],
+            total['failed'],
+            '#' * int(round(20 * total['duration'] / longest))])
+
+    _print_table(['Span', 'Calls', 'Total', 'Remote', 'Local', 'Bytes',
+                  'Failed', ''], rows)
+
+
+def _size(path):
+    """ Total size of the local files a path or glob names.
+    """
+
+    if not isinstance(path, basestring):
+        return 0
+    return sum(os.path.getsize(p) for p in glob.glob(os.path.expanduser(path))
+               if os.path.isfile(p))
+
+
+def install():
+    """ Start timing fab tasks and commands, write the spans out and report
+    them at the end of the run. Does nothing unless ``env.timing`` is set.
+    Safe to call more than once.
+
+    ``env.timing`` is read directly rather than through ``settings``, so
+    loading the fabfile does not build the config.
+    """
+
+    global _enabled
+
+    from fabric import api
+
+    if not env.get('timing') or _enabled:
+        return
+    _enabled = True
+
+    run_command = operations._run_command
+    local = operations.local
+    put = operations.put
+    get = operations.get
+    task_run = tasks.WrappedCallableTask.run
+    disconnect_all = network.disconnect_all
+
+    def timed_run_command(command, *args, **kwargs):
+        kind = 'sudo' if kwargs.get('sudo') else 'run'
+        name = getattr(_local, 'label', None) or command
+        with span(name, kind, bytes_sent=len(command)) as record:
+            result = run_command(command, *args, **kwargs)
+            if record:
+                record['exit_code'] = result.return_code
+                record['bytes_received'] = len(result) + len(result.stderr)
+                if result.failed:
+                    record['status'] = 'failed'
+            return result
+
+    def timed_local(command, *args, **kwargs):
+        with span(command, 'local') as record:
+            result = local(command, *args, **kwargs)
+            if record:
+                record['exit_code'] = result.return_code
+                if result.failed:
+                    record['status'] = 'failed'
+            return result
+
+    def timed_put(local_path=None, remote_path=None, *args, **kwargs):
+        name = 'put {0}'.format(local_path)
+        with span(name, 'put', bytes_sent=_size(local_path)):
+            return put(local_path, remote_path, *args, **kwargs)
+
+    def timed_get(remote_path, *args, **kwargs):
+        with span('get {0}'.format(remote_path), 'get') as record:
+            result = get(remote_path, *args, **kwargs)
+            if record:
+                record['bytes_received'] = sum(_size(p) for p in result)
+            return result
+
+    def timed_task_run(self, *args, **kwargs):
+        with span(self.name, 'task'):
+            return task_run(self, *args, **kwargs)
+
+    def flushing_disconnect_all():
+        _flush_all()
+        disconnect_all()
+
+    operations._run_command = timed_run_command
+    operations.local = api.local = timed_local
+    operations.put = api.put = timed_put
+    operations.get = api.get = timed_get
+    tasks.WrappedCallableTask.run = timed_task_run
+
+    # fab disconnects before exiting, the spans have to go out first
+    network.disconnect_all = flushing_disconnect_all
+    main = sys.modules.get('fabric.main')
+    if main is not None:
+        main.disconnect_all = flushing_disconnect_all
+
+    atexit.register(_flush_all)
+    atexit.register(report)
@@ -5,14 +5,19 @@
 """
 
 import datetime
+import hashlib
+import json
+import marshal
 import os
+import re
 import time
-from yaml import load
 
 from fabric.api import run, sudo
-from fabric.colors import green, blue, red, yellow
+from fabric.colors import green, blue, red
 from fabric.state import env
 from fabric.utils import puts
+from . import FabricException
+from hooks import after, concurrent
 
 
 def _print_error(message):
@@ -25,6 +30,48 @@ def _print_error(message):
     puts(red('[ERROR]: {0}'.format(message), bold=True))
 
 
+def _print_table(headers, rows):
+    """ Print rows of values as an aligned table.
+
+    :param headers: The column headings.
+    :type headers: list
+
+    :param rows: The table rows, one value per column.
+    :type rows: list
+    """
+
+    rows = [[str(value) for value in row] for row in rows]
+    widths = [max([len(h)] + [len(row[i]) for row in rows])
+              for i, h in enumerate(headers)]
+    line = '  '.join('{{{0}:<{1}}}'.format(i, w) for i, w in enumerate(widths))
+
+    puts(blue(line.format(*headers), bold=True))
+    for row in rows:
+        puts(line.format(*row))
+
+
+def _json_log_command(path, record):
+    """ Shell command appending a record to a log file as a JSON line.
+
+    String values that name a shell variable, like ``'$hash'``, are
+    expanded by the remote shell.
+
+    :param path: The log file path.
+    :type path: str
+
+    :param record: The values to log.
+    :type record: dict
+
+    :returns: str -- The command.
+    """
+
+    line = json.dumps(record, sort_keys=True).replace("'", "'\\''")
+    line = re.sub(r'"\$(\w+)"', '"\'"$\\1"\'"', line)
+
+    return "mkdir -p {0} && echo '{1}' >> {2}".format(
+        os.path.dirname(path), line, path)
+
+
 def _raise(exception):
     """ Raise exception, for usage in lambda's
 
@@ -35,6 +82,35 @@ def _raise(exception):
     raise exception
 
 
+def _bool(value):
+    """ Turn a task argument into a bool, ``fab`` passes them all as
+    strings.
+
+    :param value: The argument.
+    :type value: str or bool
+
+    :returns: bool -- False for False, None, '', '0', 'false' and 'no'.
+    """
+
+    if isinstance(value, basestring):
+        return value.strip().lower() not in ('', '0', 'false', 'no')
+    return bool(value)
+
+
+def _check_sudo(command):
+    """ Make sure a command can be run with sudo.
+
+    :param command: The command to run with sudo.
+    :type command: str.
+
+    :raises: FabricException -- When ``env.sudo_user`` is not set.
+    """
+
+    if not env.sudo_user:
+        raise FabricException('Could not run {0}, missing '
+                              'sudo user'.format(command))
+
+
 def _sudo(command):
     """ Run command with sudo privileges
 
@@ -44,14 +120,12 @@ def _sudo(command):
     :returns: bool -- True if successful False if not.
     """
 
-    if env.sudo_user:
-        sudo(command)
-    else:
-        raise FabricException('Could not run {0}, missing '
-                              'sudo user'.format(command))
+    _check_sudo(command)
+    sudo(command)
 
 
-def _symlink(target_path, link_path, use_sudo=False):
+def _symlink(target_path, link_path, use_sudo=False, batch=None,
+             atomic=False):
     """ Generate symbolic links.
 
     :param target_path: The symlink target path.
@@ -60,19 +134,34 @@ def _symlink(target_path, link_path, use_sudo=False):
     :param link_path: The name for the symlinked file.
     :type link_path: str.
 
+    :param atomic: Swap the link with a rename, so it never goes missing.
+    :type atomic: bool.
+
+    :param batch: Add the commands to this batch instead of running them.
+    :type batch: deploy.batch.Batch
+
     :returns: bool -- True if successful False if not.
     """
 
-    unlink = 'if [ -L {0} ]; then unlink {0}; fi'.format(link_path)
-    link = 'ln -s {0} {1}'.format(target_path, link_path)
+    from batch import Batch
+
+    if atomic:
+        commands = ['ln -sfn {0} {1}.tmp && mv -Tf {1}.tmp {1}'.format(
+            target_path, link_path)]
+    else:
+        commands = ['if [ -L {0} ]; then unlink {0}; fi'.format(link_path),
+                    'ln -s {0} {1}'.format(target_path, link_path)]
+
+    if batch is not None:
+        for command in commands:
+            batch.add(command)
+        return True
 
     try:
-        if use_sudo:
-            _sudo(unlink)
-            _sudo(link)
-        else:
-            run(unlink)
-            run(link)
+        batch = Batch(use_sudo=use_sudo)
+        for command in commands:
+            batch.add(command)
+        batch.run()
         return True
     except FabricException as e:
         _print_error(e)
@@ -91,8 +180,10 @@ def _target(name):
     """
 
     from conf import settings
+    from connections import install
 
     puts(blue('Set target: ') + green(name.title(), bold=True))
+    install()
 
     now = time.time()
 
@@ -110,28 +201,6 @@ def _target(name):
         _print_error(e)
 
 
-def _call_hooks(hooks):
-    """ Run hook functions.
-
-    :param hooks: List of hooks to import and call
-    :type hooks: list or tuple
-    """
-
-    if hooks:
-        for hook in hooks:
-            try:
-                path, name = os.path.splitext(hook)
-                module = __import__(path, globals(), locals(), [name[1:]], -1)
-                func = getattr(module, name[1:], None)
-                if not callable(func):
-                    _print_error('{0} is not callable'.format(hook))
-                else:
-                    puts(yellow('[HOOK]: {0}'.format(hook)))
-                    func()
-            except ImportError:
-                _print_error('Failed to import hook: {0}'.format(hook))
-
-
 def print_config_path():
     """
     Print config build path.
@@ -181,6 +250,8 @@ def print_local_config_path():
     puts(blue('Config Path: {0}'.format(settings.LOCAL_CONFIG_PATH())))
 
 
+@concurrent
+@after('deploy.scm.git.clean')
 def cdn_timestamp():
     """
     Write the current timestamp to an importable file
@@ -188,7 +259,7 @@ def cdn_timestamp():
     **Usage:**
 
     Add to the deploy function as a post_hook ``fabfile.py``:
-    Make sure it comes after git.clean or it will get deleted
+    It always runs after git.clean, which would delete it
 
     .. code-block:: python:
         ...
@@ -212,6 +283,11 @@ def get_local_config():
     this reads key value pairs from a ~/.velcro.yml file
     and adds them to the env
 
+    A ``.velcro.yml`` next to the ``fabfile.py`` is read as well, its
+    values override the ones in ``~/.velcro.yml``. The parsed result is
+    cached in ``~/.velcro/``, readable only by the user as it holds the
+    same secrets, and only parsed again when one of the files changes.
+
     Yaml format:
 
     .. code-block:: yaml:
@@ -227,13 +303,96 @@ def get_local_config():
 
     """
 
+    paths = [os.path.join(os.environ.get('HOME'), '.velcro.yml')]
+    if env.get('real_fabfile'):
+        paths.append(os.path.join(os.path.dirname(env.real_fabfile),
+                                  '.velcro.yml'))
+
+    for group, config in _read_local_config(paths).iteritems():
+        for k, v in config.iteritems():
+            prop = '{group}_{key}'.format(group=group, key=k)
+            setattr(env, prop, v)
+
+
+def _read_local_config(paths):
+    """ Read and merge local config files, using the cached result when
+    none of the files have changed since it was written.
+
+    :param paths: Config file paths, later files override earlier ones.
+    :type paths: list
+
+    :returns: dict -- Config values by group.
+    """
+
+    stamps = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stamps.append([path, None, None])
+        else:
+            stamps.append([path, stat.st_mtime, stat.st_size])
+
+    name = 'config-{0}'.format(
+        hashlib.sha1('|'.join(paths).encode('utf-8')).hexdigest()[:12])
+    cache_dir = os.path.join(os.environ.get('HOME'), '.velcro')
+    cache_path = os.path.join(cache_dir, name + '.cache')
+
     try:
-        with open(os.path.join(os.environ.get('HOME'), '.velcro.yml'), 'r') as f:
-            data = load(f.read())
-    except IOError:
+        with open(cache_path, 'rb') as f:
+            cached = marshal.load(f)
+        if cached['stamps'] == stamps:
+            return cached['data']
+    except (IOError, EOFError, ValueError, TypeError, KeyError):
         pass
-    else:
-        for group, config in data.iteritems():
-            for k, v in config.iteritems():
-                prop = '{group}_{key}'.format(group=group, key=k)
-                setattr(env, prop, v)
+
+    data = {}
+    for path, mtime, size in stamps:
+        if mtime is None:
+            continue
+        for group, config in _load_yaml(path).items():
+            # Groups may be a mapping or a list of single key mappings
+            if isinstance(config, list):
+                config = dict(kv for item in config for kv in item.items())
+            data.setdefault(group, {}).update(config or {})
+
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0o700)
+        # marshal keeps str and unicode apart, the cached run sees the
+        # same types as the first
+        content = marshal.dumps({'stamps': stamps, 'data': data})
+        fd = os.open(cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o600)
+        try:
+            os.fchmod(fd, 0o600)
+            os.write(fd, content)
+        finally:
+            os.close(fd)
+    except (IOError, OSError, ValueError):
+        # Values marshal can't hold, like dates, are parsed again next time
+        pass
+
+    return data
+
+
+def _load_yaml(path):
+    """ Parse a YAML file with the C safe loader when libyaml is available.
+
+    :param path: The file path.
+    :type path: str
+
+    :returns: dict -- The parsed file, empty if the file is.
+    """
+
+    from yaml import load
+    try:
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import SafeLoader
+
+    try:
+        with open(path, 'r') as f:
+            return load(f, Loader=SafeLoader) or {}
+    except IOError:
+        return {}
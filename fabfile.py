@@ -3,12 +3,22 @@ from fabric.api import env, roles
 from fabric.state import output
 from fabric.operations import run, put, local
 
+# Times tasks and commands when run with fab --set timing, it has to wrap
+# the commands before the tasks importing them are loaded
+from deploy import timing
+timing.install()
+
+from deploy.answers import questionnaire
 from deploy.env import bootstrap as _bootstrap
 from deploy.decorators import pre_hooks, post_hooks
 from deploy.http.nginx import (restart_nginx, reload_nginx, stop_nginx,
-                               start_nginx)
+                               start_nginx, sync_nginx, parallel_sync_nginx)
+from deploy.process.pm2 import reload_pm2, rolling_reload, health_check
+from deploy.release import rollback
+from deploy.rolling import rolling_deploy
 from deploy.scm.git import deploy
 from deploy.target import live, stage
+from deploy.utils import print_config_path
 
 # Project Details
 env.client = 'lingobee'